@@ -0,0 +1,71 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare passing objects to Python native callbacks directly and as JSON strings.
+
+Usage: python python_native.py [calls] [fields]
+
+Both variants call a native callback once per loop iteration with an object of
+the given number of fields.  The first passes the object itself, the second
+the workaround needed before native callbacks took arrays and objects:
+std.manifestJson in Jsonnet and json.loads in Python.
+"""
+
+import json
+import sys
+import time
+
+import _jsonnet
+
+CODE = '''
+local obj = { ["f" + i]: [i, "v" + i, { n: i }] for i in std.range(1, %(fields)d) };
+std.foldl(function(acc, i) acc + std.native("%(native)s")(%(arg)s), std.range(1, %(calls)d), 0)
+'''
+
+
+def size(obj):
+    return len(obj)
+
+
+def size_json(obj):
+    return len(json.loads(obj))
+
+
+NATIVES = {
+    'size': (('obj',), size),
+    'size_json': (('obj',), size_json),
+}
+
+
+def run(calls, fields, native, arg):
+    vm = _jsonnet.Vm(native_callbacks=NATIVES)
+    code = CODE % {'calls': calls, 'fields': fields, 'native': native, 'arg': arg}
+    start = time.time()
+    result = vm.evaluate_snippet('bench', code)
+    assert int(result) == calls * fields, result
+    return time.time() - start
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    fields = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    direct = run(calls, fields, 'size', 'obj')
+    via_json = run(calls, fields, 'size_json', 'std.manifestJson(obj)')
+    print('object argument:   %8.3f s' % direct)
+    print('manifestJson+json: %8.3f s  (x%.2f)' % (via_json, via_json / direct))
+
+
+if __name__ == '__main__':
+    main()
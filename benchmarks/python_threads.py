@@ -0,0 +1,72 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how _jsonnet evaluation throughput scales with threads.
+
+Usage: python python_threads.py [file.jsonnet] [max_threads] [evals_per_thread]
+
+Each thread evaluates the file repeatedly with its own _jsonnet.Vm.  Since the
+GIL is released during evaluation, throughput should grow close to linearly
+with the number of threads, up to the number of cores.  The same work is then
+given to _jsonnet.evaluate_many with that many workers.
+"""
+
+import os
+import sys
+import threading
+import time
+
+import _jsonnet
+
+
+def run(filename, num_threads, evals):
+    def worker():
+        vm = _jsonnet.Vm()
+        for _ in range(evals):
+            vm.evaluate_file(filename)
+
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return num_threads * evals / (time.time() - start)
+
+
+def run_many(filename, num_threads, evals):
+    start = time.time()
+    _jsonnet.evaluate_many([filename] * (num_threads * evals), workers=num_threads)
+    return num_threads * evals / (time.time() - start)
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    filename = sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, 'bench.04.jsonnet')
+    max_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    evals = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    base = None
+    num_threads = 1
+    while num_threads <= max_threads:
+        rate = run(filename, num_threads, evals)
+        base = base or rate
+        many = run_many(filename, num_threads, evals)
+        print('%2d threads: %8.2f evals/s  (x%.2f)   evaluate_many: %8.2f evals/s  (x%.2f)' % (
+            num_threads, rate, rate / base, many, many / base))
+        num_threads *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare evaluating straight to Python objects with the JSON string round trip.
+
+Usage: python python_to_python.py [scale] [runs]
+
+Each workload is evaluated with evaluate_snippet_to_python and with
+json.loads(evaluate_snippet(...)).  Each run is in a process of its own, so
+that its peak memory (maxrss) can be reported as well as its CPU time.  The
+scale multiplies the size of every workload.
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import _jsonnet
+
+WORKLOADS = {
+    'numbers': 'std.range(1, %d * 1000000)',
+    'strings': 'std.makeArray(%d * 200000, function(i) "item-%%d" %% i)',
+    'objects': """
+std.makeArray(%d * 60000, function(i) {
+  name: 'object-' + i,
+  labels: { app: 'app-' + i %% 10, tier: 'backend' },
+  ports: [8080 + i %% 3, 9090],
+  weight: i / 7,
+  enabled: i %% 2 == 0,
+})
+""",
+}
+
+
+def run(workload, variant, scale):
+    src = WORKLOADS[workload] % scale
+    start = time.process_time()
+    if variant == 'to_python':
+        value = _jsonnet.evaluate_snippet_to_python('snippet', src)
+    else:
+        value = json.loads(_jsonnet.evaluate_snippet('snippet', src))
+    elapsed = time.process_time() - start
+    assert isinstance(value, list)
+    # ru_maxrss is in kilobytes on Linux.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print('%f %f' % (elapsed, maxrss))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    for workload in sorted(WORKLOADS):
+        for variant in ['to_python', 'json.loads']:
+            results = []
+            for _ in range(runs):
+                out = subprocess.check_output(
+                    [sys.executable, __file__, '--run', workload, variant, str(scale)])
+                results.append([float(x) for x in out.split()])
+            print('%-8s  %-10s  %8.2fs cpu  %8.1f MB maxrss  (best of %d)' % (
+                workload, variant, min(r[0] for r in results), min(r[1] for r in results),
+                runs))
+
+
+if __name__ == '__main__':
+    main()
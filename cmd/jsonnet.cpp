@@ -62,6 +62,7 @@ void usage(std::ostream &o)
     o << "  -t / --max-trace <n>    Max length of stack trace before cropping\n";
     o << "  --gc-min-objects <n>    Do not run garbage collector until this many\n";
     o << "  --gc-growth-trigger <n> Run garbage collector after this amount of object growth\n";
+    o << "  --gc-nursery-objects <n> Collect new objects once there are this many (0 to disable)\n";
     o << "  --version               Print version\n";
     o << "Available options for specifying values of 'external' variables:\n";
     o << "Provide the value as a string:\n";
@@ -308,6 +309,13 @@ static ArgStatus process_args(int argc, const char **argv, JsonnetConfig *config
                 return ARG_FAILURE;
             }
             jsonnet_gc_growth_trigger(vm, v);
+        } else if (arg == "--gc-nursery-objects") {
+            long l = strtol_check(next_arg(i, args));
+            if (l < 0) {
+                std::cerr << "ERROR: invalid --gc-nursery-objects value: " << l << std::endl;
+                return ARG_FAILURE;
+            }
+            jsonnet_gc_nursery_objects(vm, l);
         } else if (arg == "-m" || arg == "--multi") {
             config->evalMulti = true;
             std::string output_dir = next_arg(i, args);
@@ -450,24 +458,20 @@ static bool write_output_stream(JsonnetVm *vm, char *output, const std::string &
         o = &f;
     }
 
-    // If YAML stream output is used, then iterate over each string from
-    // the sequence of strings returned by jsonnet_evaluate_snippet_stream,
-    // and add the --- and ... as defined by the YAML spec.
-    std::vector<std::string> r;
-    for (const char *c = output; *c != '\0';) {
-        const char *json = c;
-        while (*c != '\0')
-            ++c;
-        ++c;
-        r.emplace_back(json);
-    }
-    jsonnet_realloc(vm, output, 0);
-    for (const auto &str : r) {
+    // If YAML stream output is used, then write each string from the
+    // sequence of strings returned by jsonnet_evaluate_snippet_stream
+    // straight from the buffer, and add the --- and ... as defined by the
+    // YAML spec.
+    const char *c = output;
+    while (*c != '\0') {
+        size_t len = strlen(c);
         (*o) << "---\n";
-        (*o) << str;
+        o->write(c, len);
+        c += len + 1;
     }
-    if (r.size() > 0)
+    if (c != output)
         (*o) << "...\n";
+    jsonnet_realloc(vm, output, 0);
     o->flush();
 
     if (output_file.empty()) {
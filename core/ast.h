@@ -369,10 +369,13 @@ struct Binary : public AST {
  * interpreter.
  */
 struct BuiltinFunction : public AST {
+    /** The number of the builtin, as given to jsonnet_builtin_decl. */
+    unsigned long builtin;
     std::string name;
     Identifiers params;
-    BuiltinFunction(const LocationRange &lr, const std::string &name, const Identifiers &params)
-        : AST(lr, AST_BUILTIN_FUNCTION, Fodder{}), name(name), params(params)
+    BuiltinFunction(const LocationRange &lr, unsigned long builtin, const std::string &name,
+                    const Identifiers &params)
+        : AST(lr, AST_BUILTIN_FUNCTION, Fodder{}), builtin(builtin), name(name), params(params)
     {
     }
 };
@@ -938,7 +941,29 @@ class Allocator {
     std::map<UString, const Identifier *> internedIdentifiers;
     ASTs allocated;
 
+    /** If non-null, identifiers are interned in the parent instead.
+     *
+     * Identifiers are compared by pointer, so this allows ASTs owned by a short-lived allocator
+     * to be mixed with ASTs owned by a long-lived one (e.g. the cached stdlib).
+     */
+    Allocator *parent;
+
+    /** If non-null, identifiers already interned in base are used rather than new ones. */
+    const Allocator *base;
+
    public:
+    Allocator(Allocator *parent = nullptr) : parent(parent), base(nullptr) {}
+
+    /** Use the identifiers of base, so this allocator's ASTs can be mixed with base's.
+     *
+     * Unlike a parent, base is only read, so it can be shared between threads as long as nothing
+     * interns identifiers in it any more.  Must be called before any identifiers are interned.
+     */
+    void share(const Allocator *base)
+    {
+        this->base = base;
+    }
+
     template <class T, class... Args>
     T *make(Args &&... args)
     {
@@ -960,6 +985,13 @@ class Allocator {
      */
     const Identifier *makeIdentifier(const UString &name)
     {
+        if (parent != nullptr)
+            return parent->makeIdentifier(name);
+        if (base != nullptr) {
+            auto it = base->internedIdentifiers.find(name);
+            if (it != base->internedIdentifiers.end())
+                return it->second;
+        }
         auto it = internedIdentifiers.find(name);
         if (it != internedIdentifiers.end()) {
             return it->second;
@@ -29,12 +29,13 @@ static const Fodder EF;  // Empty fodder.
 
 static const LocationRange E;  // Empty.
 
-struct BuiltinDecl {
-    UString name;
-    std::vector<UString> params;
-};
+static unsigned long max_builtin = 47;
+
+unsigned long jsonnet_max_builtin(void)
+{
+    return max_builtin;
+}
 
-static unsigned long max_builtin = 37;
 BuiltinDecl jsonnet_builtin_decl(unsigned long builtin)
 {
     switch (builtin) {
@@ -76,6 +77,18 @@ BuiltinDecl jsonnet_builtin_decl(unsigned long builtin)
         case 35: return {U"parseJson", {U"str"}};
         case 36: return {U"encodeUTF8", {U"str"}};
         case 37: return {U"decodeUTF8", {U"arr"}};
+        case 38: return {U"sortImpl", {U"arr", U"keyF"}};
+        case 39: return {U"setUnionImpl", {U"a", U"b", U"keyF"}};
+        case 40: return {U"setInterImpl", {U"a", U"b", U"keyF"}};
+        case 41: return {U"setDiffImpl", {U"a", U"b", U"keyF"}};
+        case 42: return {U"uniqImpl", {U"arr", U"keyF"}};
+        case 43: return {U"format", {U"str", U"vals"}};
+        case 44: return {U"escapeStringJson", {U"str_"}};
+        case 45: return {U"manifestJsonEx", {U"value", U"indent"}};
+        case 46: return {U"manifestYamlDocImpl", {U"value", U"indent_array_in_object"}};
+        case 47:
+            return {U"manifestYamlStreamImpl",
+                    {U"value", U"indent_array_in_object", U"c_document_end"}};
         default:
             std::cerr << "INTERNAL ERROR: Unrecognized builtin function: " << builtin << std::endl;
             std::abort();
@@ -901,11 +914,14 @@ class Desugarer {
         }
     }
 
-    void desugarFile(AST *&ast, std::map<std::string, VmExt> *tlas)
+    /** Build the std object, i.e. std.jsonnet plus the natively implemented builtins.
+     *
+     * The result is "local std = { ... }; std" so that the stdlib functions can refer to each
+     * other.  It is closed, so it can be analysed and executed on its own and then bound to $std
+     * when executing the output of desugarFile.
+     */
+    AST *stdlib(void)
     {
-        desugar(ast, 0);
-
-        // Now, implement the std library by wrapping in a local construct.
         Tokens tokens = jsonnet_lex("std.jsonnet", STD_CODE);
         AST *std_ast = jsonnet_parse(alloc, tokens);
         desugar(std_ast, 0);
@@ -923,7 +939,7 @@ class Desugarer {
             for (const auto &p : decl.params)
                 params.push_back(id(p));
             auto name = str(decl.name);
-            auto fn = make<BuiltinFunction>(E, encode_utf8(decl.name), params);
+            auto fn = make<BuiltinFunction>(E, c, encode_utf8(decl.name), params);
             auto field = std::find_if(fields.begin(), fields.end(),
                 [=](const DesugaredObject::Field& f) {
                     return static_cast<LiteralString*>(f.name)->value == decl.name;
@@ -934,8 +950,13 @@ class Desugarer {
                 fields.emplace_back(ObjectField::HIDDEN, name, fn);
             }
         }
-        fields.emplace_back(
-            ObjectField::HIDDEN, str(U"thisFile"), str(decode_utf8(ast->location.file)));
+
+        return make<Local>(E, EF, singleBind(id(U"std"), std_obj), std());
+    }
+
+    void desugarFile(AST *&ast, std::map<std::string, VmExt> *tlas)
+    {
+        desugar(ast, 0);
 
         std::vector<std::string> empty;
         auto line_end_blank = Fodder{{FodderElement::LINE_END, 1, 0, empty}};
@@ -985,7 +1006,12 @@ class Desugarer {
                                               make<Var>(E, line_end, body)));
         }
 
-        // local std = (std.jsonnet stuff); ast
+        // local std = $std + { thisFile:: "..." }; ast
+        DesugaredObject::Fields this_file_fields;
+        this_file_fields.emplace_back(
+            ObjectField::HIDDEN, str(U"thisFile"), str(decode_utf8(ast->location.file)));
+        AST *this_file = make<DesugaredObject>(E, ASTs{}, this_file_fields);
+        AST *std_obj = make<Binary>(E, EF, var(id(U"$std")), EF, BOP_PLUS, this_file);
         ast = make<Local>(ast->location, EF, singleBind(id(U"std"), std_obj), ast);
     }
 };
@@ -995,3 +1021,9 @@ void jsonnet_desugar(Allocator *alloc, AST *&ast, std::map<std::string, VmExt> *
     Desugarer desugarer(alloc);
     desugarer.desugarFile(ast, tlas);
 }
+
+AST *jsonnet_desugar_stdlib(Allocator *alloc)
+{
+    Desugarer desugarer(alloc);
+    return desugarer.stdlib();
+}
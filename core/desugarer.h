@@ -19,11 +19,28 @@ limitations under the License.
 
 #include <map>
 #include <string>
+#include <vector>
 
 #include "ast.h"
 #include "vm.h"
 
+/** A function of the std object that is implemented natively. */
+struct BuiltinDecl {
+    UString name;
+    std::vector<UString> params;
+};
+
+/** The natively implemented std functions are numbered from 0 to jsonnet_max_builtin(). */
+unsigned long jsonnet_max_builtin(void);
+
+/** The name and parameters of a natively implemented std function. */
+BuiltinDecl jsonnet_builtin_decl(unsigned long builtin);
+
 /** Translate the AST to remove syntax sugar.
+ *
+ * The result refers to the standard library through the free variable $std, which must be bound
+ * to the result of executing jsonnet_desugar_stdlib.
+ *
  * \param alloc Allocator for making new identifiers / ASTs.
  * \param ast The AST to change.
  * \param tla the top level arguments.  If null then do not try to process
@@ -31,4 +48,14 @@ limitations under the License.
  */
 void jsonnet_desugar(Allocator *alloc, AST *&ast, std::map<std::string, VmExt> *tla);
 
+/** Build the desugared standard library, including the natively implemented builtins.
+ *
+ * The result has no free variables and evaluates to the std object.  It only depends on the
+ * interpreter version, so it can be built once and shared between executions.
+ *
+ * \param alloc Allocator for making new identifiers / ASTs.
+ * \returns The AST of the standard library.
+ */
+AST *jsonnet_desugar_stdlib(Allocator *alloc);
+
 #endif
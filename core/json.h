@@ -17,6 +17,7 @@ limitations under the License.
 #ifndef JSONNET_JSON_H
 #define JSONNET_JSON_H
 
+#include <map>
 #include <memory>
 #include <string>
 #include <vector>
@@ -42,6 +43,27 @@ struct JsonnetJsonValue {
     {
     }
 
+    /** Frees the nested values without recursing, so deeply nested values cannot overflow the
+     * native stack.
+     */
+    ~JsonnetJsonValue()
+    {
+        std::vector<std::unique_ptr<JsonnetJsonValue>> pending;
+        pending.swap(elements);
+        for (auto &pair : fields)
+            pending.push_back(std::move(pair.second));
+        while (!pending.empty()) {
+            std::unique_ptr<JsonnetJsonValue> v = std::move(pending.back());
+            pending.pop_back();
+            for (auto &el : v->elements)
+                pending.push_back(std::move(el));
+            for (auto &pair : v->fields)
+                pending.push_back(std::move(pair.second));
+            v->elements.clear();
+            v->fields.clear();
+        }
+    }
+
     Kind kind;
     std::string string;
     double number;  // Also used for bool (0.0 and 1.0)
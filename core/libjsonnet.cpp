@@ -21,6 +21,7 @@ limitations under the License.
 #include <exception>
 #include <fstream>
 #include <iostream>
+#include <iterator>
 #include <sstream>
 #include <string>
 
@@ -83,6 +84,88 @@ int jsonnet_json_extract_null(struct JsonnetVm *vm, const struct JsonnetJsonValu
     return v->kind == JsonnetJsonValue::NULL_KIND;
 }
 
+/** Convert v with the builder b, walking arrays and objects without recursing. */
+static void *json_extract_value(const JsonnetJsonValue *v, const JsonnetValueBuilder &b,
+                                void *ctx)
+{
+    // An array or object whose elements are being built.
+    struct Level {
+        const JsonnetJsonValue *v;
+        // The value built so far, owned until it is appended to the enclosing one.
+        void *r;
+        size_t next;
+        std::map<std::string, std::unique_ptr<JsonnetJsonValue>>::const_iterator field;
+    };
+    std::vector<Level> levels;
+    while (true) {
+        // Build v, or start building its elements.
+        void *r = nullptr;
+        bool opened = false;
+        switch (v->kind) {
+            case JsonnetJsonValue::NULL_KIND: r = b.make_null(ctx); break;
+
+            case JsonnetJsonValue::BOOL: r = b.make_bool(ctx, v->number != 0); break;
+
+            case JsonnetJsonValue::NUMBER: r = b.make_number(ctx, v->number); break;
+
+            case JsonnetJsonValue::STRING:
+                r = b.make_string(ctx, v->string.data(), v->string.length());
+                break;
+
+            case JsonnetJsonValue::ARRAY:
+                r = b.make_array(ctx);
+                opened = r != nullptr && v->elements.size() > 0;
+                break;
+
+            case JsonnetJsonValue::OBJECT:
+                r = b.make_object(ctx);
+                opened = r != nullptr && v->fields.size() > 0;
+                break;
+        }
+        if (opened)
+            levels.push_back(Level{v, r, 0, v->fields.begin()});
+
+        // Append the finished value to its array or object, and those that are finished in
+        // turn to theirs.  The builder owns the element once appending is attempted.
+        bool ok = r != nullptr;
+        while (!opened && !levels.empty()) {
+            Level &l = levels.back();
+            if (ok) {
+                if (l.v->kind == JsonnetJsonValue::ARRAY) {
+                    ok = b.array_append(ctx, l.r, r);
+                } else {
+                    const std::string &name = std::prev(l.field)->first;
+                    ok = b.object_append(ctx, l.r, name.data(), name.length(), r);
+                }
+            }
+            if (!ok) {
+                b.destroy(ctx, l.r);
+            } else if (l.next < l.v->elements.size() || l.field != l.v->fields.end()) {
+                break;
+            }
+            r = l.r;
+            levels.pop_back();
+        }
+        if (levels.empty())
+            return ok ? r : nullptr;
+
+        // Start on the next element.
+        Level &l = levels.back();
+        if (l.v->kind == JsonnetJsonValue::ARRAY) {
+            v = l.v->elements[l.next++].get();
+        } else {
+            v = (l.field++)->second.get();
+        }
+    }
+}
+
+void *jsonnet_json_extract_value(struct JsonnetVm *vm, const struct JsonnetJsonValue *v,
+                                 const struct JsonnetValueBuilder *builder, void *ctx)
+{
+    (void)vm;
+    return json_extract_value(v, *builder, ctx);
+}
+
 JsonnetJsonValue *jsonnet_json_make_string(JsonnetVm *vm, const char *v)
 {
     (void)vm;
@@ -159,6 +242,7 @@ struct JsonnetVm {
     double gcGrowthTrigger;
     unsigned maxStack;
     unsigned gcMinObjects;
+    unsigned gcNurseryObjects;
     unsigned maxTrace;
     std::map<std::string, VmExt> ext;
     std::map<std::string, VmExt> tla;
@@ -168,6 +252,9 @@ struct JsonnetVm {
     bool stringOutput;
     std::vector<std::string> jpaths;
 
+    /** Parsed imports, reused by every evaluation with this vm. */
+    VmCache cache;
+
     FmtOpts fmtOpts;
     bool fmtDebugDesugaring;
 
@@ -175,6 +262,7 @@ struct JsonnetVm {
         : gcGrowthTrigger(2.0),
           maxStack(500),
           gcMinObjects(1000),
+          gcNurseryObjects(2000),
           maxTrace(20),
           importCallback(default_import_callback),
           importCallbackContext(this),
@@ -186,6 +274,27 @@ struct JsonnetVm {
     }
 };
 
+struct JsonnetProgram {
+    /** Holds the program's ASTs, whose identifiers are interned by the vm's cache. */
+    Allocator alloc;
+    AST *expr;
+
+    JsonnetProgram(JsonnetVm *vm) : alloc(vm->cache.allocator()), expr(nullptr) {}
+};
+
+struct JsonnetIterator {
+    /** Holds the program's ASTs, whose identifiers are interned by the vm's cache. */
+    Allocator alloc;
+    std::unique_ptr<VmIterator> documents;
+    bool multi;
+    bool done;
+
+    JsonnetIterator(JsonnetVm *vm, bool multi)
+        : alloc(vm->cache.allocator()), multi(multi), done(false)
+    {
+    }
+};
+
 enum ImportStatus { IMPORT_STATUS_OK, IMPORT_STATUS_FILE_NOT_FOUND, IMPORT_STATUS_IO_ERROR };
 
 static enum ImportStatus try_path(const std::string &dir, const std::string &rel,
@@ -291,6 +400,11 @@ JsonnetVm *jsonnet_make(void)
     return nullptr;
 }
 
+const JsonnetStats *jsonnet_stats(JsonnetVm *vm)
+{
+    return &vm->cache.stats;
+}
+
 void jsonnet_destroy(JsonnetVm *vm)
 {
     TRY
@@ -313,6 +427,11 @@ void jsonnet_gc_growth_trigger(JsonnetVm *vm, double v)
     vm->gcGrowthTrigger = v;
 }
 
+void jsonnet_gc_nursery_objects(JsonnetVm *vm, unsigned v)
+{
+    vm->gcNurseryObjects = v;
+}
+
 void jsonnet_string_output(struct JsonnetVm *vm, int v)
 {
     vm->stringOutput = bool(v);
@@ -353,6 +472,26 @@ void jsonnet_tla_code(JsonnetVm *vm, const char *key, const char *val)
     vm->tla[key] = VmExt(val, true);
 }
 
+void jsonnet_ext_value(JsonnetVm *vm, const char *key, JsonnetJsonValue *val)
+{
+    vm->ext[key] = VmExt(std::shared_ptr<const JsonnetJsonValue>(val));
+}
+
+void jsonnet_tla_value(JsonnetVm *vm, const char *key, JsonnetJsonValue *val)
+{
+    vm->tla[key] = VmExt(std::shared_ptr<const JsonnetJsonValue>(val));
+}
+
+void jsonnet_ext_clear(JsonnetVm *vm)
+{
+    vm->ext.clear();
+}
+
+void jsonnet_tla_clear(JsonnetVm *vm)
+{
+    vm->tla.clear();
+}
+
 void jsonnet_fmt_debug_desugaring(JsonnetVm *vm, int v)
 {
     vm->fmtDebugDesugaring = v;
@@ -481,140 +620,240 @@ namespace {
 enum EvalKind { REGULAR, MULTI, STREAM };
 }  // namespace
 
-static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, const char *snippet,
-                                          int *error, EvalKind kind)
+/** Lex, parse, desugar and statically analyse the given code, ready for jsonnet_vm_execute. */
+static AST *jsonnet_compile(Allocator &alloc, JsonnetStats &stats, const char *filename,
+                            const char *snippet)
 {
-    try {
-        Allocator alloc;
-        AST *expr;
-        Tokens tokens = jsonnet_lex(filename, snippet);
+    VmTimer lex_timer(stats.lex_seconds);
+    Tokens tokens = jsonnet_lex(filename, snippet);
+    lex_timer.stop();
+
+    VmTimer parse_timer(stats.parse_seconds);
+    AST *expr = jsonnet_parse(&alloc, tokens);
+    parse_timer.stop();
+
+    // Top-level arguments are applied at execution time, so the program can be re-used.
+    VmTimer desugar_timer(stats.desugar_seconds);
+    jsonnet_desugar(&alloc, expr, nullptr);
+    desugar_timer.stop();
+
+    VmTimer static_analysis_timer(stats.static_analysis_seconds);
+    jsonnet_static_analysis(expr, {alloc.makeIdentifier(U"$std")});
+    jsonnet_static_optimize(&alloc, expr);
+    return expr;
+}
 
-        expr = jsonnet_parse(&alloc, tokens);
 
-        jsonnet_desugar(&alloc, expr, &vm->tla);
-
-        unsigned max_stack = vm->maxStack;
-
-        // For the stdlib desugaring.
-        max_stack++;
-
-        // For the TLA desugaring.
-        max_stack++;
-
-        jsonnet_static_analysis(expr);
-        switch (kind) {
-            case REGULAR: {
-                std::string json_str = jsonnet_vm_execute(&alloc,
-                                                          expr,
-                                                          vm->ext,
-                                                          max_stack,
-                                                          vm->gcMinObjects,
-                                                          vm->gcGrowthTrigger,
-                                                          vm->nativeCallbacks,
-                                                          vm->importCallback,
-                                                          vm->importCallbackContext,
-                                                          vm->stringOutput);
-                json_str += "\n";
-                *error = false;
-                return from_string(vm, json_str);
-            } break;
-
-            case MULTI: {
-                std::map<std::string, std::string> files =
-                    jsonnet_vm_execute_multi(&alloc,
-                                             expr,
-                                             vm->ext,
-                                             max_stack,
-                                             vm->gcMinObjects,
-                                             vm->gcGrowthTrigger,
-                                             vm->nativeCallbacks,
-                                             vm->importCallback,
-                                             vm->importCallbackContext,
-                                             vm->stringOutput);
-                size_t sz = 1;  // final sentinel
-                for (const auto &pair : files) {
-                    sz += pair.first.length() + 1;   // include sentinel
-                    sz += pair.second.length() + 2;  // Add a '\n' as well as sentinel
-                }
-                char *buf = (char *)::malloc(sz);
-                if (buf == nullptr)
-                    memory_panic();
-                std::ptrdiff_t i = 0;
-                for (const auto &pair : files) {
-                    memcpy(&buf[i], pair.first.c_str(), pair.first.length() + 1);
-                    i += pair.first.length() + 1;
-                    memcpy(&buf[i], pair.second.c_str(), pair.second.length());
-                    i += pair.second.length();
-                    buf[i] = '\n';
-                    i++;
-                    buf[i] = '\0';
-                    i++;
-                }
-                buf[i] = '\0';  // final sentinel
-                *error = false;
-                return buf;
-            } break;
-
-            case STREAM: {
-                std::vector<std::string> documents =
-                    jsonnet_vm_execute_stream(&alloc,
-                                              expr,
-                                              vm->ext,
-                                              max_stack,
-                                              vm->gcMinObjects,
-                                              vm->gcGrowthTrigger,
-                                              vm->nativeCallbacks,
-                                              vm->importCallback,
-                                              vm->importCallbackContext);
-                size_t sz = 1;  // final sentinel
-                for (const auto &doc : documents) {
-                    sz += doc.length() + 2;  // Add a '\n' as well as sentinel
-                }
-                char *buf = (char *)::malloc(sz);
-                if (buf == nullptr)
-                    memory_panic();
-                std::ptrdiff_t i = 0;
-                for (const auto &doc : documents) {
-                    memcpy(&buf[i], doc.c_str(), doc.length());
-                    i += doc.length();
-                    buf[i] = '\n';
-                    i++;
-                    buf[i] = '\0';
-                    i++;
-                }
-                buf[i] = '\0';  // final sentinel
-                *error = false;
-                return buf;
-            } break;
-
-            default:
-                fputs("INTERNAL ERROR: bad value of 'kind', probably memory corruption.\n", stderr);
-                abort();
+static std::string jsonnet_static_error_string(const StaticError &e)
+{
+    std::stringstream ss;
+    ss << "STATIC ERROR: " << e << std::endl;
+    return ss.str();
+}
+
+/** Format the error with its stack trace, abbreviated to vm->maxTrace lines. */
+static std::string jsonnet_runtime_error_string(JsonnetVm *vm, const RuntimeError &e)
+{
+    std::stringstream ss;
+    ss << "RUNTIME ERROR: " << e.msg << std::endl;
+    const long max_above = vm->maxTrace / 2;
+    const long max_below = vm->maxTrace - max_above;
+    const long sz = e.stackTrace.size();
+    for (long i = 0; i < sz; ++i) {
+        const auto &f = e.stackTrace[i];
+        if (vm->maxTrace > 0 && i >= max_above && i < sz - max_below) {
+            if (i == max_above)
+                ss << "\t..." << std::endl;
+        } else {
+            ss << "\t" << f.location << "\t" << f.name << std::endl;
         }
+    }
+    return ss.str();
+}
 
-    } catch (StaticError &e) {
+/** Read the whole file, or return false with an error message in err. */
+static bool jsonnet_read_file(const char *filename, std::string &input, std::string &err)
+{
+    std::ifstream f;
+    f.open(filename);
+    if (!f.good()) {
         std::stringstream ss;
-        ss << "STATIC ERROR: " << e << std::endl;
+        ss << "Opening input file: " << filename << ": " << strerror(errno);
+        err = ss.str();
+        return false;
+    }
+    input.assign(std::istreambuf_iterator<char>(f), std::istreambuf_iterator<char>());
+    return true;
+}
+
+namespace {
+/** Collects the output of an execution in a string. */
+class StringOutput : public VmOutput {
+   public:
+    std::string str;
+
+    bool write(const char *buf, size_t len) override
+    {
+        str.append(buf, len);
+        return true;
+    }
+};
+
+/** Hands the output of an execution to a JsonnetOutputCallback. */
+class CallbackOutput : public VmOutput {
+    JsonnetOutputCallback *cb;
+    void *ctx;
+
+   public:
+    CallbackOutput(JsonnetOutputCallback *cb, void *ctx) : cb(cb), ctx(ctx) {}
+
+    bool write(const char *buf, size_t len) override
+    {
+        return cb(ctx, buf, len) != 0;
+    }
+};
+}  // namespace
+
+/** Execute a compiled program, writing the JSON to the given output.
+ *
+ * \param alloc Holds any code parsed during execution.
+ * \throws StaticError, RuntimeError
+ */
+static void jsonnet_execute_to_aux(JsonnetVm *vm, Allocator &alloc, const AST *expr,
+                                   VmOutput &output)
+{
+    jsonnet_vm_execute(&alloc,
+                       vm->cache,
+                       expr,
+                       vm->ext,
+                       vm->tla,
+                       vm->maxStack,
+                       vm->gcMinObjects,
+                       vm->gcGrowthTrigger,
+                       vm->gcNurseryObjects,
+                       vm->nativeCallbacks,
+                       vm->importCallback,
+                       vm->importCallbackContext,
+                       vm->stringOutput,
+                       output);
+}
+
+/** Execute a compiled program.
+ *
+ * \param alloc Holds any code parsed during execution.
+ * \throws StaticError, RuntimeError
+ */
+static char *jsonnet_execute_aux(JsonnetVm *vm, Allocator &alloc, const AST *expr, int *error,
+                                 EvalKind kind)
+{
+    switch (kind) {
+        case REGULAR: {
+            StringOutput output;
+            jsonnet_execute_to_aux(vm, alloc, expr, output);
+            *error = false;
+            return from_string(vm, output.str);
+        } break;
+
+        case MULTI: {
+            std::map<std::string, std::string> files =
+                jsonnet_vm_execute_multi(&alloc,
+                                         vm->cache,
+                                         expr,
+                                         vm->ext,
+                                         vm->tla,
+                                         vm->maxStack,
+                                         vm->gcMinObjects,
+                                         vm->gcGrowthTrigger,
+                                         vm->gcNurseryObjects,
+                                         vm->nativeCallbacks,
+                                         vm->importCallback,
+                                         vm->importCallbackContext,
+                                         vm->stringOutput);
+            size_t sz = 1;  // final sentinel
+            for (const auto &pair : files) {
+                sz += pair.first.length() + 1;   // include sentinel
+                sz += pair.second.length() + 2;  // Add a '\n' as well as sentinel
+            }
+            char *buf = (char *)::malloc(sz);
+            if (buf == nullptr)
+                memory_panic();
+            std::ptrdiff_t i = 0;
+            for (const auto &pair : files) {
+                memcpy(&buf[i], pair.first.c_str(), pair.first.length() + 1);
+                i += pair.first.length() + 1;
+                memcpy(&buf[i], pair.second.c_str(), pair.second.length());
+                i += pair.second.length();
+                buf[i] = '\n';
+                i++;
+                buf[i] = '\0';
+                i++;
+            }
+            buf[i] = '\0';  // final sentinel
+            *error = false;
+            return buf;
+        } break;
+
+        case STREAM: {
+            std::vector<std::string> documents =
+                jsonnet_vm_execute_stream(&alloc,
+                                          vm->cache,
+                                          expr,
+                                          vm->ext,
+                                          vm->tla,
+                                          vm->maxStack,
+                                          vm->gcMinObjects,
+                                          vm->gcGrowthTrigger,
+                                          vm->gcNurseryObjects,
+                                          vm->nativeCallbacks,
+                                          vm->importCallback,
+                                          vm->importCallbackContext);
+            size_t sz = 1;  // final sentinel
+            for (const auto &doc : documents) {
+                sz += doc.length() + 2;  // Add a '\n' as well as sentinel
+            }
+            char *buf = (char *)::malloc(sz);
+            if (buf == nullptr)
+                memory_panic();
+            std::ptrdiff_t i = 0;
+            for (const auto &doc : documents) {
+                memcpy(&buf[i], doc.c_str(), doc.length());
+                i += doc.length();
+                buf[i] = '\n';
+                i++;
+                buf[i] = '\0';
+                i++;
+            }
+            buf[i] = '\0';  // final sentinel
+            *error = false;
+            return buf;
+        } break;
+
+        default:
+            fputs("INTERNAL ERROR: bad value of 'kind', probably memory corruption.\n", stderr);
+            abort();
+    }
+
+    return nullptr;  // Quiet, compiler.
+}
+
+static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, const char *snippet,
+                                          int *error, EvalKind kind)
+{
+    try {
+        // The program's ASTs are discarded afterwards, but identifiers must be shared with the
+        // cached ones.
+        vm->cache.stats = JsonnetStats();
+        Allocator alloc(vm->cache.allocator());
+        AST *expr = jsonnet_compile(alloc, vm->cache.stats, filename, snippet);
+        return jsonnet_execute_aux(vm, alloc, expr, error, kind);
+
+    } catch (StaticError &e) {
         *error = true;
-        return from_string(vm, ss.str());
+        return from_string(vm, jsonnet_static_error_string(e));
 
     } catch (RuntimeError &e) {
-        std::stringstream ss;
-        ss << "RUNTIME ERROR: " << e.msg << std::endl;
-        const long max_above = vm->maxTrace / 2;
-        const long max_below = vm->maxTrace - max_above;
-        const long sz = e.stackTrace.size();
-        for (long i = 0; i < sz; ++i) {
-            const auto &f = e.stackTrace[i];
-            if (vm->maxTrace > 0 && i >= max_above && i < sz - max_below) {
-                if (i == max_above)
-                    ss << "\t..." << std::endl;
-            } else {
-                ss << "\t" << f.location << "\t" << f.name << std::endl;
-            }
-        }
         *error = true;
-        return from_string(vm, ss.str());
+        return from_string(vm, jsonnet_runtime_error_string(vm, e));
     }
 
     return nullptr;  // Quiet, compiler.
@@ -623,20 +862,59 @@ static char *jsonnet_evaluate_snippet_aux(JsonnetVm *vm, const char *filename, c
 static char *jsonnet_evaluate_file_aux(JsonnetVm *vm, const char *filename, int *error,
                                        EvalKind kind)
 {
-    std::ifstream f;
-    f.open(filename);
-    if (!f.good()) {
-        std::stringstream ss;
-        ss << "Opening input file: " << filename << ": " << strerror(errno);
+    std::string input, err;
+    if (!jsonnet_read_file(filename, input, err)) {
         *error = true;
-        return from_string(vm, ss.str());
+        return from_string(vm, err);
     }
-    std::string input;
-    input.assign(std::istreambuf_iterator<char>(f), std::istreambuf_iterator<char>());
-
     return jsonnet_evaluate_snippet_aux(vm, filename, input.c_str(), error, kind);
 }
 
+/** Execute a compiled program, building the result with the given builder.
+ *
+ * \throws StaticError, RuntimeError
+ */
+static void *jsonnet_execute_value_aux(JsonnetVm *vm, Allocator &alloc, const AST *expr,
+                                       const JsonnetValueBuilder *builder, void *ctx)
+{
+    return jsonnet_vm_execute_value(&alloc,
+                                    vm->cache,
+                                    expr,
+                                    vm->ext,
+                                    vm->tla,
+                                    vm->maxStack,
+                                    vm->gcMinObjects,
+                                    vm->gcGrowthTrigger,
+                                    vm->gcNurseryObjects,
+                                    vm->nativeCallbacks,
+                                    vm->importCallback,
+                                    vm->importCallbackContext,
+                                    *builder,
+                                    ctx);
+}
+
+static void *jsonnet_evaluate_snippet_value_aux(JsonnetVm *vm, const char *filename,
+                                                const char *snippet,
+                                                const JsonnetValueBuilder *builder, void *ctx,
+                                                char **error)
+{
+    try {
+        vm->cache.stats = JsonnetStats();
+        Allocator alloc(vm->cache.allocator());
+        AST *expr = jsonnet_compile(alloc, vm->cache.stats, filename, snippet);
+        void *r = jsonnet_execute_value_aux(vm, alloc, expr, builder, ctx);
+        *error = nullptr;
+        return r;
+
+    } catch (StaticError &e) {
+        *error = from_string(vm, jsonnet_static_error_string(e));
+
+    } catch (RuntimeError &e) {
+        *error = from_string(vm, jsonnet_runtime_error_string(vm, e));
+    }
+    return nullptr;
+}
+
 char *jsonnet_evaluate_file(JsonnetVm *vm, const char *filename, int *error)
 {
     TRY
@@ -687,6 +965,289 @@ char *jsonnet_evaluate_snippet_stream(JsonnetVm *vm, const char *filename, const
     return nullptr;  // Never happens.
 }
 
+void *jsonnet_evaluate_file_value(JsonnetVm *vm, const char *filename,
+                                  const JsonnetValueBuilder *builder, void *ctx, char **error)
+{
+    TRY
+        std::string input, err;
+        if (!jsonnet_read_file(filename, input, err)) {
+            *error = from_string(vm, err);
+            return nullptr;
+        }
+        return jsonnet_evaluate_snippet_value_aux(vm, filename, input.c_str(), builder, ctx,
+                                                  error);
+    CATCH("jsonnet_evaluate_file_value")
+    return nullptr;  // Never happens.
+}
+
+void *jsonnet_evaluate_snippet_value(JsonnetVm *vm, const char *filename, const char *snippet,
+                                     const JsonnetValueBuilder *builder, void *ctx, char **error)
+{
+    TRY
+        return jsonnet_evaluate_snippet_value_aux(vm, filename, snippet, builder, ctx, error);
+    CATCH("jsonnet_evaluate_snippet_value")
+    return nullptr;  // Never happens.
+}
+
+static void jsonnet_evaluate_snippet_to_aux(JsonnetVm *vm, const char *filename,
+                                            const char *snippet, JsonnetOutputCallback *cb,
+                                            void *ctx, char **error)
+{
+    try {
+        vm->cache.stats = JsonnetStats();
+        Allocator alloc(vm->cache.allocator());
+        AST *expr = jsonnet_compile(alloc, vm->cache.stats, filename, snippet);
+        CallbackOutput output(cb, ctx);
+        jsonnet_execute_to_aux(vm, alloc, expr, output);
+        *error = nullptr;
+
+    } catch (StaticError &e) {
+        *error = from_string(vm, jsonnet_static_error_string(e));
+
+    } catch (RuntimeError &e) {
+        *error = from_string(vm, jsonnet_runtime_error_string(vm, e));
+    }
+}
+
+void jsonnet_evaluate_file_to(JsonnetVm *vm, const char *filename, JsonnetOutputCallback *cb,
+                              void *ctx, char **error)
+{
+    TRY
+        std::string input, err;
+        if (!jsonnet_read_file(filename, input, err)) {
+            *error = from_string(vm, err);
+            return;
+        }
+        jsonnet_evaluate_snippet_to_aux(vm, filename, input.c_str(), cb, ctx, error);
+    CATCH("jsonnet_evaluate_file_to")
+}
+
+void jsonnet_evaluate_snippet_to(JsonnetVm *vm, const char *filename, const char *snippet,
+                                 JsonnetOutputCallback *cb, void *ctx, char **error)
+{
+    TRY
+        jsonnet_evaluate_snippet_to_aux(vm, filename, snippet, cb, ctx, error);
+    CATCH("jsonnet_evaluate_snippet_to")
+}
+
+static JsonnetProgram *jsonnet_compile_aux(JsonnetVm *vm, const char *filename,
+                                           const char *snippet, char **error)
+{
+    vm->cache.stats = JsonnetStats();
+    auto *program = new JsonnetProgram(vm);
+    try {
+        program->expr = jsonnet_compile(program->alloc, vm->cache.stats, filename, snippet);
+        *error = nullptr;
+        return program;
+    } catch (StaticError &e) {
+        delete program;
+        *error = from_string(vm, jsonnet_static_error_string(e));
+        return nullptr;
+    }
+}
+
+JsonnetProgram *jsonnet_compile_file(JsonnetVm *vm, const char *filename, char **error)
+{
+    TRY
+        std::string input, err;
+        if (!jsonnet_read_file(filename, input, err)) {
+            *error = from_string(vm, err);
+            return nullptr;
+        }
+        return jsonnet_compile_aux(vm, filename, input.c_str(), error);
+    CATCH("jsonnet_compile_file")
+    return nullptr;  // Never happens.
+}
+
+JsonnetProgram *jsonnet_compile_snippet(JsonnetVm *vm, const char *filename, const char *snippet,
+                                        char **error)
+{
+    TRY
+        return jsonnet_compile_aux(vm, filename, snippet, error);
+    CATCH("jsonnet_compile_snippet")
+    return nullptr;  // Never happens.
+}
+
+char *jsonnet_program_evaluate(JsonnetVm *vm, JsonnetProgram *program, int *error)
+{
+    TRY
+        try {
+            vm->cache.stats = JsonnetStats();
+            Allocator alloc(vm->cache.allocator());
+            return jsonnet_execute_aux(vm, alloc, program->expr, error, REGULAR);
+        } catch (StaticError &e) {
+            *error = true;
+            return from_string(vm, jsonnet_static_error_string(e));
+        } catch (RuntimeError &e) {
+            *error = true;
+            return from_string(vm, jsonnet_runtime_error_string(vm, e));
+        }
+    CATCH("jsonnet_program_evaluate")
+    return nullptr;  // Never happens.
+}
+
+void *jsonnet_program_evaluate_value(JsonnetVm *vm, JsonnetProgram *program,
+                                     const JsonnetValueBuilder *builder, void *ctx, char **error)
+{
+    TRY
+        try {
+            vm->cache.stats = JsonnetStats();
+            Allocator alloc(vm->cache.allocator());
+            void *r = jsonnet_execute_value_aux(vm, alloc, program->expr, builder, ctx);
+            *error = nullptr;
+            return r;
+        } catch (StaticError &e) {
+            *error = from_string(vm, jsonnet_static_error_string(e));
+        } catch (RuntimeError &e) {
+            *error = from_string(vm, jsonnet_runtime_error_string(vm, e));
+        }
+        return nullptr;
+    CATCH("jsonnet_program_evaluate_value")
+    return nullptr;  // Never happens.
+}
+
+void jsonnet_program_evaluate_to(JsonnetVm *vm, JsonnetProgram *program,
+                                 JsonnetOutputCallback *cb, void *ctx, char **error)
+{
+    TRY
+        try {
+            vm->cache.stats = JsonnetStats();
+            Allocator alloc(vm->cache.allocator());
+            CallbackOutput output(cb, ctx);
+            jsonnet_execute_to_aux(vm, alloc, program->expr, output);
+            *error = nullptr;
+        } catch (StaticError &e) {
+            *error = from_string(vm, jsonnet_static_error_string(e));
+        } catch (RuntimeError &e) {
+            *error = from_string(vm, jsonnet_runtime_error_string(vm, e));
+        }
+    CATCH("jsonnet_program_evaluate_to")
+}
+
+void jsonnet_program_destroy(JsonnetVm *vm, JsonnetProgram *program)
+{
+    TRY
+        (void)vm;
+        delete program;
+    CATCH("jsonnet_program_destroy")
+}
+
+static JsonnetIterator *jsonnet_evaluate_snippet_iter_aux(JsonnetVm *vm, const char *filename,
+                                                         const char *snippet, char **error,
+                                                         EvalKind kind)
+{
+    vm->cache.stats = JsonnetStats();
+    auto *it = new JsonnetIterator(vm, kind == MULTI);
+    try {
+        AST *expr = jsonnet_compile(it->alloc, vm->cache.stats, filename, snippet);
+        it->documents = jsonnet_vm_execute_iter(&it->alloc,
+                                                vm->cache,
+                                                expr,
+                                                vm->ext,
+                                                vm->tla,
+                                                vm->maxStack,
+                                                vm->gcMinObjects,
+                                                vm->gcGrowthTrigger,
+                                                vm->gcNurseryObjects,
+                                                vm->nativeCallbacks,
+                                                vm->importCallback,
+                                                vm->importCallbackContext,
+                                                kind == MULTI,
+                                                vm->stringOutput);
+        *error = nullptr;
+        return it;
+
+    } catch (StaticError &e) {
+        *error = from_string(vm, jsonnet_static_error_string(e));
+
+    } catch (RuntimeError &e) {
+        *error = from_string(vm, jsonnet_runtime_error_string(vm, e));
+    }
+    delete it;
+    return nullptr;
+}
+
+static JsonnetIterator *jsonnet_evaluate_file_iter_aux(JsonnetVm *vm, const char *filename,
+                                                      char **error, EvalKind kind)
+{
+    std::string input, err;
+    if (!jsonnet_read_file(filename, input, err)) {
+        *error = from_string(vm, err);
+        return nullptr;
+    }
+    return jsonnet_evaluate_snippet_iter_aux(vm, filename, input.c_str(), error, kind);
+}
+
+JsonnetIterator *jsonnet_evaluate_file_multi_iter(JsonnetVm *vm, const char *filename,
+                                                  char **error)
+{
+    TRY
+        return jsonnet_evaluate_file_iter_aux(vm, filename, error, MULTI);
+    CATCH("jsonnet_evaluate_file_multi_iter")
+    return nullptr;  // Never happens.
+}
+
+JsonnetIterator *jsonnet_evaluate_file_stream_iter(JsonnetVm *vm, const char *filename,
+                                                   char **error)
+{
+    TRY
+        return jsonnet_evaluate_file_iter_aux(vm, filename, error, STREAM);
+    CATCH("jsonnet_evaluate_file_stream_iter")
+    return nullptr;  // Never happens.
+}
+
+JsonnetIterator *jsonnet_evaluate_snippet_multi_iter(JsonnetVm *vm, const char *filename,
+                                                     const char *snippet, char **error)
+{
+    TRY
+        return jsonnet_evaluate_snippet_iter_aux(vm, filename, snippet, error, MULTI);
+    CATCH("jsonnet_evaluate_snippet_multi_iter")
+    return nullptr;  // Never happens.
+}
+
+JsonnetIterator *jsonnet_evaluate_snippet_stream_iter(JsonnetVm *vm, const char *filename,
+                                                      const char *snippet, char **error)
+{
+    TRY
+        return jsonnet_evaluate_snippet_iter_aux(vm, filename, snippet, error, STREAM);
+    CATCH("jsonnet_evaluate_snippet_stream_iter")
+    return nullptr;  // Never happens.
+}
+
+char *jsonnet_iterator_next(JsonnetVm *vm, JsonnetIterator *it, char **name, int *error)
+{
+    TRY
+        *name = nullptr;
+        *error = false;
+        if (it->done)
+            return nullptr;
+        try {
+            std::string name_str, document;
+            if (!it->documents->next(name_str, document)) {
+                it->done = true;
+                return nullptr;
+            }
+            if (it->multi)
+                *name = from_string(vm, name_str);
+            document += "\n";
+            return from_string(vm, document);
+        } catch (RuntimeError &e) {
+            it->done = true;
+            *error = true;
+            return from_string(vm, jsonnet_runtime_error_string(vm, e));
+        }
+    CATCH("jsonnet_iterator_next")
+    return nullptr;  // Never happens.
+}
+
+void jsonnet_iterator_destroy(JsonnetVm *vm, JsonnetIterator *it)
+{
+    TRY
+        (void)vm;
+        delete it;
+    CATCH("jsonnet_iterator_destroy")
+}
+
 char *jsonnet_realloc(JsonnetVm *vm, char *str, size_t sz)
 {
     (void)vm;
@@ -37,7 +37,11 @@ struct HeapEntity {
     };
     GarbageCollectionMark mark;
     Type type;
-    HeapEntity(Type type_) : type(type_) {}
+    /** Whether the entity has survived a garbage collection cycle.  \see Heap */
+    bool old;
+    /** Whether the entity is in the heap's remembered set.  \see Heap::remember */
+    bool remembered;
+    HeapEntity(Type type_) : type(type_), old(false), remembered(false) {}
     virtual ~HeapEntity() {}
 };
 
@@ -98,11 +102,109 @@ struct HeapThunk;
  *
  * Each nested local statement, function call, and field access has its own binding frame to
  * give the values for the local variable, function parameters, or upValues.
+ *
+ * The bindings are kept in a single array sorted by identifier, rather than a tree, because
+ * frames are small and are copied into every closure, thunk and object that captures them.  An
+ * environment thus costs one allocation, and looking up a variable touches one cache line or two.
+ * The interface is the subset of std::map that the interpreter uses.
  */
-typedef std::map<const Identifier *, HeapThunk *> BindingFrame;
+class BindingFrame {
+   public:
+    typedef std::pair<const Identifier *, HeapThunk *> value_type;
+    typedef std::vector<value_type>::iterator iterator;
+    typedef std::vector<value_type>::const_iterator const_iterator;
+
+   private:
+    std::vector<value_type> bindings;
+
+    static bool before(const value_type &binding, const Identifier *id)
+    {
+        return binding.first < id;
+    }
+
+   public:
+    iterator begin(void)
+    {
+        return bindings.begin();
+    }
+    iterator end(void)
+    {
+        return bindings.end();
+    }
+    const_iterator begin(void) const
+    {
+        return bindings.begin();
+    }
+    const_iterator end(void) const
+    {
+        return bindings.end();
+    }
+    size_t size(void) const
+    {
+        return bindings.size();
+    }
+    void clear(void)
+    {
+        bindings.clear();
+    }
+    void reserve(size_t n)
+    {
+        bindings.reserve(n);
+    }
+
+    iterator find(const Identifier *id)
+    {
+        auto it = std::lower_bound(bindings.begin(), bindings.end(), id, before);
+        return it != bindings.end() && it->first == id ? it : bindings.end();
+    }
+    const_iterator find(const Identifier *id) const
+    {
+        auto it = std::lower_bound(bindings.begin(), bindings.end(), id, before);
+        return it != bindings.end() && it->first == id ? it : bindings.end();
+    }
+
+    HeapThunk *&operator[](const Identifier *id)
+    {
+        auto it = std::lower_bound(bindings.begin(), bindings.end(), id, before);
+        if (it == bindings.end() || it->first != id)
+            it = bindings.emplace(it, id, nullptr);
+        return it->second;
+    }
+
+    /** Add a binding for an identifier that comes after every one bound so far. */
+    void append(const Identifier *id, HeapThunk *thunk)
+    {
+        assert(bindings.empty() || bindings.back().first < id);
+        bindings.emplace_back(id, thunk);
+    }
+
+    /** Add the bindings of other, except those of identifiers that are already bound. */
+    void insert(const_iterator first, const_iterator last)
+    {
+        std::vector<value_type> merged;
+        merged.reserve(bindings.size() + (last - first));
+        auto it = bindings.begin();
+        for (; first != last; ++first) {
+            while (it != bindings.end() && it->first < first->first)
+                merged.push_back(*it++);
+            if (it == bindings.end() || it->first != first->first)
+                merged.push_back(*first);
+        }
+        merged.insert(merged.end(), it, bindings.end());
+        bindings.swap(merged);
+    }
+};
 
 /** Supertype of all objects.  Types of Value::OBJECT will point at these.  */
 struct HeapObject : public HeapEntity {
+    /** The fields evaluated so far with this object as self.
+     *
+     * Keyed by the field and the "super" level of the leaf it was found in (\see Frame::offset),
+     * which together determine the body and environment.  Since evaluation has no side effects,
+     * a field only has to be evaluated once per object.
+     */
+    std::map<std::pair<const Identifier *, unsigned>, Value> fieldValues;
+
     HeapObject(Type type) : HeapEntity(type) {}
 };
 
@@ -147,14 +249,76 @@ struct HeapThunk : public HeapEntity {
     }
 };
 
+/** Stores an array on the heap.
+ *
+ * Like a string, an array can also be the concatenation of two other arrays.  Its elements are
+ * only copied out of the halves the first time they are needed, after which the halves are
+ * dropped.  This keeps loops that build an array element by element from copying everything
+ * built so far at each step.
+ */
 struct HeapArray : public HeapEntity {
-    // It is convenient for this to not be const, so that we can add elements to it one at a
-    // time after creation.  Thus, elements are not GCed as the array is being
-    // created.
-    std::vector<HeapThunk *> elements;
+    /** The halves of a concatenation node, or nullptr if the elements are in flat. */
+    mutable HeapArray *left, *right;
+
     HeapArray(const std::vector<HeapThunk *> &elements)
-        : HeapEntity(ARRAY), elements(elements)
+        : HeapEntity(ARRAY), left(nullptr), right(nullptr), length(0), flat(elements)
+    {
+    }
+
+    HeapArray(HeapArray *left, HeapArray *right)
+        : HeapEntity(ARRAY), left(left), right(right), length(left->size() + right->size())
+    {
+    }
+
+    /** The number of elements. */
+    size_t size(void) const
     {
+        return left == nullptr ? flat.size() : length;
+    }
+
+    /** The elements of the array.
+     *
+     * It is convenient for this to not be const, so that we can add elements to it one at a
+     * time after creation.  Thus, elements are not GCed as the array is being created.
+     */
+    std::vector<HeapThunk *> &elements(void)
+    {
+        if (left != nullptr)
+            flatten();
+        return flat;
+    }
+
+    const std::vector<HeapThunk *> &elements(void) const
+    {
+        if (left != nullptr)
+            flatten();
+        return flat;
+    }
+
+   private:
+    /** The number of elements of a concatenation node. */
+    size_t length;
+
+    mutable std::vector<HeapThunk *> flat;
+
+    void flatten(void) const
+    {
+        std::vector<HeapThunk *> r;
+        r.reserve(length);
+        // Concatenations can be very deep, so walk them without recursing.
+        std::vector<const HeapArray *> todo = {this};
+        while (!todo.empty()) {
+            const HeapArray *a = todo.back();
+            todo.pop_back();
+            if (a->left == nullptr) {
+                r.insert(r.end(), a->flat.begin(), a->flat.end());
+            } else {
+                todo.push_back(a->right);
+                todo.push_back(a->left);
+            }
+        }
+        flat = std::move(r);
+        left = right = nullptr;
     }
 };
 
@@ -261,26 +425,181 @@ struct HeapClosure : public HeapEntity {
     const Params params;
     const AST *body;
     std::string builtinName;
+    /** The builtin's number, as given to jsonnet_builtin_decl, for calling it without a lookup.
+     *
+     * It is NO_BUILTIN for user functions, and for native callbacks, which are looked up by name.
+     */
+    unsigned long builtin;
+    static const unsigned long NO_BUILTIN = ~0ul;
     HeapClosure(const BindingFrame &up_values, HeapObject *self, unsigned offset,
-                const Params &params, const AST *body, const std::string &builtin_name)
+                const Params &params, const AST *body, const std::string &builtin_name,
+                unsigned long builtin = NO_BUILTIN)
         : HeapEntity(CLOSURE),
           upValues(up_values),
           self(self),
           offset(offset),
           params(params),
           body(body),
-          builtinName(builtin_name)
+          builtinName(builtin_name),
+          builtin(builtin)
     {
     }
 };
 
-/** Stores a simple string on the heap. */
+/** Stores a simple string on the heap.
+ *
+ * A string can also be a rope node, the concatenation of two other strings.  Its characters are
+ * only copied out of the halves the first time they are needed, after which the halves are
+ * dropped.  This keeps loops that build a string piece by piece from copying everything built so
+ * far at each step.
+ */
 struct HeapString : public HeapEntity {
-    const UString value;
-    HeapString(const UString &value) : HeapEntity(STRING), value(value) {}
+    /** The halves of a rope node, or nullptr if the characters are in flat. */
+    mutable const HeapString *left, *right;
+
+    /** The number of characters. */
+    const size_t length;
+
+    HeapString(const UString &value)
+        : HeapEntity(STRING), left(nullptr), right(nullptr), length(value.length()), flat(value)
+    {
+    }
+
+    HeapString(const HeapString *left, const HeapString *right)
+        : HeapEntity(STRING), left(left), right(right), length(left->length + right->length)
+    {
+    }
+
+    /** The characters of the string. */
+    const UString &value(void) const
+    {
+        if (left != nullptr)
+            flatten();
+        return flat;
+    }
+
+   private:
+    mutable UString flat;
+
+    void flatten(void) const
+    {
+        UString r;
+        r.reserve(length);
+        // Ropes can be very deep, so walk them without recursing.
+        std::vector<const HeapString *> todo = {this};
+        while (!todo.empty()) {
+            const HeapString *s = todo.back();
+            todo.pop_back();
+            if (s->left == nullptr) {
+                r += s->flat;
+            } else {
+                todo.push_back(s->right);
+                todo.push_back(s->left);
+            }
+        }
+        flat = std::move(r);
+        left = right = nullptr;
+    }
 };
 
-/** The heap does memory management, i.e. garbage collection. */
+/** Memory for heap entities, carved out of large blocks.
+ *
+ * Entities are grouped in size classes, each with a free list of the slots of deleted entities.
+ * Allocating an entity takes a slot from the free list, or the next one of the current block,
+ * and deleting it puts the slot back.  This avoids going through the general purpose allocator
+ * for each of the millions of small entities a program makes.  Blocks are only returned to the
+ * system when the arena is destroyed.
+ */
+class HeapArena {
+    /** How many entities fit in each block. */
+    static const size_t BLOCK_ENTITIES = 1024;
+
+    /** Sizes are rounded up to a multiple of this, which is also the alignment of slots. */
+    static const size_t GRANULE = alignof(std::max_align_t);
+
+    struct FreeSlot {
+        FreeSlot *next;
+    };
+
+    struct SizeClass {
+        /** Slots of deleted entities. */
+        FreeSlot *free;
+        /** The unused part of the latest block. */
+        char *next;
+        char *end;
+        SizeClass(void) : free(nullptr), next(nullptr), end(nullptr) {}
+    };
+
+    /** Indexed by size in granules. */
+    std::vector<SizeClass> classes;
+
+    std::vector<char *> blocks;
+
+    static size_t granules(size_t size)
+    {
+        return (size + GRANULE - 1) / GRANULE;
+    }
+
+   public:
+    HeapArena(void) {}
+
+    HeapArena(const HeapArena &) = delete;
+    HeapArena &operator=(const HeapArena &) = delete;
+
+    ~HeapArena(void)
+    {
+        for (char *block : blocks)
+            ::operator delete(block);
+    }
+
+    /** Memory for an entity of the given size. */
+    void *allocate(size_t size)
+    {
+        size_t n = granules(size);
+        if (n >= classes.size())
+            classes.resize(n + 1);
+        SizeClass &c = classes[n];
+        if (c.free != nullptr) {
+            FreeSlot *slot = c.free;
+            c.free = slot->next;
+            return slot;
+        }
+        if (c.next == c.end) {
+            size_t block_size = n * GRANULE * BLOCK_ENTITIES;
+            char *block = static_cast<char *>(::operator new(block_size));
+            blocks.push_back(block);
+            c.next = block;
+            c.end = block + block_size;
+        }
+        void *r = c.next;
+        c.next += n * GRANULE;
+        return r;
+    }
+
+    /** Return the memory of an entity of the given size, which must already be destroyed. */
+    void release(void *mem, size_t size)
+    {
+        SizeClass &c = classes[granules(size)];
+        auto *slot = static_cast<FreeSlot *>(mem);
+        slot->next = c.free;
+        c.free = slot;
+    }
+};
+
+/** The heap does memory management, i.e. garbage collection.
+ *
+ * The collector is generational.  Entities allocated since the last cycle are young, those that
+ * survived one are old.  Most entities (e.g. thunks for arguments and temporaries) die young, so
+ * most cycles are minor: they only mark the young entities reachable from the roots and sweep the
+ * young entities, so their cost does not depend on the size of the old heap.  Every survivor of a
+ * cycle becomes old.  A full cycle, which marks and sweeps everything, runs when the heap has
+ * grown enough since the last full cycle (\see gcTuneMinObjects, gcTuneGrowthTrigger).
+ *
+ * A minor cycle does not look inside old entities, so those that may refer to young ones must be
+ * in the remembered set, whose entities are treated as roots.  Whenever a reference to an entity
+ * is stored in an entity that already existed (filling a thunk, appending to an array, etc),
+ * remember() must be called on the latter.
+ */
 class Heap {
     /** How many objects must exist in the heap before we bother doing garbage collection?
      */
@@ -290,23 +609,47 @@ class Heap {
      */
     double gcTuneGrowthTrigger;
 
-    /** Value used to mark entities at the last garbage collection cycle. */
+    /** How many young entities trigger a minor collection, or 0 for only full collections.
+     */
+    unsigned gcTuneNurseryObjects;
+
+    /** Value used to mark entities at the last garbage collection cycle.
+     *
+     * Between cycles, every entity has o->mark == this->lastMark.
+     */
     GarbageCollectionMark lastMark;
 
-    /** The heap entities (strings, arrays, objects, functions, etc).
+    /** Whether the current cycle is a minor one. */
+    bool minor;
+
+    /** The entities that survived a garbage collection cycle.
      *
-     * Not all may be reachable, all should have o->mark == this->lastMark.  Entities are
-     * removed from the heap via O(1) swap with last element, so the ordering of entities is
-     * arbitrary and changes every garbage collection cycle.
+     * Entities are removed from the heap via O(1) swap with last element, so the ordering of
+     * entities is arbitrary and changes every full garbage collection cycle.
      */
-    std::vector<HeapEntity *> entities;
+    std::vector<HeapEntity *> oldEntities;
+
+    /** The entities allocated since the last garbage collection cycle. */
+    std::vector<HeapEntity *> youngEntities;
+
+    /** Old entities that may refer to young ones. */
+    std::vector<HeapEntity *> rememberedSet;
 
-    /** The number of heap entities at the last garbage collection cycle. */
+    /** The number of heap entities at the last full garbage collection cycle. */
     unsigned long lastNumEntities;
 
     /** The number of heap entities now. */
     unsigned long numEntities;
 
+    /** The number of markFrom() calls, i.e. of roots, in the current cycle. */
+    unsigned long markedRoots;
+
+    /** The number of roots marked by the last cycle, \see checkHeap. */
+    unsigned long lastMarkedRoots;
+
+    /** Where the entities live. */
+    HeapArena arena;
+
     /** Add the HeapEntity inside v to vec, if the value exists on the heap.
      */
     void addIfHeapEntity(Value v, std::vector<HeapEntity *> &vec)
@@ -322,20 +665,191 @@ class Heap {
         vec.push_back(v);
     }
 
+    /** Add the entities that curr refers to. */
+    void addChildren(HeapEntity *curr, std::vector<HeapEntity *> &children)
+    {
+        switch(curr->type) {
+            case HeapEntity::SIMPLE_OBJECT: {
+                assert(dynamic_cast<HeapSimpleObject *>(curr));
+                auto *obj = static_cast<HeapSimpleObject *>(curr);
+                for (auto upv : obj->upValues)
+                    addIfHeapEntity(upv.second, children);
+                for (const auto &field : obj->fieldValues)
+                    addIfHeapEntity(field.second, children);
+                break;
+            }
+            case HeapEntity::EXTENDED_OBJECT: {
+                assert(dynamic_cast<HeapExtendedObject *>(curr));
+                auto *obj = static_cast<HeapExtendedObject *>(curr);
+                addIfHeapEntity(obj->left, children);
+                addIfHeapEntity(obj->right, children);
+                for (const auto &field : obj->fieldValues)
+                    addIfHeapEntity(field.second, children);
+                break;
+            }
+            case HeapEntity::COMPREHENSION_OBJECT: {
+                assert(dynamic_cast<HeapComprehensionObject *>(curr));
+                auto *obj = static_cast<HeapComprehensionObject *>(curr);
+                for (auto upv : obj->upValues)
+                    addIfHeapEntity(upv.second, children);
+                for (auto upv : obj->compValues)
+                    addIfHeapEntity(upv.second, children);
+                for (const auto &field : obj->fieldValues)
+                    addIfHeapEntity(field.second, children);
+                break;
+            }
+            case HeapEntity::ARRAY: {
+                assert(dynamic_cast<HeapArray *>(curr));
+                auto *arr = static_cast<HeapArray *>(curr);
+                if (arr->left != nullptr) {
+                    addIfHeapEntity(arr->left, children);
+                    addIfHeapEntity(arr->right, children);
+                } else {
+                    for (auto el : arr->elements())
+                        addIfHeapEntity(el, children);
+                }
+                break;
+            }
+            case HeapEntity::CLOSURE: {
+                assert(dynamic_cast<HeapClosure *>(curr));
+                auto *func = static_cast<HeapClosure *>(curr);
+                for (auto upv : func->upValues)
+                    addIfHeapEntity(upv.second, children);
+                if (func->self)
+                    addIfHeapEntity(func->self, children);
+                break;
+            }
+            case HeapEntity::THUNK: {
+                assert(dynamic_cast<HeapThunk *>(curr));
+                auto *thunk = static_cast<HeapThunk *>(curr);
+                if (thunk->filled) {
+                    if (thunk->content.isHeap())
+                        addIfHeapEntity(thunk->content.v.h, children);
+                } else {
+                    for (auto upv : thunk->upValues)
+                        addIfHeapEntity(upv.second, children);
+                    if (thunk->self)
+                        addIfHeapEntity(thunk->self, children);
+                }
+                break;
+            }
+            case HeapEntity::STRING: {
+                assert(dynamic_cast<HeapString *>(curr));
+                auto *str = static_cast<HeapString *>(curr);
+                if (str->left != nullptr) {
+                    addIfHeapEntity(const_cast<HeapString *>(str->left), children);
+                    addIfHeapEntity(const_cast<HeapString *>(str->right), children);
+                }
+                break;
+            }
+            default:
+                assert(false);
+                break;
+        }
+    }
+
+    /** The size of the entity, for returning its memory to the arena. */
+    static size_t entitySize(const HeapEntity *x)
+    {
+        switch (x->type) {
+            case HeapEntity::THUNK: return sizeof(HeapThunk);
+            case HeapEntity::ARRAY: return sizeof(HeapArray);
+            case HeapEntity::CLOSURE: return sizeof(HeapClosure);
+            case HeapEntity::STRING: return sizeof(HeapString);
+            case HeapEntity::SIMPLE_OBJECT: return sizeof(HeapSimpleObject);
+            case HeapEntity::COMPREHENSION_OBJECT: return sizeof(HeapComprehensionObject);
+            case HeapEntity::EXTENDED_OBJECT: return sizeof(HeapExtendedObject);
+        }
+        assert(false);
+        return 0;
+    }
+
+    void destroy(HeapEntity *x)
+    {
+        size_t size = entitySize(x);
+        x->~HeapEntity();
+        arena.release(x, size);
+    }
+
+    /** Delete the entities of vec whose mark is not mark, and make the others old. */
+    void sweepEntities(std::vector<HeapEntity *> &vec, GarbageCollectionMark mark)
+    {
+        // Vec shrinks during this loop.  Do not cache vec.size().
+        for (unsigned long i = 0; i < vec.size(); ++i) {
+            HeapEntity *x = vec[i];
+            if (x->mark != mark) {
+                destroy(x);
+                if (i != vec.size() - 1) {
+                    // Swap it with the back.
+                    vec[i] = vec[vec.size() - 1];
+                }
+                vec.pop_back();
+                --i;
+            } else {
+                x->old = true;
+            }
+        }
+    }
+
+    bool fullCollectionDue(void) const
+    {
+        return numEntities > gcTuneMinObjects &&
+               numEntities > gcTuneGrowthTrigger * lastNumEntities;
+    }
+
    public:
-    Heap(unsigned gc_tune_min_objects, double gc_tune_growth_trigger)
+    Heap(unsigned gc_tune_min_objects, double gc_tune_growth_trigger,
+         unsigned gc_tune_nursery_objects)
         : gcTuneMinObjects(gc_tune_min_objects),
           gcTuneGrowthTrigger(gc_tune_growth_trigger),
+          gcTuneNurseryObjects(gc_tune_nursery_objects),
           lastMark(0),
+          minor(false),
           lastNumEntities(0),
-          numEntities(0)
+          numEntities(0),
+          markedRoots(0),
+          lastMarkedRoots(0)
     {
     }
 
     ~Heap(void)
     {
-        // Nothing is marked, everything will be collected.
-        sweep();
+        for (HeapEntity *x : oldEntities)
+            destroy(x);
+        for (HeapEntity *x : youngEntities)
+            destroy(x);
+    }
+
+    /** Write barrier: record that a reference was stored in the given entity.
+     *
+     * This is cheap, and only does anything if the entity is old.
+     */
+    void remember(HeapEntity *e)
+    {
+        if (e->old && !e->remembered) {
+            e->remembered = true;
+            rememberedSet.push_back(e);
+        }
+    }
+
+    /** Begin a garbage collection cycle, to be followed by markFrom() of every root, then
+     * sweep().
+     *
+     * \returns Whether the cycle is a minor one.
+     */
+    bool startCollection(void)
+    {
+        markedRoots = 0;
+        minor = !fullCollectionDue();
+        if (minor) {
+            // The remembered entities are roots, but need not be marked themselves.
+            std::vector<HeapEntity *> children;
+            for (HeapEntity *e : rememberedSet)
+                addChildren(e, children);
+            for (HeapEntity *child : children)
+                markFrom(child);
+        }
+        return minor;
     }
 
     /** Garbage collection: Mark v, and entities reachable from v. */
@@ -345,10 +859,14 @@ class Heap {
             markFrom(v.v.h);
     }
 
-    /** Garbage collection: Mark heap entities reachable from the given heap entity. */
+    /** Garbage collection: Mark heap entities reachable from the given heap entity.
+     *
+     * In a minor cycle, old entities are neither marked nor looked into.
+     */
     void markFrom(HeapEntity *from)
     {
         assert(from != nullptr);
+        markedRoots++;
         const GarbageCollectionMark thisMark = lastMark + 1;
         struct State {
             HeapEntity *ent;
@@ -363,70 +881,9 @@ class Heap {
             size_t curr_index = stack.size() - 1;
             State &s = stack[curr_index];
             HeapEntity *curr = s.ent;
-            if (curr->mark != thisMark) {
+            if (curr->mark != thisMark && !(minor && curr->old)) {
                 curr->mark = thisMark;
-
-                switch(curr->type) {
-                    case HeapEntity::SIMPLE_OBJECT: {
-                        assert(dynamic_cast<HeapSimpleObject *>(curr));
-                        auto *obj = static_cast<HeapSimpleObject *>(curr);
-                        for (auto upv : obj->upValues)
-                            addIfHeapEntity(upv.second, s.children);
-                        break;
-                    }
-                    case HeapEntity::EXTENDED_OBJECT: {
-                        assert(dynamic_cast<HeapExtendedObject *>(curr));
-                        auto *obj = static_cast<HeapExtendedObject *>(curr);
-                        addIfHeapEntity(obj->left, s.children);
-                        addIfHeapEntity(obj->right, s.children);
-                        break;
-                    }
-                    case HeapEntity::COMPREHENSION_OBJECT: {
-                        assert(dynamic_cast<HeapComprehensionObject *>(curr));
-                        auto *obj = static_cast<HeapComprehensionObject *>(curr);
-                        for (auto upv : obj->upValues)
-                            addIfHeapEntity(upv.second, s.children);
-                        for (auto upv : obj->compValues)
-                            addIfHeapEntity(upv.second, s.children);
-                        break;
-                    }
-                    case HeapEntity::ARRAY: {
-                        assert(dynamic_cast<HeapArray *>(curr));
-                        auto *arr = static_cast<HeapArray *>(curr);
-                        for (auto el : arr->elements)
-                            addIfHeapEntity(el, s.children);
-                        break;
-                    }
-                    case HeapEntity::CLOSURE: {
-                        assert(dynamic_cast<HeapClosure *>(curr));
-                        auto *func = static_cast<HeapClosure *>(curr);
-                        for (auto upv : func->upValues)
-                            addIfHeapEntity(upv.second, s.children);
-                        if (func->self)
-                            addIfHeapEntity(func->self, s.children);
-                        break;
-                    }
-                    case HeapEntity::THUNK: {
-                        assert(dynamic_cast<HeapThunk *>(curr));
-                        auto *thunk = static_cast<HeapThunk *>(curr);
-                        if (thunk->filled) {
-                            if (thunk->content.isHeap())
-                                addIfHeapEntity(thunk->content.v.h, s.children);
-                        } else {
-                            for (auto upv : thunk->upValues)
-                                addIfHeapEntity(upv.second, s.children);
-                            if (thunk->self)
-                                addIfHeapEntity(thunk->self, s.children);
-                        }
-                        break;
-                    }
-                    case HeapEntity::STRING:
-                        assert(dynamic_cast<HeapString *>(curr));
-                        break;
-                    default:
-                        assert(false);
-                        break;
-                }
+                addChildren(curr, s.children);
             }
 
             if (s.children.size() > 0) {
@@ -439,31 +896,51 @@ class Heap {
         }
     }
 
-    /** Delete everything that was not marked since the last collection. */
+    /** Delete everything that was not marked since the start of the cycle. */
     void sweep(void)
     {
-        lastMark++;
-        // Heap shrinks during this loop.  Do not cache entities.size().
-        for (unsigned long i = 0; i < entities.size(); ++i) {
-            HeapEntity *x = entities[i];
-            if (x->mark != lastMark) {
-                delete x;
-                if (i != entities.size() - 1) {
-                    // Swap it with the back.
-                    entities[i] = entities[entities.size() - 1];
-                }
-                entities.pop_back();
-                --i;
-            }
+        const GarbageCollectionMark thisMark = lastMark + 1;
+        // The remembered entities may be about to be deleted, so forget them first.
+        for (HeapEntity *e : rememberedSet)
+            e->remembered = false;
+        rememberedSet.clear();
+        sweepEntities(youngEntities, thisMark);
+        if (minor) {
+            // Old entities were not marked, so keep the young survivors' marks in line with them.
+            for (HeapEntity *x : youngEntities)
+                x->mark = lastMark;
+        } else {
+            sweepEntities(oldEntities, thisMark);
+            lastMark = thisMark;
         }
-        lastNumEntities = numEntities = entities.size();
+        oldEntities.insert(oldEntities.end(), youngEntities.begin(), youngEntities.end());
+        youngEntities.clear();
+        numEntities = oldEntities.size();
+        if (!minor)
+            lastNumEntities = numEntities;
+        lastMarkedRoots = markedRoots;
+        minor = false;
     }
 
-    /** Is it time to initiate a GC cycle? */
-    bool checkHeap(void)
+    /** The number of heap entities now. */
+    unsigned long size(void) const
     {
-        return numEntities > gcTuneMinObjects &&
-               numEntities > gcTuneGrowthTrigger * lastNumEntities;
+        return numEntities;
+    }
+
+    /** Is it time to initiate a GC cycle?
+     *
+     * \param roots How many roots a cycle has to mark from.  A minor cycle is not started until
+     * there are at least as many young entities, so that deep stacks do not make the cost of
+     * minor cycles dominate.  The roots marked by the last cycle count too, as frames can hold
+     * many entities, e.g. the elements of an array that is being built.
+     */
+    bool checkHeap(unsigned long roots)
+    {
+        if (gcTuneNurseryObjects > 0 && youngEntities.size() >= gcTuneNurseryObjects &&
+            youngEntities.size() >= roots && youngEntities.size() >= lastMarkedRoots)
+            return true;
+        return fullCollectionDue();
     }
 
     /** Allocate a heap entity.
@@ -474,10 +951,17 @@ class Heap {
     template <class T, class... Args>
     T *makeEntity(Args &&... args)
     {
-        T *r = new T(std::forward<Args>(args)...);
-        entities.push_back(r);
+        void *mem = arena.allocate(sizeof(T));
+        T *r;
+        try {
+            r = new (mem) T(std::forward<Args>(args)...);
+        } catch (...) {
+            arena.release(mem, sizeof(T));
+            throw;
+        }
+        youngEntities.push_back(r);
         r->mark = lastMark;
-        numEntities = entities.size();
+        numEntities++;
         return r;
     }
 };
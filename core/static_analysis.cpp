@@ -14,9 +14,14 @@ See the License for the specific language governing permissions and
 limitations under the License.
 */
 
+#include <algorithm>
+#include <cmath>
+#include <map>
 #include <set>
 
 #include "ast.h"
+#include "desugarer.h"
+#include "parser.h"
 #include "static_analysis.h"
 #include "static_error.h"
 
@@ -212,13 +217,492 @@ static IdSet static_analysis(AST *ast_, bool in_object, const IdSet &vars)
         break;
     }
 
-    for (auto *id : r)
-        ast_->freeVariables.push_back(id);
+    // Some nodes are reached more than once, so replace rather than append.  Being taken from a
+    // set, the free variables are in identifier order, which capturing them relies on.
+    ast_->freeVariables.assign(r.begin(), r.end());
 
     return r;
 }
 
-void jsonnet_static_analysis(AST *ast)
+void jsonnet_static_analysis(AST *ast, const Identifiers &globals)
 {
-    static_analysis(ast, false, IdSet{});
+    static_analysis(ast, false, IdSet(globals.begin(), globals.end()));
+}
+
+/** What the optimizer knows about the variables in scope.
+ *
+ * A variable maps to the literal or object literal it is bound to, or to nullptr if nothing is
+ * known about it, e.g. because it shadows a variable of an enclosing scope.
+ */
+typedef std::map<const Identifier *, AST *> KnownVars;
+
+/** Whether evaluating the AST cannot fail and just gives the value it denotes. */
+static bool is_literal(const AST *ast)
+{
+    switch (ast->type) {
+    case AST_LITERAL_BOOLEAN:
+    case AST_LITERAL_NULL:
+    case AST_LITERAL_STRING: return true;
+    case AST_LITERAL_NUMBER: return std::isfinite(static_cast<const LiteralNumber *>(ast)->value);
+    default: return false;
+    }
+}
+
+/** Whether the field names of the object are distinct string literals and it has no asserts.
+ *
+ * Such an object cannot fail to evaluate, nor can indexing it with one of its field names fail
+ * before that field's body is evaluated.
+ */
+static bool is_plain_object(const AST *ast)
+{
+    if (ast->type != AST_DESUGARED_OBJECT)
+        return false;
+    const auto *obj = static_cast<const DesugaredObject *>(ast);
+    if (!obj->asserts.empty())
+        return false;
+    std::set<UString> names;
+    for (const auto &field : obj->fields) {
+        if (field.name->type != AST_LITERAL_STRING)
+            return false;
+        if (!names.insert(static_cast<const LiteralString *>(field.name)->value).second)
+            return false;
+    }
+    return true;
+}
+
+/** Whether the AST is the standard library, i.e. $std, or $std + a plain object. */
+static bool is_stdlib(const AST *ast)
+{
+    if (ast->type == AST_BINARY) {
+        const auto *binary = static_cast<const Binary *>(ast);
+        return binary->op == BOP_PLUS && is_stdlib(binary->left) && is_plain_object(binary->right);
+    }
+    return ast->type == AST_VAR && static_cast<const Var *>(ast)->id->name == U"$std";
+}
+
+/** What the optimizer knows about a variable bound to the AST. */
+static AST *known_value(AST *ast)
+{
+    return is_literal(ast) || is_plain_object(ast) || is_stdlib(ast) ? ast : nullptr;
+}
+
+/** Restore what was known about a variable before it was shadowed.
+ *
+ * Nothing being known is represented by the variable's absence, to keep the map small.
+ */
+static void restore_known(KnownVars &known, const Identifier *id, AST *value)
+{
+    if (value == nullptr) {
+        known.erase(id);
+    } else {
+        known[id] = value;
+    }
+}
+
+/** The literal the variable is bound to, or nullptr if it is not bound to a literal. */
+static AST *known_literal(const KnownVars &known, const Identifier *id)
+{
+    auto it = known.find(id);
+    if (it == known.end() || it->second == nullptr || !is_literal(it->second))
+        return nullptr;
+    return it->second;
+}
+
+/** The body of a field of a plain object, or nullptr if there is no such field. */
+static AST *plain_object_field(const DesugaredObject *obj, const UString &name)
+{
+    for (const auto &field : obj->fields) {
+        if (static_cast<const LiteralString *>(field.name)->value == name)
+            return field.body;
+    }
+    return nullptr;
+}
+
+/** If obj.name is a natively implemented builtin of the standard library, return it.
+ *
+ * \param obj What the optimizer knows about the object being indexed.
+ */
+static AST *builtin_field(Allocator *alloc, const LocationRange &loc, const AST *obj,
+                          const UString &name)
+{
+    if (obj->type == AST_DESUGARED_OBJECT) {
+        // The field names are distinct, so only the builtins need to be compared.
+        for (const auto &field : static_cast<const DesugaredObject *>(obj)->fields) {
+            if (field.body->type == AST_BUILTIN_FUNCTION &&
+                static_cast<const LiteralString *>(field.name)->value == name)
+                return field.body;
+        }
+        return nullptr;
+    }
+    if (obj->type == AST_BINARY) {
+        const auto *binary = static_cast<const Binary *>(obj);
+        // Fields of the right hand side override those of the standard library.
+        if (plain_object_field(static_cast<const DesugaredObject *>(binary->right), name))
+            return nullptr;
+        return builtin_field(alloc, loc, binary->left, name);
+    }
+    for (unsigned long c = 0; c <= jsonnet_max_builtin(); ++c) {
+        const auto &decl = jsonnet_builtin_decl(c);
+        if (decl.name != name)
+            continue;
+        Identifiers params;
+        for (const auto &p : decl.params)
+            params.push_back(alloc->makeIdentifier(p));
+        return alloc->make<BuiltinFunction>(loc, c, encode_utf8(decl.name), params);
+    }
+    return nullptr;
+}
+
+static AST *make_number(Allocator *alloc, const LocationRange &loc, double v)
+{
+    return alloc->make<LiteralNumber>(loc, Fodder{}, jsonnet_unparse_number(v));
+}
+
+static AST *make_boolean(Allocator *alloc, const LocationRange &loc, bool v)
+{
+    return alloc->make<LiteralBoolean>(loc, Fodder{}, v);
+}
+
+/** Whether the number converts to a 64 bit integer as the bitwise operators require. */
+static bool is_int64(double v)
+{
+    return v >= -9223372036854775808.0 && v < 9223372036854775808.0;
+}
+
+/** The literal a binary operator on two literals evaluates to, or nullptr if it would fail. */
+static AST *fold_binary(Allocator *alloc, const Binary *ast)
+{
+    const LocationRange &loc = ast->location;
+    if (ast->left->type != ast->right->type)
+        return nullptr;
+    switch (ast->left->type) {
+    case AST_LITERAL_BOOLEAN: {
+        bool l = static_cast<const LiteralBoolean *>(ast->left)->value;
+        bool r = static_cast<const LiteralBoolean *>(ast->right)->value;
+        switch (ast->op) {
+        case BOP_AND: return make_boolean(alloc, loc, l && r);
+        case BOP_OR: return make_boolean(alloc, loc, l || r);
+        default: return nullptr;
+        }
+    }
+    case AST_LITERAL_NUMBER: {
+        double l = static_cast<const LiteralNumber *>(ast->left)->value;
+        double r = static_cast<const LiteralNumber *>(ast->right)->value;
+        double v;
+        switch (ast->op) {
+        case BOP_PLUS: v = l + r; break;
+        case BOP_MINUS: v = l - r; break;
+        case BOP_MULT: v = l * r; break;
+        case BOP_DIV:
+            if (r == 0)
+                return nullptr;
+            v = l / r;
+            break;
+        case BOP_LESS_EQ: return make_boolean(alloc, loc, l <= r);
+        case BOP_GREATER_EQ: return make_boolean(alloc, loc, l >= r);
+        case BOP_LESS: return make_boolean(alloc, loc, l < r);
+        case BOP_GREATER: return make_boolean(alloc, loc, l > r);
+        case BOP_SHIFT_L:
+        case BOP_SHIFT_R:
+        case BOP_BITWISE_AND:
+        case BOP_BITWISE_XOR:
+        case BOP_BITWISE_OR: {
+            if (!is_int64(l) || !is_int64(r))
+                return nullptr;
+            int64_t long_l = l;
+            int64_t long_r = r;
+            if (ast->op == BOP_SHIFT_L || ast->op == BOP_SHIFT_R) {
+                // Leave shifts whose result the C++ standard does not define to run time.
+                if (long_l < 0 || long_r < 0 || long_r > 62)
+                    return nullptr;
+                if (ast->op == BOP_SHIFT_L && (long_l >> (62 - long_r)) != 0)
+                    return nullptr;
+            }
+            switch (ast->op) {
+            case BOP_SHIFT_L: v = long_l << long_r; break;
+            case BOP_SHIFT_R: v = long_l >> long_r; break;
+            case BOP_BITWISE_AND: v = long_l & long_r; break;
+            case BOP_BITWISE_XOR: v = long_l ^ long_r; break;
+            default: v = long_l | long_r; break;
+            }
+        } break;
+        default: return nullptr;
+        }
+        if (!std::isfinite(v))
+            return nullptr;
+        return make_number(alloc, loc, v);
+    }
+    case AST_LITERAL_STRING: {
+        const UString &l = static_cast<const LiteralString *>(ast->left)->value;
+        const UString &r = static_cast<const LiteralString *>(ast->right)->value;
+        switch (ast->op) {
+        case BOP_PLUS:
+            return alloc->make<LiteralString>(
+                loc, Fodder{}, l + r, LiteralString::DOUBLE, "", "");
+        case BOP_LESS_EQ: return make_boolean(alloc, loc, l <= r);
+        case BOP_GREATER_EQ: return make_boolean(alloc, loc, l >= r);
+        case BOP_LESS: return make_boolean(alloc, loc, l < r);
+        case BOP_GREATER: return make_boolean(alloc, loc, l > r);
+        default: return nullptr;
+        }
+    }
+    default: return nullptr;
+    }
+}
+
+/** The literal a unary operator on a literal evaluates to, or nullptr if it would fail. */
+static AST *fold_unary(Allocator *alloc, const Unary *ast)
+{
+    const LocationRange &loc = ast->location;
+    if (ast->expr->type == AST_LITERAL_BOOLEAN) {
+        if (ast->op != UOP_NOT)
+            return nullptr;
+        return make_boolean(alloc, loc, !static_cast<const LiteralBoolean *>(ast->expr)->value);
+    }
+    if (ast->expr->type == AST_LITERAL_NUMBER) {
+        double v = static_cast<const LiteralNumber *>(ast->expr)->value;
+        switch (ast->op) {
+        case UOP_PLUS: return ast->expr;
+        case UOP_MINUS: return make_number(alloc, loc, -v);
+        case UOP_BITWISE_NOT:
+            if (!is_int64(v))
+                return nullptr;
+            return make_number(alloc, loc, ~(long)(v));
+        default: return nullptr;
+        }
+    }
+    return nullptr;
+}
+
+/** The literal a call evaluates to, if it is to std.length with a literal argument. */
+static AST *fold_apply(Allocator *alloc, const Apply *ast)
+{
+    if (ast->target->type != AST_BUILTIN_FUNCTION)
+        return nullptr;
+    if (static_cast<const BuiltinFunction *>(ast->target)->name != "length")
+        return nullptr;
+    if (ast->args.size() != 1 || ast->args[0].id != nullptr)
+        return nullptr;
+    // The argument is forced, but not the elements of an array.
+    const AST *arg = ast->args[0].expr;
+    if (arg->type == AST_ARRAY) {
+        const auto *array = static_cast<const Array *>(arg);
+        return make_number(alloc, ast->location, array->elements.size());
+    }
+    if (arg->type == AST_LITERAL_STRING) {
+        const auto *str = static_cast<const LiteralString *>(arg);
+        return make_number(alloc, ast->location, str->value.size());
+    }
+    return nullptr;
+}
+
+/** Simplify the AST, replacing it if it can be evaluated without running the program.
+ *
+ * \param alloc Allocator for making new ASTs.
+ * \param ast_ The AST, which is replaced by a simpler one if possible.
+ * \param known What is known about the variables in scope, restored before returning.
+ */
+static void optimize(Allocator *alloc, AST *&ast_, KnownVars &known)
+{
+    switch (ast_->type) {
+    case AST_APPLY: {
+        assert(dynamic_cast<Apply *>(ast_));
+        auto* ast = static_cast<Apply *>(ast_);
+        optimize(alloc, ast->target, known);
+        for (auto &arg : ast->args)
+            optimize(alloc, arg.expr, known);
+        if (AST *r = fold_apply(alloc, ast))
+            ast_ = r;
+    } break;
+    case AST_ARRAY: {
+        assert(dynamic_cast<Array *>(ast_));
+        auto* ast = static_cast<Array *>(ast_);
+        for (auto &el : ast->elements)
+            optimize(alloc, el.expr, known);
+    } break;
+    case AST_BINARY: {
+        assert(dynamic_cast<Binary *>(ast_));
+        auto* ast = static_cast<Binary *>(ast_);
+        optimize(alloc, ast->left, known);
+        if (ast->left->type == AST_LITERAL_BOOLEAN) {
+            // The right hand side of a short-circuited && or || is never evaluated.
+            bool l = static_cast<LiteralBoolean *>(ast->left)->value;
+            if ((ast->op == BOP_AND && !l) || (ast->op == BOP_OR && l)) {
+                ast_ = ast->left;
+                break;
+            }
+        }
+        optimize(alloc, ast->right, known);
+        if (is_literal(ast->left) && is_literal(ast->right)) {
+            if (AST *r = fold_binary(alloc, ast))
+                ast_ = r;
+        }
+    } break;
+    case AST_CONDITIONAL: {
+        assert(dynamic_cast<Conditional *>(ast_));
+        auto* ast = static_cast<Conditional *>(ast_);
+        optimize(alloc, ast->cond, known);
+        if (ast->cond->type == AST_LITERAL_BOOLEAN) {
+            ast_ = static_cast<LiteralBoolean *>(ast->cond)->value ? ast->branchTrue
+                                                                   : ast->branchFalse;
+            optimize(alloc, ast_, known);
+            break;
+        }
+        optimize(alloc, ast->branchTrue, known);
+        optimize(alloc, ast->branchFalse, known);
+    } break;
+    case AST_ERROR: {
+        assert(dynamic_cast<Error *>(ast_));
+        auto* ast = static_cast<Error *>(ast_);
+        optimize(alloc, ast->expr, known);
+    } break;
+    case AST_FUNCTION: {
+        assert(dynamic_cast<Function *>(ast_));
+        auto* ast = static_cast<Function *>(ast_);
+        KnownVars outer;
+        for (const auto &p : ast->params) {
+            outer[p.id] = known[p.id];
+            known[p.id] = nullptr;
+        }
+        for (auto &p : ast->params) {
+            if (p.expr != nullptr)
+                optimize(alloc, p.expr, known);
+        }
+        optimize(alloc, ast->body, known);
+        for (const auto &pair : outer)
+            restore_known(known, pair.first, pair.second);
+    } break;
+    case AST_IN_SUPER: {
+        assert(dynamic_cast<InSuper *>(ast_));
+        auto* ast = static_cast<InSuper *>(ast_);
+        optimize(alloc, ast->element, known);
+    } break;
+    case AST_INDEX: {
+        assert(dynamic_cast<Index *>(ast_));
+        auto* ast = static_cast<Index *>(ast_);
+        if (ast->target->type == AST_VAR && ast->index->type == AST_LITERAL_STRING) {
+            auto it = known.find(static_cast<Var *>(ast->target)->id);
+            const AST *obj = it == known.end() ? nullptr : it->second;
+            if (obj != nullptr && !is_literal(obj)) {
+                const UString &name = static_cast<LiteralString *>(ast->index)->value;
+                if (AST *r = builtin_field(alloc, ast->location, obj, name)) {
+                    ast_ = r;
+                    break;
+                }
+            }
+        }
+        optimize(alloc, ast->target, known);
+        optimize(alloc, ast->index, known);
+    } break;
+    case AST_LOCAL: {
+        assert(dynamic_cast<Local *>(ast_));
+        auto* ast = static_cast<Local *>(ast_);
+        KnownVars outer;
+        for (const auto &bind : ast->binds) {
+            outer[bind.var] = known[bind.var];
+            known[bind.var] = known_value(bind.body);
+        }
+        // The bindings can refer to each other, and folding one can make another foldable, so go
+        // over them until what is known about them stops changing.  Folding never loses what was
+        // already known, so this terminates.
+        bool changed = true;
+        while (changed) {
+            changed = false;
+            for (auto &bind : ast->binds)
+                optimize(alloc, bind.body, known);
+            for (const auto &bind : ast->binds) {
+                AST *value = known_value(bind.body);
+                if (known[bind.var] != value) {
+                    known[bind.var] = value;
+                    changed = true;
+                }
+            }
+        }
+        optimize(alloc, ast->body, known);
+        for (const auto &pair : outer)
+            restore_known(known, pair.first, pair.second);
+        // Every use of a variable bound to a literal has been replaced by the literal.
+        Local::Binds binds;
+        for (const auto &bind : ast->binds) {
+            if (!is_literal(bind.body))
+                binds.push_back(bind);
+        }
+        if (binds.empty()) {
+            ast_ = ast->body;
+        } else {
+            ast->binds = binds;
+        }
+    } break;
+    case AST_DESUGARED_OBJECT: {
+        assert(dynamic_cast<DesugaredObject *>(ast_));
+        auto* ast = static_cast<DesugaredObject *>(ast_);
+        for (auto &field : ast->fields) {
+            optimize(alloc, field.name, known);
+            optimize(alloc, field.body, known);
+        }
+        for (AST *&assert : ast->asserts)
+            optimize(alloc, assert, known);
+    } break;
+    case AST_OBJECT_COMPREHENSION_SIMPLE: {
+        assert(dynamic_cast<ObjectComprehensionSimple *>(ast_));
+        auto* ast = static_cast<ObjectComprehensionSimple *>(ast_);
+        optimize(alloc, ast->array, known);
+        AST *outer = known[ast->id];
+        known[ast->id] = nullptr;
+        optimize(alloc, ast->field, known);
+        optimize(alloc, ast->value, known);
+        restore_known(known, ast->id, outer);
+    } break;
+    case AST_SUPER_INDEX: {
+        assert(dynamic_cast<SuperIndex *>(ast_));
+        auto* ast = static_cast<SuperIndex *>(ast_);
+        optimize(alloc, ast->index, known);
+    } break;
+    case AST_UNARY: {
+        assert(dynamic_cast<Unary *>(ast_));
+        auto* ast = static_cast<Unary *>(ast_);
+        optimize(alloc, ast->expr, known);
+        if (is_literal(ast->expr)) {
+            if (AST *r = fold_unary(alloc, ast))
+                ast_ = r;
+        }
+    } break;
+    case AST_VAR: {
+        assert(dynamic_cast<Var *>(ast_));
+        auto* ast = static_cast<Var *>(ast_);
+        if (AST *literal = known_literal(known, ast->id))
+            ast_ = literal;
+    } break;
+    case AST_APPLY_BRACE:
+    case AST_BUILTIN_FUNCTION:
+    case AST_IMPORT:
+    case AST_IMPORTSTR:
+    case AST_LITERAL_BOOLEAN:
+    case AST_LITERAL_NUMBER:
+    case AST_LITERAL_STRING:
+    case AST_LITERAL_NULL:
+    case AST_SELF:
+        // Nothing to do.
+        break;
+    default:
+        std::cerr << "INTERNAL ERROR: Unknown AST: " << ast_ << std::endl;
+        std::abort();
+        break;
+    }
+
+    // The variables bound to literals are no longer used, and their bindings are removed.
+    auto &free = ast_->freeVariables;
+    auto unused = [&](const Identifier *id) { return known_literal(known, id) != nullptr; };
+    free.erase(std::remove_if(free.begin(), free.end(), unused), free.end());
+}
+
+bool jsonnet_static_is_literal(const AST *ast)
+{
+    return is_literal(ast);
+}
+
+void jsonnet_static_optimize(Allocator *alloc, AST *&ast)
+{
+    KnownVars known;
+    optimize(alloc, ast, known);
 }
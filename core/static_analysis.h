@@ -21,7 +21,25 @@ limitations under the License.
 
 /** Check the ast for appropriate use of self, super, and correctly bound variables.  Also
  * initialize the freeVariables member of function and object ASTs.
+ *
+ * \param ast The AST to analyse.
+ * \param globals Variables that may be used without being bound in the AST, e.g. $std.
  */
-void jsonnet_static_analysis(AST *ast);
+void jsonnet_static_analysis(AST *ast, const Identifiers &globals = Identifiers{});
+
+/** Whether the AST is a literal that cannot fail to evaluate, so its value can be shared. */
+bool jsonnet_static_is_literal(const AST *ast);
+
+/** Simplify an analysed AST by doing before execution what does not depend on it.
+ *
+ * Operators, conditionals and std.length are folded when applied to literals, variables bound to
+ * literals are replaced by them, and std.f is replaced by the builtin function when std is the
+ * standard library and f is implemented natively.  Nothing that could fail is folded, so errors
+ * still happen at run time, as before.  The freeVariables members are kept up to date.
+ *
+ * \param alloc Allocator for making new ASTs.
+ * \param ast The AST to simplify, which must have passed jsonnet_static_analysis.
+ */
+void jsonnet_static_optimize(Allocator *alloc, AST *&ast);
 
 #endif
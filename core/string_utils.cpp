@@ -28,6 +28,35 @@ UString jsonnet_string_unparse(const UString &str, bool single)
     return ss.str();
 }
 
+void jsonnet_string_unparse_utf8(const UString &str, std::string &out)
+{
+    static const char hex[] = "0123456789abcdef";
+    out += '\"';
+    for (char32_t c : str) {
+        switch (c) {
+            case U'\"': out += "\\\""; break;
+            case U'\\': out += "\\\\"; break;
+            case U'\b': out += "\\b"; break;
+            case U'\f': out += "\\f"; break;
+            case U'\n': out += "\\n"; break;
+            case U'\r': out += "\\r"; break;
+            case U'\t': out += "\\t"; break;
+            default: {
+                if (c < 0x20 || (c >= 0x7f && c <= 0x9f)) {
+                    // Unprintable, use \u
+                    out += "\\u00";
+                    out += hex[c >> 4];
+                    out += hex[c & 0xf];
+                } else {
+                    // Printable, write verbatim
+                    encode_utf8(c, out);
+                }
+            }
+        }
+    }
+    out += '\"';
+}
+
 UString jsonnet_string_escape(const UString &str, bool single)
 {
     UStringStream ss;
@@ -22,6 +22,13 @@ limitations under the License.
 /** Unparse the string. */
 UString jsonnet_string_unparse(const UString &str, bool single);
 
+/** Unparse the string with double quotes, appending it to out in UTF-8.
+ *
+ * This gives the same characters as jsonnet_string_unparse(str, false), without building them as
+ * an intermediate UString.
+ */
+void jsonnet_string_unparse_utf8(const UString &str, std::string &out);
+
 // Note that the following two functions do not handle the quoting of ' and "
 // inside verbatim strings because that quoting is reversible.  Thus, that
 // quoting is done at lexing time and undone again at pretty-printing time.
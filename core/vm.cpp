@@ -14,6 +14,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 */
 
+#include <algorithm>
 #include <cassert>
 #include <cmath>
 
@@ -46,6 +47,39 @@ std::string dir_name(const std::string &path)
     return "";
 }
 
+/** Concatenations shorter than this are copied instead of becoming rope nodes. */
+static const size_t ROPE_MIN_LENGTH = 256;
+
+/** Manifested output is handed to the sink in pieces of about this many bytes. */
+static const size_t OUTPUT_CHUNK_SIZE = 1 << 16;
+
+/** Array concatenations shorter than this are copied instead of becoming concatenation nodes. */
+static const size_t ARRAY_CONCAT_MIN_LENGTH = 64;
+
+/** The desugared and analysed stdlib, shared by every execution in the process.
+ *
+ * It is built by the first execution that needs it and never changes afterwards, so executions in
+ * different threads use it without locking.  Every VmCache shares its identifiers.
+ */
+struct SharedStdlib {
+    Allocator alloc;
+    const AST *expr;
+
+    SharedStdlib(void)
+    {
+        AST *stdlib = jsonnet_desugar_stdlib(&alloc);
+        jsonnet_static_analysis(stdlib, Identifiers{});
+        jsonnet_static_optimize(&alloc, stdlib);
+        expr = stdlib;
+    }
+};
+
+const SharedStdlib &shared_stdlib(void)
+{
+    static const SharedStdlib stdlib;
+    return stdlib;
+}
+
 /** Stack frames.
  *
  * Of these, FRAME_CALL is the most special, as it is the only frame the stack
@@ -74,6 +108,61 @@ enum FrameKind {
     FRAME_BUILTIN_JOIN_STRINGS, // When executing std.join over strings, used to hold intermediate state.
     FRAME_BUILTIN_JOIN_ARRAYS,  // When executing std.join over arrays, used to hold intermediate state.
     FRAME_BUILTIN_DECODE_UTF8,  // When executing std.decodeUTF8, used to hold intermediate state.
+    FRAME_BUILTIN_SORT,         // When executing std.sort, holds the keys computed so far.
+    FRAME_BUILTIN_UNIQ,         // When executing std.uniq, holds the keys computed so far.
+    FRAME_BUILTIN_SET_UNION,    // When executing std.setUnion, holds the keys computed so far.
+    FRAME_BUILTIN_SET_INTER,    // When executing std.setInter, holds the keys computed so far.
+    FRAME_BUILTIN_SET_DIFF,     // When executing std.setDiff, holds the keys computed so far.
+};
+
+/** State that only a few kinds of stack frame need, e.g. to build an object or join strings.
+ *
+ * It is kept out of Frame so that the common frames stay small and cheap to push, pop and mark.
+ * \see Stack::payload()
+ */
+struct FramePayload {
+    /** Used for accumulating the fields of an object. */
+    std::map<const Identifier *, HeapSimpleObject::Field> objectFields;
+
+    /** Used for accumulating the elements of an object comprehension. */
+    std::map<const Identifier *, HeapThunk *> elements;
+
+    /** Used for accumulating a joined string. */
+    UString str;
+
+    /** Used for accumulating bytes */
+    std::string bytes;
+
+    /** Used for accumulating sort keys. */
+    std::vector<Value> values;
+
+    /** Mark everything visible from the payload. */
+    void mark(Heap &heap) const
+    {
+        for (const auto &el : elements)
+            heap.markFrom(el.second);
+        for (const auto &v : values)
+            heap.markFrom(v);
+    }
+
+    /** Forget the state, so the payload can be reused by another frame.  Large buffers are
+     * released rather than kept around for reuse.
+     */
+    void clear(void)
+    {
+        static const size_t MAX_KEPT_CAPACITY = 4096;
+        objectFields.clear();
+        elements.clear();
+        if (str.capacity() > MAX_KEPT_CAPACITY)
+            UString().swap(str);
+        str.clear();
+        if (bytes.capacity() > MAX_KEPT_CAPACITY)
+            std::string().swap(bytes);
+        bytes.clear();
+        if (values.capacity() > MAX_KEPT_CAPACITY)
+            std::vector<Value>().swap(values);
+        values.clear();
+    }
 };
 
 /** A frame on the stack.
@@ -83,7 +172,8 @@ enum FrameKind {
  *
  * The stack frame is a bit like a tagged union, except not as memory
  * efficient.  The set of member variables that are actually used depends on
- * the value of the member varaible kind.
+ * the value of the member varaible kind.  The few kinds that need containers beyond thunks and
+ * bindings keep them in a FramePayload, so that most frames are cheap to create.
  *
  * If the stack frame is of kind FRAME_CALL, then it counts towards the
  * maximum number of stack frames allowed.  Other stack frames are not
@@ -102,11 +192,12 @@ struct Frame {
     /** The code we were executing before. */
     const AST *ast;
 
-    /** The location of the code we were executing before.
+    /** The location of the code we were executing before, if ast is nullptr.
      *
-     * location == ast->location when ast != nullptr
+     * Otherwise it is left empty, as copying ast->location for every frame would be costly.
+     * \see location()
      */
-    LocationRange location;
+    LocationRange ownLocation;
 
     /** Reuse this stack frame for the purpose of tail call optimization. */
     bool tailCall;
@@ -120,24 +211,17 @@ struct Frame {
     /** Used for a variety of purposes. */
     DesugaredObject::Fields::const_iterator fit;
 
-    /** Used for a variety of purposes. */
-    std::map<const Identifier *, HeapSimpleObject::Field> objectFields;
-
     /** Used for a variety of purposes. */
     unsigned elementId;
 
-    /** Used for a variety of purposes. */
-    std::map<const Identifier *, HeapThunk *> elements;
-
     /** Used for a variety of purposes. */
     std::vector<HeapThunk *> thunks;
 
-    /** Used for accumulating a joined string. */
-    UString str;
+    /** Used when accumulating a joined string. */
     bool first;
 
-    /** Used for accumulating bytes */
-    std::string bytes;
+    /** State needed by only some kinds of frame, or nullptr.  Owned by the Stack. */
+    FramePayload *payload;
 
     /** The context is used in error messages to attempt to find a reasonable name for the
      * object, function, or thunk value being executed.  If it is a thunk, it is filled
@@ -162,18 +246,31 @@ struct Frame {
      */
     unsigned offset;
 
+    /** The field being evaluated, if this is the call frame of an object field.  Its value is
+     * then stored in self's fieldValues when the frame terminates.
+     */
+    const Identifier *field;
+
     /** A set of variables introduced at this point. */
     BindingFrame bindings;
 
+    /** For a call frame, the environment captured by the closure, thunk or object whose code
+     * is being executed, or nullptr.  It is shared with that entity rather than copied into
+     * bindings, which then only holds the variables bound on top of it (e.g. arguments).
+     */
+    const BindingFrame *upValues;
+
     Frame(const FrameKind &kind, const AST *ast)
         : kind(kind),
           ast(ast),
-          location(ast->location),
           tailCall(false),
           elementId(0),
+          payload(nullptr),
           context(NULL),
           self(NULL),
-          offset(0)
+          offset(0),
+          field(nullptr),
+          upValues(nullptr)
     {
         val.t = Value::NULL_TYPE;
         val2.t = Value::NULL_TYPE;
@@ -182,17 +279,26 @@ struct Frame {
     Frame(const FrameKind &kind, const LocationRange &location)
         : kind(kind),
           ast(nullptr),
-          location(location),
+          ownLocation(location),
           tailCall(false),
           elementId(0),
+          payload(nullptr),
           context(NULL),
           self(NULL),
-          offset(0)
+          offset(0),
+          field(nullptr),
+          upValues(nullptr)
     {
         val.t = Value::NULL_TYPE;
         val2.t = Value::NULL_TYPE;
     }
 
+    /** The location of the code we were executing before. */
+    const LocationRange &location(void) const
+    {
+        return ast == nullptr ? ownLocation : ast->location;
+    }
+
     /** Mark everything visible from this frame. */
     void mark(Heap &heap) const
     {
@@ -204,10 +310,13 @@ struct Frame {
             heap.markFrom(self);
         for (const auto &bind : bindings)
             heap.markFrom(bind.second);
-        for (const auto &el : elements)
-            heap.markFrom(el.second);
+        if (upValues)
+            for (const auto &bind : *upValues)
+                heap.markFrom(bind.second);
         for (const auto &th : thunks)
             heap.markFrom(th);
+        if (payload)
+            payload->mark(heap);
     }
 
     bool isCall(void) const
@@ -224,19 +333,81 @@ class Stack {
     /** How many call frames should be allowed before aborting the program. */
     unsigned limit;
 
+    /** The most call frames there have been on the stack at once. */
+    unsigned deepest;
+
     /** The stack frames. */
     std::vector<Frame> stack;
 
+    /** Payloads of popped frames, kept for reuse. */
+    std::vector<FramePayload *> sparePayloads;
+
+    /** Pop the top frame, recycling its payload. */
+    void popBack(void)
+    {
+        FramePayload *payload = stack.back().payload;
+        if (payload != nullptr) {
+            payload->clear();
+            sparePayloads.push_back(payload);
+        }
+        stack.pop_back();
+    }
+
+    /** Throw if another call frame would exceed the limit. */
+    void checkCallLimit(const LocationRange &loc)
+    {
+        tailCallTrimStack();
+        if (calls >= limit) {
+            throw makeError(loc, "max stack frames exceeded.");
+        }
+    }
+
+    /** Set up the call frame just pushed. */
+    void initCall(HeapEntity *context, HeapObject *self, unsigned offset,
+                  const BindingFrame *up_values, BindingFrame &&bindings)
+    {
+        calls++;
+        if (calls > deepest)
+            deepest = calls;
+        top().context = context;
+        top().self = self;
+        top().offset = offset;
+        top().bindings = std::move(bindings);
+        top().upValues = up_values;
+        top().tailCall = false;
+
+#ifndef NDEBUG
+        for (const auto &bind : top().bindings) {
+            if (bind.second == nullptr) {
+                std::cerr << "INTERNAL ERROR: No binding for variable "
+                          << encode_utf8(bind.first->name) << std::endl;
+                std::abort();
+            }
+        }
+#endif
+    }
+
    public:
-    Stack(unsigned limit) : calls(0), limit(limit) {}
+    Stack(unsigned limit) : calls(0), limit(limit), deepest(0) {}
 
-    ~Stack(void) {}
+    ~Stack(void)
+    {
+        for (const auto &f : stack)
+            delete f.payload;
+        for (FramePayload *payload : sparePayloads)
+            delete payload;
+    }
 
     unsigned size(void)
     {
         return stack.size();
     }
 
+    unsigned maxDepth(void)
+    {
+        return deepest;
+    }
+
     /** Search for the closest variable in scope that matches the given name. */
     HeapThunk *lookUpVar(const Identifier *id)
     {
@@ -246,8 +417,14 @@ class Stack {
             if (it != binds.end()) {
                 return it->second;
             }
-            if (stack[i].isCall())
+            if (stack[i].isCall()) {
+                if (stack[i].upValues != nullptr) {
+                    auto it2 = stack[i].upValues->find(id);
+                    if (it2 != stack[i].upValues->end())
+                        return it2->second;
+                }
                 break;
+            }
         }
         return nullptr;
     }
@@ -274,7 +451,21 @@ class Stack {
     {
         if (top().isCall())
             calls--;
-        stack.pop_back();
+        popBack();
+    }
+
+    /** The payload of a frame, which is allocated (or reused) the first time it is needed. */
+    FramePayload &payload(Frame &f)
+    {
+        if (f.payload == nullptr) {
+            if (sparePayloads.empty()) {
+                f.payload = new FramePayload();
+            } else {
+                f.payload = sparePayloads.back();
+                sparePayloads.pop_back();
+            }
+        }
+        return *f.payload;
     }
 
     /** Attempt to find a name for a given heap entity.  This may not be possible, but we try
@@ -287,7 +478,17 @@ class Stack {
         std::string name;
         for (int i = from_here - 1; i >= 0; --i) {
             const auto &f = stack[i];
-            for (const auto &pair : f.bindings) {
+            // Visit the frame's own bindings and its shared environment in identifier order,
+            // as if they were a single binding frame.
+            static const BindingFrame no_bindings;
+            const BindingFrame &up_values = f.upValues ? *f.upValues : no_bindings;
+            auto it = f.bindings.begin();
+            auto up_it = up_values.begin();
+            while (it != f.bindings.end() || up_it != up_values.end()) {
+                const auto &pair = up_it == up_values.end() ||
+                                           (it != f.bindings.end() && it->first < up_it->first)
+                                       ? *it++
+                                       : *up_it++;
                 HeapThunk *thunk = pair.second;
                 if (!thunk->filled)
                     continue;
@@ -329,7 +530,7 @@ class Stack {
     virtual void dump(void)
     {
         for (unsigned i = 0; i < stack.size(); ++i) {
-            std::cout << "stack[" << i << "] = " << stack[i].location << " (" << stack[i].kind
+            std::cout << "stack[" << i << "] = " << stack[i].location() << " (" << stack[i].kind
                       << ")" << std::endl;
         }
         std::cout << std::endl;
@@ -348,8 +549,8 @@ class Stack {
                     // Give the last line a name.
                     stack_trace[stack_trace.size() - 1].name = getName(i, f.context);
                 }
-                if (f.location.isSet() || f.location.file.length() > 0)
-                    stack_trace.push_back(TraceFrame(f.location));
+                if (f.location().isSet() || f.location().file.length() > 0)
+                    stack_trace.push_back(TraceFrame(f.location()));
             }
         }
         return RuntimeError(stack_trace, msg);
@@ -357,9 +558,9 @@ class Stack {
 
     /** New (non-call) frame. */
     template <class... Args>
-    void newFrame(Args... args)
+    void newFrame(Args &&... args)
     {
-        stack.emplace_back(args...);
+        stack.emplace_back(std::forward<Args>(args)...);
     }
 
     /** If there is a tailstrict annotated frame followed by some locals, pop them all. */
@@ -373,7 +574,7 @@ class Stack {
                     }
                     // Remove all stack frames including this one.
                     while (stack.size() > unsigned(i))
-                        stack.pop_back();
+                        popBack();
                     calls--;
                     return;
                 } break;
@@ -385,31 +586,41 @@ class Stack {
         }
     }
 
-    /** New call frame. */
+    /** New call frame.
+     *
+     * \param bindings The variables bound in the new frame.
+     */
     void newCall(const LocationRange &loc, HeapEntity *context, HeapObject *self, unsigned offset,
-                 const BindingFrame &up_values)
+                 BindingFrame bindings)
     {
-        tailCallTrimStack();
-        if (calls >= limit) {
-            throw makeError(loc, "max stack frames exceeded.");
-        }
+        newCall(loc, context, self, offset, nullptr, std::move(bindings));
+    }
+
+    /** New call frame that shares an environment captured by a heap entity instead of copying
+     * it.
+     *
+     * \param up_values Must be owned by context, and not change while the frame is on the
+     * stack.
+     * \param bindings Variables bound on top of up_values, which they shadow.
+     */
+    void newCall(const LocationRange &loc, HeapEntity *context, HeapObject *self, unsigned offset,
+                 const BindingFrame *up_values, BindingFrame bindings = BindingFrame{})
+    {
+        checkCallLimit(loc);
         stack.emplace_back(FRAME_CALL, loc);
-        calls++;
-        top().context = context;
-        top().self = self;
-        top().offset = offset;
-        top().bindings = up_values;
-        top().tailCall = false;
+        initCall(context, self, offset, up_values, std::move(bindings));
+    }
 
-#ifndef NDEBUG
-        for (const auto &bind : up_values) {
-            if (bind.second == nullptr) {
-                std::cerr << "INTERNAL ERROR: No binding for variable "
-                          << encode_utf8(bind.first->name) << std::endl;
-                std::abort();
-            }
-        }
-#endif
+    /** New call frame, as above, for a call made by the given AST.
+     *
+     * This avoids copying the location into the frame.
+     */
+    void newCall(const AST *ast, HeapEntity *context, HeapObject *self, unsigned offset,
+                 const BindingFrame *up_values, BindingFrame bindings = BindingFrame{})
+    {
+        checkCallLimit(ast->location);
+        stack.emplace_back(FRAME_CALL, ast);
+        initCall(context, self, offset, up_values, std::move(bindings));
     }
 
     /** Look up the stack to find the self binding. */
@@ -445,6 +656,170 @@ typedef std::map<std::string, VmExt> ExtMap;
 /** Typedef to save some typing. */
 typedef std::map<std::string, std::string> StrMap;
 
+/** Builds the JsonnetJsonValue arguments of native callbacks, see Interpreter::manifestValue. */
+void *json_make_null(void *)
+{
+    return new JsonnetJsonValue(JsonnetJsonValue::NULL_KIND, "", 0);
+}
+
+void *json_make_bool(void *, int v)
+{
+    return new JsonnetJsonValue(JsonnetJsonValue::BOOL, "", v ? 1.0 : 0.0);
+}
+
+void *json_make_number(void *, double v)
+{
+    return new JsonnetJsonValue(JsonnetJsonValue::NUMBER, "", v);
+}
+
+void *json_make_string(void *, const char *v, size_t len)
+{
+    return new JsonnetJsonValue(JsonnetJsonValue::STRING, std::string(v, len), 0);
+}
+
+void *json_make_array(void *)
+{
+    return new JsonnetJsonValue(JsonnetJsonValue::ARRAY, "", 0);
+}
+
+int json_array_append(void *, void *arr, void *v)
+{
+    static_cast<JsonnetJsonValue *>(arr)->elements.emplace_back(
+        static_cast<JsonnetJsonValue *>(v));
+    return 1;
+}
+
+void *json_make_object(void *)
+{
+    return new JsonnetJsonValue(JsonnetJsonValue::OBJECT, "", 0);
+}
+
+int json_object_append(void *, void *obj, const char *f, size_t len, void *v)
+{
+    static_cast<JsonnetJsonValue *>(obj)->fields[std::string(f, len)].reset(
+        static_cast<JsonnetJsonValue *>(v));
+    return 1;
+}
+
+void json_destroy(void *, void *v)
+{
+    delete static_cast<JsonnetJsonValue *>(v);
+}
+
+const JsonnetValueBuilder json_builder = {
+    json_make_null,
+    json_make_bool,
+    json_make_number,
+    json_make_string,
+    json_make_array,
+    json_array_append,
+    json_make_object,
+    json_object_append,
+    json_destroy,
+};
+
+/** Builds nothing, for walking a value only to force it, see Interpreter::forceValue. */
+char forced_value;
+
+void *force_make_null(void *)
+{
+    return &forced_value;
+}
+
+void *force_make_bool(void *, int)
+{
+    return &forced_value;
+}
+
+void *force_make_number(void *, double)
+{
+    return &forced_value;
+}
+
+void *force_make_string(void *, const char *, size_t)
+{
+    return &forced_value;
+}
+
+int force_append(void *, void *, void *)
+{
+    return 1;
+}
+
+int force_object_append(void *, void *, const char *, size_t, void *)
+{
+    return 1;
+}
+
+void force_destroy(void *, void *) {}
+
+const JsonnetValueBuilder force_builder = {
+    force_make_null,
+    force_make_bool,
+    force_make_number,
+    force_make_string,
+    force_make_null,
+    force_append,
+    force_make_null,
+    force_object_append,
+    force_destroy,
+};
+
+/** Whether the function has a parameter with the given name. */
+bool has_param(const HeapClosure *func, const Identifier *id)
+{
+    for (const auto &param : func->params) {
+        if (param.id == id)
+            return true;
+    }
+    return false;
+}
+
+/** Whether the binding can share the thunk of its body rather than have one of its own.
+ *
+ * That is the case for literals, and for variables bound outside the local, which unlike those
+ * bound by it already have thunks.
+ */
+bool shares_thunk(const Local &ast, const Local::Bind &bind)
+{
+    if (jsonnet_static_is_literal(bind.body))
+        return true;
+    if (bind.body->type != AST_VAR)
+        return false;
+    const Identifier *id = static_cast<const Var *>(bind.body)->id;
+    for (const auto &other : ast.binds) {
+        if (other.var == id)
+            return false;
+    }
+    return true;
+}
+
+/** A conversion of a std.format string, e.g. %(key)-5.3d, and the text preceding it. */
+struct FormatCode {
+    /** Literal text between the previous conversion and this one. */
+    UString text;
+
+    /** The mapping key, if any. */
+    bool hasMkey;
+    UString mkey;
+
+    /** The conversion flags. */
+    bool alt, zero, left, blank, sign;
+
+    /** Field width, taken from the values if fwStar. */
+    bool fwStar;
+    double fw;
+
+    /** Precision, taken from the values if precStar. */
+    bool hasPrec;
+    bool precStar;
+    double prec;
+
+    /** One of d o x e f g c s %. */
+    char32_t ctype;
+    bool caps;
+};
+
 class Interpreter;
 
 typedef const AST *(Interpreter::*BuiltinFunc)(const LocationRange &loc,
@@ -474,6 +849,12 @@ class Interpreter {
      */
     Allocator *alloc;
 
+    /** State shared with other executions, e.g. the stdlib and parsed imports. */
+    VmCache &cache;
+
+    /** The variable that the desugarer uses to refer to the stdlib. */
+    const Identifier *idStd;
+
     /** Used to "name" thunks created to cache imports. */
     const Identifier *idImport;
 
@@ -489,6 +870,33 @@ class Interpreter {
     /** Used to refer to idJsonObjVar. */
     const AST *jsonObjVar;
 
+    /** Used to bind the key function of std.sort and the std.set* functions. */
+    const Identifier *idKeyF;
+
+    /** Used to bind the element whose key is computed. */
+    const Identifier *idKeyArg;
+
+    /** idKeyF(idKeyArg), for key functions that cannot be called directly, by the call of the
+     * builtin.  Each is built on demand, with the location of that call.
+     */
+    std::map<const AST *, AST *> keyCalls;
+
+    /** Used to bind the keys compared by equalKeys(). */
+    const Identifier *idKeyA;
+    const Identifier *idKeyB;
+
+    /** std.equals(idKeyA, idKeyB), for keys that are arrays or objects.  Built on demand. */
+    AST *equalsCall;
+
+    /** The std object, which is bound to idStd for every file. */
+    HeapThunk *stdThunk;
+
+    /** The closure of each builtin by number, made when first needed, as it never changes. */
+    std::vector<HeapClosure *> builtinClosures;
+
+    /** A filled thunk for each literal passed or bound so far, which is shared by every use. */
+    std::map<const AST *, HeapThunk *> literalThunks;
+
     struct ImportCacheValue {
         std::string foundHere;
         std::string content;
@@ -505,6 +913,9 @@ class Interpreter {
     /** External variables for std.extVar. */
     ExtMap externalVars;
 
+    /** The heap values of external variables bound to JSON values, made on first use. */
+    std::map<std::string, HeapThunk *> externalValues;
+
     /** The callback used for loading imported files. */
     VmNativeCallbackMap nativeCallbacks;
 
@@ -514,24 +925,103 @@ class Interpreter {
     /** User context pointer for the import callback. */
     void *importCallbackContext;
 
-    /** Builtin functions by name. */
-    typedef std::map<std::string, BuiltinFunc> BuiltinMap;
-    BuiltinMap builtins;
+    /** Builtin functions by number.  \see jsonnet_builtin_decl */
+    typedef std::vector<BuiltinFunc> BuiltinTable;
+    const BuiltinTable &builtins;
 
-    RuntimeError makeError(const LocationRange &loc, const std::string &msg)
+    /** Index the implementations of the builtins by the numbers the desugarer gives them. */
+    static BuiltinTable makeBuiltinTable(void)
     {
-        return stack.makeError(loc, msg);
+        std::map<std::string, BuiltinFunc> builtins;
+        builtins["makeArray"] = &Interpreter::builtinMakeArray;
+        builtins["pow"] = &Interpreter::builtinPow;
+        builtins["floor"] = &Interpreter::builtinFloor;
+        builtins["ceil"] = &Interpreter::builtinCeil;
+        builtins["sqrt"] = &Interpreter::builtinSqrt;
+        builtins["sin"] = &Interpreter::builtinSin;
+        builtins["cos"] = &Interpreter::builtinCos;
+        builtins["tan"] = &Interpreter::builtinTan;
+        builtins["asin"] = &Interpreter::builtinAsin;
+        builtins["acos"] = &Interpreter::builtinAcos;
+        builtins["atan"] = &Interpreter::builtinAtan;
+        builtins["type"] = &Interpreter::builtinType;
+        builtins["filter"] = &Interpreter::builtinFilter;
+        builtins["objectHasEx"] = &Interpreter::builtinObjectHasEx;
+        builtins["length"] = &Interpreter::builtinLength;
+        builtins["objectFieldsEx"] = &Interpreter::builtinObjectFieldsEx;
+        builtins["codepoint"] = &Interpreter::builtinCodepoint;
+        builtins["char"] = &Interpreter::builtinChar;
+        builtins["log"] = &Interpreter::builtinLog;
+        builtins["exp"] = &Interpreter::builtinExp;
+        builtins["mantissa"] = &Interpreter::builtinMantissa;
+        builtins["exponent"] = &Interpreter::builtinExponent;
+        builtins["modulo"] = &Interpreter::builtinModulo;
+        builtins["extVar"] = &Interpreter::builtinExtVar;
+        builtins["primitiveEquals"] = &Interpreter::builtinPrimitiveEquals;
+        builtins["native"] = &Interpreter::builtinNative;
+        builtins["md5"] = &Interpreter::builtinMd5;
+        builtins["trace"] = &Interpreter::builtinTrace;
+        builtins["splitLimit"] = &Interpreter::builtinSplitLimit;
+        builtins["substr"] = &Interpreter::builtinSubstr;
+        builtins["range"] = &Interpreter::builtinRange;
+        builtins["strReplace"] = &Interpreter::builtinStrReplace;
+        builtins["asciiLower"] = &Interpreter::builtinAsciiLower;
+        builtins["asciiUpper"] = &Interpreter::builtinAsciiUpper;
+        builtins["join"] = &Interpreter::builtinJoin;
+        builtins["parseJson"] = &Interpreter::builtinParseJson;
+        builtins["encodeUTF8"] = &Interpreter::builtinEncodeUTF8;
+        builtins["decodeUTF8"] = &Interpreter::builtinDecodeUTF8;
+        builtins["sortImpl"] = &Interpreter::builtinSortImpl;
+        builtins["uniqImpl"] = &Interpreter::builtinUniqImpl;
+        builtins["setUnionImpl"] = &Interpreter::builtinSetUnionImpl;
+        builtins["setInterImpl"] = &Interpreter::builtinSetInterImpl;
+        builtins["setDiffImpl"] = &Interpreter::builtinSetDiffImpl;
+        builtins["format"] = &Interpreter::builtinFormat;
+        builtins["escapeStringJson"] = &Interpreter::builtinEscapeStringJson;
+        builtins["manifestJsonEx"] = &Interpreter::builtinManifestJsonEx;
+        builtins["manifestYamlDocImpl"] = &Interpreter::builtinManifestYamlDocImpl;
+        builtins["manifestYamlStreamImpl"] = &Interpreter::builtinManifestYamlStreamImpl;
+
+        BuiltinTable table;
+        for (unsigned long c = 0; c <= jsonnet_max_builtin(); ++c) {
+            std::string name = encode_utf8(jsonnet_builtin_decl(c).name);
+            auto it = builtins.find(name);
+            if (it == builtins.end()) {
+                std::cerr << "INTERNAL ERROR: Unimplemented builtin: " << name << std::endl;
+                std::abort();
+            }
+            table.push_back(it->second);
+        }
+        return table;
     }
 
-    /** Create an object on the heap, maybe collect garbage.
-     * \param T Something under HeapEntity
+    /** The table of builtins, which is the same for every interpreter. */
+    static const BuiltinTable &builtinTable(void)
+    {
+        static const BuiltinTable table = makeBuiltinTable();
+        return table;
+    }
+
+    RuntimeError makeError(const LocationRange &loc, const std::string &msg)
+    {
+        return stack.makeError(loc, msg);
+    }
+
+    /** Create an object on the heap, maybe collect garbage.
+     * \param T Something under HeapEntity
      * \returns The new object
      */
     template <class T, class... Args>
     T *makeHeap(Args &&... args)
     {
         T *r = heap.makeEntity<T, Args...>(std::forward<Args>(args)...);
-        if (heap.checkHeap()) {  // Do a GC cycle?
+        countAllocation(r->type);
+        if (heap.checkHeap(stack.size())) {  // Do a GC cycle?
+            cache.stats.gc_cycles++;
+            VmTimer mark_timer(cache.stats.gc_mark_seconds);
+            if (heap.startCollection())
+                cache.stats.gc_minor_cycles++;
+
             // Avoid the object we just made being collected.
             heap.markFrom(r);
 
@@ -548,12 +1038,83 @@ class Interpreter {
                     heap.markFrom(thunk);
             }
 
+            // Mark from external values
+            for (const auto &pair : externalValues) {
+                if (pair.second != nullptr)
+                    heap.markFrom(pair.second);
+            }
+
+            // Mark from the closures of builtins and the thunks of literals
+            for (HeapClosure *closure : builtinClosures) {
+                if (closure != nullptr)
+                    heap.markFrom(closure);
+            }
+            for (const auto &pair : literalThunks) {
+                if (pair.second != nullptr)
+                    heap.markFrom(pair.second);
+            }
+            mark_timer.stop();
+
             // Delete unreachable objects.
+            VmTimer sweep_timer(cache.stats.gc_sweep_seconds);
             heap.sweep();
         }
         return r;
     }
 
+    void countAllocation(HeapEntity::Type type)
+    {
+        JsonnetStats &stats = cache.stats;
+        switch (type) {
+            case HeapEntity::THUNK: stats.heap_thunks++; break;
+            case HeapEntity::ARRAY: stats.heap_arrays++; break;
+            case HeapEntity::CLOSURE: stats.heap_closures++; break;
+            case HeapEntity::STRING: stats.heap_strings++; break;
+            case HeapEntity::SIMPLE_OBJECT: stats.heap_simple_objects++; break;
+            case HeapEntity::COMPREHENSION_OBJECT: stats.heap_comprehension_objects++; break;
+            case HeapEntity::EXTENDED_OBJECT: stats.heap_extended_objects++; break;
+        }
+        if (heap.size() > stats.max_heap_entities)
+            stats.max_heap_entities = heap.size();
+    }
+
+    /** Lex, parse and desugar code met during execution, counting the time taken. */
+    AST *parseCode(Allocator *a, const std::string &filename, const std::string &code)
+    {
+        JsonnetStats &stats = cache.stats;
+        Tokens tokens;
+        {
+            VmTimer timer(stats.lex_seconds);
+            tokens = jsonnet_lex(filename, code.c_str());
+        }
+        AST *expr;
+        {
+            VmTimer timer(stats.parse_seconds);
+            expr = jsonnet_parse(a, tokens);
+        }
+        VmTimer timer(stats.desugar_seconds);
+        jsonnet_desugar(a, expr, nullptr);
+        return expr;
+    }
+
+    /** Statically analyse and optimize code met during execution, counting the time taken.
+     *
+     * New ASTs are allocated with a, which must be the allocator of expr.
+     */
+    void analyseCode(Allocator *a, AST *&expr, const Identifiers &globals)
+    {
+        VmTimer timer(cache.stats.static_analysis_seconds);
+        jsonnet_static_analysis(expr, globals);
+        jsonnet_static_optimize(a, expr);
+    }
+
+    /** Record the stack depth reached so far in the statistics. */
+    void recordStackDepth(void)
+    {
+        if (stack.maxDepth() > cache.stats.max_stack_depth)
+            cache.stats.max_stack_depth = stack.maxDepth();
+    }
+
     Value makeBoolean(bool v)
     {
         Value r;
@@ -611,18 +1172,54 @@ class Interpreter {
         for (const auto &p : params) {
             hc_params.emplace_back(alloc->makeIdentifier(decode_utf8(p)), nullptr);
         }
-        return makeBuiltin(name, hc_params);
+        return makeBuiltin(HeapClosure::NO_BUILTIN, name, hc_params);
     }
 
-    Value makeBuiltin(const std::string &name, const HeapClosure::Params &params)
+    Value makeBuiltin(unsigned long builtin, const std::string &name,
+                      const HeapClosure::Params &params)
     {
         AST *body = nullptr;
         Value r;
         r.t = Value::FUNCTION;
-        r.v.h = makeHeap<HeapClosure>(BindingFrame(), nullptr, 0, params, body, name);
+        r.v.h = makeHeap<HeapClosure>(BindingFrame(), nullptr, 0, params, body, name, builtin);
         return r;
     }
 
+    /** A thunk for the expression that can be shared instead of allocating one, or nullptr.
+     *
+     * A variable is already bound to a thunk, which gives the same value and errors as a new thunk
+     * that evaluates the variable.  A literal that cannot fail is evaluated once into a filled
+     * thunk.  Neither needs an environment to be captured, nor a frame to be forced.
+     */
+    HeapThunk *sharedThunk(const AST *expr)
+    {
+        if (expr->type == AST_VAR)
+            return stack.lookUpVar(static_cast<const Var *>(expr)->id);
+        if (!jsonnet_static_is_literal(expr))
+            return nullptr;
+        HeapThunk *&thunk = literalThunks[expr];
+        if (thunk != nullptr)
+            return thunk;
+        // Bind it before making its value, which may collect garbage.
+        thunk = makeHeap<HeapThunk>(nullptr, nullptr, 0, expr);
+        Value v;
+        switch (expr->type) {
+            case AST_LITERAL_BOOLEAN:
+                v = makeBoolean(static_cast<const LiteralBoolean *>(expr)->value);
+                break;
+            case AST_LITERAL_NUMBER:
+                v = makeNumber(static_cast<const LiteralNumber *>(expr)->value);
+                break;
+            case AST_LITERAL_STRING:
+                v = makeString(static_cast<const LiteralString *>(expr)->value);
+                break;
+            default: v = makeNull(); break;
+        }
+        thunk->fill(v);
+        heap.remember(thunk);
+        return thunk;
+    }
+
     template <class T, class... Args>
     Value makeObject(Args... args)
     {
@@ -640,6 +1237,51 @@ class Interpreter {
         return r;
     }
 
+    /** Concatenate two strings.
+     *
+     * Long results are rope nodes, so that building a string piece by piece does not copy the
+     * pieces over and over.  Short ones are copied right away, as a rope would cost more than it
+     * saves.
+     */
+    Value makeStringConcat(const HeapString *a, const HeapString *b)
+    {
+        if (a->length + b->length <= ROPE_MIN_LENGTH)
+            return makeString(a->value() + b->value());
+        Value r;
+        r.t = Value::STRING;
+        if (b->length == 0)
+            r.v.h = const_cast<HeapString *>(a);
+        else if (a->length == 0)
+            r.v.h = const_cast<HeapString *>(b);
+        else
+            r.v.h = makeHeap<HeapString>(a, b);
+        return r;
+    }
+
+    /** Concatenate two arrays.
+     *
+     * As with strings, long results are concatenation nodes and short ones are copied right away.
+     */
+    Value makeArrayConcat(HeapArray *a, HeapArray *b)
+    {
+        if (a->size() + b->size() <= ARRAY_CONCAT_MIN_LENGTH) {
+            std::vector<HeapThunk *> elements;
+            elements.reserve(a->size() + b->size());
+            elements.insert(elements.end(), a->elements().begin(), a->elements().end());
+            elements.insert(elements.end(), b->elements().begin(), b->elements().end());
+            return makeArray(elements);
+        }
+        Value r;
+        r.t = Value::ARRAY;
+        if (b->size() == 0)
+            r.v.h = a;
+        else if (a->size() == 0)
+            r.v.h = b;
+        else
+            r.v.h = makeHeap<HeapArray>(a, b);
+        return r;
+    }
+
     /** Auxiliary function of objectIndex.
      *
      * Traverse the object's tree from right to left, looking for an object
@@ -736,13 +1378,28 @@ class Interpreter {
     {
         ImportCacheValue *input = importString(loc, file);
         if (input->thunk == nullptr) {
-            Tokens tokens = jsonnet_lex(input->foundHere, input->content.c_str());
-            AST *expr = jsonnet_parse(alloc, tokens);
-            jsonnet_desugar(alloc, expr, nullptr);
-            jsonnet_static_analysis(expr);
+            // Only parse the file if it changed since it was last parsed with this cache.
+            VmCachedImport &cached = cache.imports[input->foundHere];
+            if (cached.expr == nullptr || cached.content != input->content) {
+                cache.stats.import_cache_misses++;
+                std::unique_ptr<Allocator> alloc(new Allocator(&cache.alloc));
+                AST *expr = parseCode(alloc.get(), input->foundHere, input->content);
+                analyseCode(alloc.get(), expr, {idStd});
+                if (cached.alloc != nullptr)
+                    cache.replacedImports.push_back(std::move(cached.alloc));
+                cached.alloc = std::move(alloc);
+                cached.content = input->content;
+                cached.expr = expr;
+            } else {
+                cache.stats.import_cache_hits++;
+            }
             // If no errors then populate cache.
-            auto *thunk = makeHeap<HeapThunk>(idImport, nullptr, 0, expr);
+            auto *thunk = makeHeap<HeapThunk>(idImport, nullptr, 0, cached.expr);
+            thunk->upValues[idStd] = stdThunk;
+            heap.remember(thunk);
             input->thunk = thunk;
+        } else {
+            cache.stats.import_cache_hits++;
         }
         return input->thunk;
     }
@@ -797,10 +1454,12 @@ class Interpreter {
     /** Capture the required variables from the environment. */
     BindingFrame capture(const std::vector<const Identifier *> &free_vars)
     {
+        // Static analysis lists free variables in identifier order.
         BindingFrame env;
+        env.reserve(free_vars.size());
         for (auto fv : free_vars) {
             auto *th = stack.lookUpVar(fv);
-            env[fv] = th;
+            env.append(fv, th);
         }
         return env;
     }
@@ -825,67 +1484,57 @@ class Interpreter {
      *
      * \param loc The location range of the file to be executed.
      */
-    Interpreter(Allocator *alloc, const ExtMap &ext_vars, unsigned max_stack, double gc_min_objects,
-                double gc_growth_trigger, const VmNativeCallbackMap &native_callbacks,
+    Interpreter(Allocator *alloc, VmCache &cache, const ExtMap &ext_vars, unsigned max_stack,
+                double gc_min_objects, double gc_growth_trigger, double gc_nursery_objects,
+                const VmNativeCallbackMap &native_callbacks,
                 JsonnetImportCallback *import_callback, void *import_callback_context)
 
-        : heap(gc_min_objects, gc_growth_trigger),
+        : heap(gc_min_objects, gc_growth_trigger, gc_nursery_objects),
           stack(max_stack),
           alloc(alloc),
+          cache(cache),
+          idStd(alloc->makeIdentifier(U"$std")),
           idImport(alloc->makeIdentifier(U"import")),
           idArrayElement(alloc->makeIdentifier(U"array_element")),
           idInvariant(alloc->makeIdentifier(U"object_assert")),
           idJsonObjVar(alloc->makeIdentifier(U"_")),
           jsonObjVar(alloc->make<Var>(LocationRange(), Fodder{}, idJsonObjVar)),
+          idKeyF(alloc->makeIdentifier(U"$keyF")),
+          idKeyArg(alloc->makeIdentifier(U"$key_arg")),
+          idKeyA(alloc->makeIdentifier(U"$key_a")),
+          idKeyB(alloc->makeIdentifier(U"$key_b")),
+          equalsCall(nullptr),
+          builtinClosures(jsonnet_max_builtin() + 1, nullptr),
           externalVars(ext_vars),
           nativeCallbacks(native_callbacks),
           importCallback(import_callback),
-          importCallbackContext(import_callback_context)
+          importCallbackContext(import_callback_context),
+          builtins(builtinTable())
     {
         scratch = makeNull();
-        builtins["makeArray"] = &Interpreter::builtinMakeArray;
-        builtins["pow"] = &Interpreter::builtinPow;
-        builtins["floor"] = &Interpreter::builtinFloor;
-        builtins["ceil"] = &Interpreter::builtinCeil;
-        builtins["sqrt"] = &Interpreter::builtinSqrt;
-        builtins["sin"] = &Interpreter::builtinSin;
-        builtins["cos"] = &Interpreter::builtinCos;
-        builtins["tan"] = &Interpreter::builtinTan;
-        builtins["asin"] = &Interpreter::builtinAsin;
-        builtins["acos"] = &Interpreter::builtinAcos;
-        builtins["atan"] = &Interpreter::builtinAtan;
-        builtins["type"] = &Interpreter::builtinType;
-        builtins["filter"] = &Interpreter::builtinFilter;
-        builtins["objectHasEx"] = &Interpreter::builtinObjectHasEx;
-        builtins["length"] = &Interpreter::builtinLength;
-        builtins["objectFieldsEx"] = &Interpreter::builtinObjectFieldsEx;
-        builtins["codepoint"] = &Interpreter::builtinCodepoint;
-        builtins["char"] = &Interpreter::builtinChar;
-        builtins["log"] = &Interpreter::builtinLog;
-        builtins["exp"] = &Interpreter::builtinExp;
-        builtins["mantissa"] = &Interpreter::builtinMantissa;
-        builtins["exponent"] = &Interpreter::builtinExponent;
-        builtins["modulo"] = &Interpreter::builtinModulo;
-        builtins["extVar"] = &Interpreter::builtinExtVar;
-        builtins["primitiveEquals"] = &Interpreter::builtinPrimitiveEquals;
-        builtins["native"] = &Interpreter::builtinNative;
-        builtins["md5"] = &Interpreter::builtinMd5;
-        builtins["trace"] = &Interpreter::builtinTrace;
-        builtins["splitLimit"] = &Interpreter::builtinSplitLimit;
-        builtins["substr"] = &Interpreter::builtinSubstr;
-        builtins["range"] = &Interpreter::builtinRange;
-        builtins["strReplace"] = &Interpreter::builtinStrReplace;
-        builtins["asciiLower"] = &Interpreter::builtinAsciiLower;
-        builtins["asciiUpper"] = &Interpreter::builtinAsciiUpper;
-        builtins["join"] = &Interpreter::builtinJoin;
-        builtins["parseJson"] = &Interpreter::builtinParseJson;
-        builtins["encodeUTF8"] = &Interpreter::builtinEncodeUTF8;
-        builtins["decodeUTF8"] = &Interpreter::builtinDecodeUTF8;
+
+        // Build the std object once and leave it bound to $std at the bottom of the stack.
+        evaluate(shared_stdlib().expr, 0);
+        stdThunk = makeHeap<HeapThunk>(idStd, nullptr, 0, nullptr);
+        stdThunk->fill(scratch);
+        heap.remember(stdThunk);
+        stack.newFrame(FRAME_LOCAL, LocationRange());
+        stack.top().bindings[idStd] = stdThunk;
+        cache.interpreters++;
+    }
+
+    /** The size of the stack when nothing is being executed. */
+    unsigned baseStackSize(void)
+    {
+        return 1;
     }
 
     /** Clean up the heap, stack, stash, and builtin function ASTs. */
     ~Interpreter()
     {
+        recordStackDepth();
+        if (--cache.interpreters == 0)
+            cache.replacedImports.clear();
         for (const auto &pair : cachedImports) {
             delete pair.second;
         }
@@ -957,6 +1606,8 @@ class Interpreter {
             auto *el = makeHeap<HeapThunk>(func->params[0].id, nullptr, 0, nullptr);
             el->fill(makeNumber(i));  // i guaranteed not to be inf/NaN
             th->upValues[func->params[0].id] = el;
+            // th may have become old while el was made.
+            heap.remember(th);
             elements[i] = th;
         }
         scratch = makeArray(elements);
@@ -1062,7 +1713,7 @@ class Interpreter {
         if (func->params.size() != 1) {
             throw makeError(loc, "filter function takes 1 parameter.");
         }
-        if (arr->elements.size() == 0) {
+        if (arr->size() == 0) {
             scratch = makeArray({});
         } else {
             f.kind = FRAME_BUILTIN_FILTER;
@@ -1071,10 +1722,11 @@ class Interpreter {
             f.thunks.clear();
             f.elementId = 0;
 
-            auto *thunk = arr->elements[f.elementId];
-            BindingFrame bindings = func->upValues;
-            bindings[func->params[0].id] = thunk;
-            stack.newCall(loc, func, func->self, func->offset, bindings);
+            auto *thunk = arr->elements()[f.elementId];
+            BindingFrame bindings;
+            bindings.append(func->params[0].id, thunk);
+            stack.newCall(
+                loc, func, func->self, func->offset, &func->upValues, std::move(bindings));
             return func->body;
         }
         return nullptr;
@@ -1089,7 +1741,7 @@ class Interpreter {
         bool include_hidden = args[2].v.b;
         bool found = false;
         for (const auto &field : objectFields(obj, !include_hidden)) {
-            if (field->name == str->value) {
+            if (field->name == str->value()) {
                 found = true;
                 break;
             }
@@ -1111,11 +1763,11 @@ class Interpreter {
             } break;
 
             case Value::ARRAY:
-                scratch = makeNumber(static_cast<HeapArray *>(e)->elements.size());
+                scratch = makeNumber(static_cast<HeapArray *>(e)->size());
                 break;
 
             case Value::STRING:
-                scratch = makeNumber(static_cast<HeapString *>(e)->value.length());
+                scratch = makeNumber(static_cast<HeapString *>(e)->length);
                 break;
 
             case Value::FUNCTION:
@@ -1142,11 +1794,13 @@ class Interpreter {
             fields.insert(field->name);
         }
         scratch = makeArray({});
-        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
+        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements();
         for (const auto &field : fields) {
             auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
             elements.push_back(th);
             th->fill(makeString(field));
+            heap.remember(th);
+            heap.remember(scratch.v.h);
         }
         return nullptr;
     }
@@ -1154,13 +1808,13 @@ class Interpreter {
     const AST *builtinCodepoint(const LocationRange &loc, const std::vector<Value> &args)
     {
         validateBuiltinArgs(loc, "codepoint", args, {Value::STRING});
-        const UString &str = static_cast<HeapString *>(args[0].v.h)->value;
+        const UString &str = static_cast<HeapString *>(args[0].v.h)->value();
         if (str.length() != 1) {
             std::stringstream ss;
             ss << "codepoint takes a string of length 1, got length " << str.length();
             throw makeError(loc, ss.str());
         }
-        char32_t c = static_cast<HeapString *>(args[0].v.h)->value[0];
+        char32_t c = static_cast<HeapString *>(args[0].v.h)->value()[0];
         scratch = makeNumber((unsigned long)(c));
         return nullptr;
     }
@@ -1230,7 +1884,7 @@ class Interpreter {
     const AST *builtinExtVar(const LocationRange &loc, const std::vector<Value> &args)
     {
         validateBuiltinArgs(loc, "extVar", args, {Value::STRING});
-        const UString &var = static_cast<HeapString *>(args[0].v.h)->value;
+        const UString &var = static_cast<HeapString *>(args[0].v.h)->value();
         std::string var8 = encode_utf8(var);
         auto it = externalVars.find(var8);
         if (it == externalVars.end()) {
@@ -1240,12 +1894,24 @@ class Interpreter {
         const VmExt &ext = it->second;
         if (ext.isCode) {
             std::string filename = "<extvar:" + var8 + ">";
-            Tokens tokens = jsonnet_lex(filename, ext.data.c_str());
-            AST *expr = jsonnet_parse(alloc, tokens);
-            jsonnet_desugar(alloc, expr, nullptr);
-            jsonnet_static_analysis(expr);
+            AST *expr = parseCode(alloc, filename, ext.data);
+            analyseCode(alloc, expr, {idStd});
             stack.pop();
+            // Execute it in a fresh environment that only binds the stdlib.
+            auto *thunk = makeHeap<HeapThunk>(nullptr, nullptr, 0, expr);
+            thunk->upValues[idStd] = stdThunk;
+            heap.remember(thunk);
+            stack.newCall(loc, thunk, nullptr, 0, &thunk->upValues);
             return expr;
+        } else if (ext.value != nullptr) {
+            // Made once, as the value may be large.
+            HeapThunk *&thunk = externalValues[var8];
+            if (thunk == nullptr) {
+                thunk = makeHeap<HeapThunk>(nullptr, nullptr, 0, nullptr);
+                jsonToHeap(ext.value.get(), thunk->filled, thunk->content);
+            }
+            scratch = thunk->content;
+            return nullptr;
         } else {
             scratch = makeString(decode_utf8(ext.data));
             return nullptr;
@@ -1270,8 +1936,8 @@ class Interpreter {
             case Value::NUMBER: r = args[0].v.d == args[1].v.d; break;
 
             case Value::STRING:
-                r = static_cast<HeapString *>(args[0].v.h)->value ==
-                    static_cast<HeapString *>(args[1].v.h)->value;
+                r = static_cast<HeapString *>(args[0].v.h)->value() ==
+                    static_cast<HeapString *>(args[1].v.h)->value();
                 break;
 
             case Value::NULL_TYPE: r = true; break;
@@ -1292,7 +1958,7 @@ class Interpreter {
     {
         validateBuiltinArgs(loc, "native", args, {Value::STRING});
 
-        std::string builtin_name = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+        std::string builtin_name = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
 
         VmNativeCallbackMap::const_iterator nit = nativeCallbacks.find(builtin_name);
         if (nit == nativeCallbacks.end()) {
@@ -1308,7 +1974,7 @@ class Interpreter {
     {
         validateBuiltinArgs(loc, "md5", args, {Value::STRING});
 
-        std::string value = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+        std::string value = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
 
         scratch = makeString(decode_utf8(md5(value)));
         return nullptr;
@@ -1318,14 +1984,16 @@ class Interpreter {
     {
         validateBuiltinArgs(loc, "encodeUTF8", args, {Value::STRING});
 
-        std::string byteString = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+        std::string byteString = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
 
         scratch = makeArray({});
-        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
+        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements();
         for (const auto c : byteString) {
             auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
             elements.push_back(th);
             th->fill(makeNumber(uint8_t(c)));
+            heap.remember(th);
+            heap.remember(scratch.v.h);
         }
         return nullptr;
     }
@@ -1333,7 +2001,8 @@ class Interpreter {
     const AST *decodeUTF8(void)
     {
         Frame &f = stack.top();
-        const auto& elements = static_cast<HeapArray*>(f.val.v.h)->elements;
+        std::string &bytes = stack.payload(f).bytes;
+        const auto& elements = static_cast<HeapArray*>(f.val.v.h)->elements();
         while (f.elementId < elements.size()) {
             auto *th = elements[f.elementId];
             if (th->filled) {
@@ -1341,23 +2010,23 @@ class Interpreter {
                 if (b.t != Value::NUMBER) {
                     std::stringstream ss;
                     ss << "Element " << f.elementId << " of the provided array was not a number";
-                    throw makeError(stack.top().location, ss.str());
+                    throw makeError(stack.top().location(), ss.str());
                 } else {
                     double d = b.v.d;
                     if (d < 0 || d > 255 || d != int(d)) {
                         std::stringstream ss;
                         ss << "Element " << f.elementId << " of the provided array was not an integer in range [0,255]";
-                        throw makeError(stack.top().location, ss.str());
+                        throw makeError(stack.top().location(), ss.str());
                     }
-                    f.bytes.push_back(uint8_t(d));
+                    bytes.push_back(uint8_t(d));
                 }
                 f.elementId++;
             } else {
-                stack.newCall(f.location, th, th->self, th->offset, th->upValues);
+                stack.newCall(f.location(), th, th->self, th->offset, &th->upValues);
                 return th->body;
             }
         }
-        scratch = makeString(decode_utf8(f.bytes));
+        scratch = makeString(decode_utf8(bytes));
         return nullptr;
     }
 
@@ -1368,169 +2037,966 @@ class Interpreter {
         Frame &f = stack.top();
         f.kind = FRAME_BUILTIN_DECODE_UTF8;
         f.val = args[0]; // arr
-        f.bytes.clear();
+        stack.payload(f).bytes.clear();
         f.elementId = 0;
         return decodeUTF8();
     }
 
-    const AST *builtinTrace(const LocationRange &loc, const std::vector<Value> &args)
+    /** Whether func is function(x) x, in which case the key of an element is its value. */
+    static bool isIdentity(const HeapClosure *func)
     {
-        if(args[0].t != Value::STRING) {
-            std::stringstream ss;
-            ss << "Builtin function trace expected string as first parameter but "
-               << "got " << type_str(args[0].t);
-            throw makeError(loc, ss.str());
-        }
-
-        std::string str = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
-        std::cerr << "TRACE: " << loc.file << ":" << loc.begin.line << " " <<  str
-            << std::endl;
-
-        scratch = args[1];
-        return nullptr;
+        if (func->body == nullptr || func->params.size() != 1 || func->body->type != AST_VAR)
+            return false;
+        return static_cast<const Var *>(func->body)->id == func->params[0].id;
     }
 
-    const AST *builtinSplitLimit(const LocationRange &loc, const std::vector<Value> &args)
+    /** Start computing the keys of the given elements with the key function keyF.
+     *
+     * Once computeKeys() has the keys of all elements, it completes the builtin according to
+     * kind, which must be one of the frame kinds handled by finishKeys().
+     */
+    const AST *startKeys(FrameKind kind, const Value &keyF, std::vector<HeapThunk *> elements)
     {
-        validateBuiltinArgs(loc, "splitLimit", args, {Value::STRING, Value::STRING, Value::NUMBER});
-        const auto *str = static_cast<const HeapString *>(args[0].v.h);
-        const auto *c = static_cast<const HeapString *>(args[1].v.h);
-        long maxsplits = long(args[2].v.d);
-        unsigned start = 0;
-        unsigned test = 0;
-        scratch = makeArray({});
-        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
-        while (test < str->value.size() && (maxsplits == -1 ||
-                                            size_t(maxsplits) > elements.size())) {
-            if (c->value[0] == str->value[test]) {
-                auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
-                elements.push_back(th);
-                th->fill(makeString(str->value.substr(start, test - start)));
-                start = test + 1;
-                test = start;
-            } else {
-                ++test;
+        Frame &f = stack.top();
+        auto *func = static_cast<HeapClosure *>(keyF.v.h);
+        f.kind = kind;
+        f.val = keyF;
+        f.thunks = std::move(elements);
+        std::vector<Value> &keys = stack.payload(f).values;
+        keys.clear();
+        keys.reserve(f.thunks.size());
+        if (func->body == nullptr || func->params.size() != 1) {
+            // Builtins and functions with default arguments are called like any function.
+            AST *&key_call = keyCalls[f.ast];
+            if (key_call == nullptr) {
+                // Calls of the builtin made without an AST share one, which has no location.
+                LocationRange loc = f.ast == nullptr ? LocationRange() : f.location();
+                ArgParams args;
+                args.emplace_back(alloc->make<Var>(loc, Fodder{}, idKeyArg), Fodder{});
+                key_call = alloc->make<Apply>(loc, Fodder{},
+                                              alloc->make<Var>(loc, Fodder{}, idKeyF), Fodder{},
+                                              args, false, Fodder{}, Fodder{}, false);
+                analyseCode(alloc, key_call, {idKeyF, idKeyArg});
             }
+            auto *th = makeHeap<HeapThunk>(idKeyF, nullptr, 0, nullptr);
+            th->fill(keyF);
+            f.bindings[idKeyF] = th;
         }
-        auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
-        elements.push_back(th);
-        th->fill(makeString(str->value.substr(start)));
-
-        return nullptr;
+        return computeKeys();
     }
 
-    const AST *builtinSubstr(const LocationRange &loc, const std::vector<Value> &args)
+    /** Compute the key of each thunk of the top frame, then finish its builtin.
+     *
+     * The key function is in f.val, the keys computed so far in the values of the frame's
+     * payload.  The frame's handler appends the result of each call to them.
+     */
+    const AST *computeKeys(void)
     {
-        validateBuiltinArgs(loc, "substr", args, {Value::STRING, Value::NUMBER, Value::NUMBER});
-        const auto *str = static_cast<const HeapString *>(args[0].v.h);
-        long from = long(args[1].v.d);
-        long len = long(args[2].v.d);
-        if (from < 0) {
-            std::stringstream ss;
-            ss << "substr second parameter should be greater than zero, got " << from;
-            throw makeError(loc, ss.str());
-        }
-        if (len < 0) {
-            std::stringstream ss;
-            ss << "substr third parameter should be greater than zero, got " << len;
-            throw makeError(loc, ss.str());
-        }
-        if (static_cast<unsigned long>(from) > str->value.size()) {
-            scratch = makeString(UString());
-            return nullptr;
-        }
-        if (size_t(len + from) > str->value.size()) {
-          len = str->value.size() - from;
+        Frame &f = stack.top();
+        auto *func = static_cast<HeapClosure *>(f.val.v.h);
+        bool identity = isIdentity(func);
+        std::vector<Value> &keys = stack.payload(f).values;
+        while (keys.size() < f.thunks.size()) {
+            auto *th = f.thunks[keys.size()];
+            if (identity) {
+                if (th->filled) {
+                    keys.push_back(th->content);
+                    continue;
+                }
+                stack.newCall(f.location(), th, th->self, th->offset, &th->upValues);
+                return th->body;
+            }
+            if (func->body == nullptr || func->params.size() != 1) {
+                BindingFrame bindings;
+                bindings[idKeyF] = f.bindings[idKeyF];
+                bindings[idKeyArg] = th;
+                stack.newCall(f.location(), func, nullptr, 0, bindings);
+                return keyCalls[f.ast];
+            }
+            BindingFrame bindings;
+            bindings.append(func->params[0].id, th);
+            stack.newCall(
+                f.location(), func, func->self, func->offset, &func->upValues, std::move(bindings));
+            return func->body;
         }
-        scratch = makeString(str->value.substr(from, len));
+        finishKeys();
         return nullptr;
     }
 
-    const AST *builtinRange(const LocationRange &loc, const std::vector<Value> &args)
+    /** Raise an error unless the keys can all be compared with each other using <.
+     *
+     * A sort of two or more elements compares every key with some other key, so this only raises
+     * the errors that lessKeys() would, but reports them in the order of the keys.
+     */
+    void validateKeys(const std::vector<Value> &keys)
     {
-        validateBuiltinArgs(loc, "range", args, {Value::NUMBER, Value::NUMBER});
-        long from = long(args[0].v.d);
-        long to = long(args[1].v.d);
-        long len = to - from + 1;
-        scratch = makeArray({});
-        if (len > 0) {
-            auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
-            for (int i = 0; i < len; ++i) {
-                auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
-                elements.push_back(th);
-                th->fill(makeNumber(from + i));
+        for (const Value &key : keys) {
+            if (key.t != Value::NUMBER && key.t != Value::STRING) {
+                throw makeError(stack.top().location(),
+                                "sort keys must be numbers or strings, got " + type_str(key));
+            }
+            if (key.t != keys[0].t) {
+                throw makeError(stack.top().location(),
+                                "sort keys must have matching types, got " + type_str(keys[0]) +
+                                    " and " + type_str(key));
             }
         }
-        return nullptr;
     }
 
-    const AST *builtinStrReplace(const LocationRange &loc, const std::vector<Value> &args)
+    /** Whether key a is less than key b, like the < operator.
+     *
+     * Raises an error unless both keys are numbers or both are strings.
+     */
+    bool lessKeys(const Value &a, const Value &b)
     {
-        validateBuiltinArgs(loc, "strReplace", args, {Value::STRING, Value::STRING, Value::STRING});
-        const auto *str = static_cast<const HeapString *>(args[0].v.h);
-        const auto *from = static_cast<const HeapString *>(args[1].v.h);
-        const auto *to = static_cast<const HeapString *>(args[2].v.h);
-        if (from->value.empty()) {
-          throw makeError(loc, "'from' string must not be zero length.");
-        }
-        UString new_str(str->value);
-        UString::size_type pos = 0;
-        while (pos < new_str.size()) {
-            auto index = new_str.find(from->value, pos);
-            if (index == new_str.npos) {
-                break;
+        for (const Value *key : {&a, &b}) {
+            if (key->t != Value::NUMBER && key->t != Value::STRING) {
+                throw makeError(stack.top().location(),
+                                "sort keys must be numbers or strings, got " + type_str(*key));
             }
-            new_str.replace(index, from->value.size(), to->value);
-            pos = index + to->value.size();
         }
-        scratch = makeString(new_str);
-        return nullptr;
+        if (a.t != b.t) {
+            throw makeError(stack.top().location(),
+                            "sort keys must have matching types, got " + type_str(a) + " and " +
+                                type_str(b));
+        }
+        if (a.t == Value::NUMBER)
+            return a.v.d < b.v.d;
+        return static_cast<const HeapString *>(a.v.h)->value() <
+               static_cast<const HeapString *>(b.v.h)->value();
     }
 
-    const AST *builtinAsciiLower(const LocationRange &loc, const std::vector<Value> &args)
+    /** Whether two keys are equal, like the == operator.
+     *
+     * Arrays and objects are compared by calling std.equals, like == does.
+     */
+    bool equalKeys(const Value &a, const Value &b)
     {
-        validateBuiltinArgs(loc, "asciiLower", args, {Value::STRING});
-        const auto *str = static_cast<const HeapString *>(args[0].v.h);
-        UString new_str(str->value);
-        for (size_t i = 0; i < new_str.size(); ++i) {
-            if (new_str[i] >= 'A' && new_str[i] <= 'Z') {
-                new_str[i] = new_str[i] - 'A' + 'a';
-            }
+        if (a.t != b.t)
+            return false;
+        switch (a.t) {
+            case Value::NULL_TYPE: return true;
+            case Value::BOOLEAN: return a.v.b == b.v.b;
+            case Value::NUMBER: return a.v.d == b.v.d;
+            case Value::STRING:
+                return static_cast<HeapString *>(a.v.h)->value() ==
+                       static_cast<HeapString *>(b.v.h)->value();
+            case Value::FUNCTION:
+                throw makeError(stack.top().location(), "cannot test equality of functions");
+            default: break;
         }
-        scratch = makeString(new_str);
-        return nullptr;
+        if (equalsCall == nullptr) {
+            LocationRange loc;
+            AST *equals = alloc->make<Index>(
+                loc, Fodder{}, alloc->make<Var>(loc, Fodder{}, idStd), Fodder{}, false,
+                alloc->make<LiteralString>(loc, Fodder{}, U"equals", LiteralString::DOUBLE, "", ""),
+                Fodder{}, nullptr, Fodder{}, nullptr, Fodder{});
+            ArgParams args;
+            args.emplace_back(alloc->make<Var>(loc, Fodder{}, idKeyA), Fodder{});
+            args.emplace_back(alloc->make<Var>(loc, Fodder{}, idKeyB), Fodder{});
+            equalsCall = alloc->make<Apply>(
+                loc, Fodder{}, equals, Fodder{}, args, false, Fodder{}, Fodder{}, false);
+            analyseCode(alloc, equalsCall, {idStd, idKeyA, idKeyB});
+        }
+        // Both keys are on the stack, in the frame's payload, so they survive garbage collection.
+        stack.newCall(stack.top().location(), nullptr, nullptr, 0, BindingFrame{});
+        stack.top().bindings[idStd] = stdThunk;
+        for (auto pair : {std::make_pair(idKeyA, &a), std::make_pair(idKeyB, &b)}) {
+            auto *th = makeHeap<HeapThunk>(pair.first, nullptr, 0, nullptr);
+            th->fill(*pair.second);
+            stack.top().bindings[pair.first] = th;
+        }
+        evaluate(equalsCall, stack.size());
+        stack.pop();
+        return scratch.v.b;
     }
 
-    const AST *builtinAsciiUpper(const LocationRange &loc, const std::vector<Value> &args)
+    /** Complete std.sort, std.uniq or a std.set* function once all keys are known. */
+    void finishKeys(void)
     {
-        validateBuiltinArgs(loc, "asciiUpper", args, {Value::STRING});
-        const auto *str = static_cast<const HeapString *>(args[0].v.h);
-        UString new_str(str->value);
-        for (size_t i = 0; i < new_str.size(); ++i) {
-            if (new_str[i] >= 'a' && new_str[i] <= 'z') {
-                new_str[i] = new_str[i] - 'a' + 'A';
+        Frame &f = stack.top();
+        const std::vector<Value> &keys = stack.payload(f).values;
+        std::vector<HeapThunk *> elements;
+        if (f.kind == FRAME_BUILTIN_SORT) {
+            validateKeys(keys);
+            std::vector<unsigned> order(keys.size());
+            for (unsigned i = 0; i < order.size(); ++i)
+                order[i] = i;
+            std::stable_sort(order.begin(), order.end(), [&](unsigned a, unsigned b) {
+                return lessKeys(keys[a], keys[b]);
+            });
+            elements.reserve(order.size());
+            for (unsigned i : order)
+                elements.push_back(f.thunks[i]);
+            scratch = makeArray(elements);
+            return;
+        }
+        // equalKeys() can push frames, which may move f, so what is needed of it is copied.
+        const FrameKind kind = f.kind;
+        const std::vector<HeapThunk *> thunks = f.thunks;
+        if (kind == FRAME_BUILTIN_UNIQ) {
+            elements.push_back(thunks[0]);
+            for (unsigned i = 1; i < keys.size(); ++i) {
+                if (!equalKeys(keys[i - 1], keys[i]))
+                    elements.push_back(thunks[i]);
+            }
+        } else {
+            // The elements of a are followed by those of b, starting at f.elementId.  Like the
+            // std.jsonnet code, keys are tested with == before they are ordered with <.
+            unsigned i = 0, j = f.elementId;
+            const unsigned a_end = f.elementId, b_end = thunks.size();
+            while (i < a_end && j < b_end) {
+                if (equalKeys(keys[i], keys[j])) {
+                    if (kind != FRAME_BUILTIN_SET_DIFF)
+                        elements.push_back(thunks[i]);
+                    i++;
+                    j++;
+                } else if (lessKeys(keys[i], keys[j])) {
+                    if (kind != FRAME_BUILTIN_SET_INTER)
+                        elements.push_back(thunks[i]);
+                    i++;
+                } else {
+                    if (kind == FRAME_BUILTIN_SET_UNION)
+                        elements.push_back(thunks[j]);
+                    j++;
+                }
             }
+            if (kind != FRAME_BUILTIN_SET_INTER)
+                elements.insert(elements.end(), thunks.begin() + i, thunks.begin() + a_end);
+            if (kind == FRAME_BUILTIN_SET_UNION)
+                elements.insert(elements.end(), thunks.begin() + j, thunks.end());
         }
-        scratch = makeString(new_str);
-        return nullptr;
+        scratch = makeArray(elements);
     }
 
-    const AST *builtinParseJson(const LocationRange &loc, const std::vector<Value> &args)
+    const AST *builtinSortImpl(const LocationRange &loc, const std::vector<Value> &args)
     {
-        validateBuiltinArgs(loc, "parseJson", args, {Value::STRING});
+        validateBuiltinArgs(loc, "sortImpl", args, {Value::ARRAY, Value::FUNCTION});
+        const auto &elements = static_cast<HeapArray *>(args[0].v.h)->elements();
+        if (elements.size() <= 1) {
+            scratch = args[0];
+            return nullptr;
+        }
+        return startKeys(FRAME_BUILTIN_SORT, args[1], elements);
+    }
 
-        std::string value = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value);
+    const AST *builtinUniqImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "uniqImpl", args, {Value::ARRAY, Value::FUNCTION});
+        const auto &elements = static_cast<HeapArray *>(args[0].v.h)->elements();
+        if (elements.size() <= 1) {
+            scratch = args[0];
+            return nullptr;
+        }
+        return startKeys(FRAME_BUILTIN_UNIQ, args[1], elements);
+    }
 
-        auto j = json::parse(value);
+    /** Implement one of std.setUnion, std.setInter, std.setDiff with linear merges. */
+    const AST *setOp(const LocationRange &loc, const std::string &name, FrameKind kind,
+                     const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, name, args, {Value::ARRAY, Value::ARRAY, Value::FUNCTION});
+        const auto &a = static_cast<HeapArray *>(args[0].v.h)->elements();
+        const auto &b = static_cast<HeapArray *>(args[1].v.h)->elements();
+        if (a.size() == 0 || b.size() == 0) {
+            if (kind == FRAME_BUILTIN_SET_UNION)
+                scratch = a.size() == 0 ? args[1] : args[0];
+            else if (kind == FRAME_BUILTIN_SET_DIFF)
+                scratch = args[0];
+            else
+                scratch = makeArray({});
+            return nullptr;
+        }
+        std::vector<HeapThunk *> elements = a;
+        elements.insert(elements.end(), b.begin(), b.end());
+        stack.top().elementId = a.size();
+        return startKeys(kind, args[2], std::move(elements));
+    }
 
-        bool filled;
+    const AST *builtinSetUnionImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        return setOp(loc, "setUnionImpl", FRAME_BUILTIN_SET_UNION, args);
+    }
 
-        otherJsonToHeap(j, filled, scratch);
+    const AST *builtinSetInterImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        return setOp(loc, "setInterImpl", FRAME_BUILTIN_SET_INTER, args);
+    }
 
-        return nullptr;
+    const AST *builtinSetDiffImpl(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        return setOp(loc, "setDiffImpl", FRAME_BUILTIN_SET_DIFF, args);
     }
 
-    void otherJsonToHeap(const json &v, bool &filled, Value &attach) {
+    /** Force a thunk from within a builtin, leaving its value in scratch.
+     *
+     * Like manifestJson, this can trigger a garbage collection cycle.
+     */
+    void forceThunk(const LocationRange &loc, HeapThunk *thunk)
+    {
+        if (thunk->filled) {
+            scratch = thunk->content;
+            return;
+        }
+        stack.newCall(loc, thunk, thunk->self, thunk->offset, &thunk->upValues);
+        evaluate(thunk->body, stack.size());
+        stack.pop();
+        thunk->fill(scratch);
+        heap.remember(thunk);
+    }
+
+    /** Parse a std.format string into its conversions.
+     *
+     * \param rest Set to the literal text after the last conversion.
+     */
+    std::vector<FormatCode> parseFormat(const LocationRange &loc, const UString &str,
+                                        UString &rest)
+    {
+        auto at = [&](size_t i) {
+            if (i >= str.length())
+                throw makeError(loc, "Truncated format code.");
+            return str[i];
+        };
+        std::vector<FormatCode> codes;
+        UString text;
+        size_t i = 0;
+        while (i < str.length()) {
+            char32_t c = str[i++];
+            if (c != U'%') {
+                text += c;
+                continue;
+            }
+            FormatCode code;
+            code.text = std::move(text);
+            text.clear();
+
+            at(i);
+            code.hasMkey = false;
+            if (str[i] == U'(') {
+                code.hasMkey = true;
+                for (++i; at(i) != U')'; ++i)
+                    code.mkey += str[i];
+                ++i;
+            }
+
+            code.alt = code.zero = code.left = code.blank = code.sign = false;
+            for (;; ++i) {
+                c = at(i);
+                if (c == U'#')
+                    code.alt = true;
+                else if (c == U'0')
+                    code.zero = true;
+                else if (c == U'-')
+                    code.left = true;
+                else if (c == U' ')
+                    code.blank = true;
+                else if (c == U'+')
+                    code.sign = true;
+                else
+                    break;
+            }
+
+            auto parse_width = [&](bool &star, double &v) {
+                star = false;
+                v = 0;
+                if (i < str.length() && str[i] == U'*') {
+                    star = true;
+                    ++i;
+                    return;
+                }
+                for (; at(i) >= U'0' && str[i] <= U'9'; ++i)
+                    v = v * 10 + (str[i] - U'0');
+            };
+            parse_width(code.fwStar, code.fw);
+
+            code.hasPrec = at(i) == U'.';
+            code.precStar = false;
+            code.prec = 0;
+            if (code.hasPrec) {
+                ++i;
+                parse_width(code.precStar, code.prec);
+            }
+
+            // Length modifiers are ignored.
+            c = at(i);
+            if (c == U'h' || c == U'l' || c == U'L')
+                ++i;
+
+            c = at(i++);
+            code.caps = false;
+            switch (c) {
+                case U'd':
+                case U'i':
+                case U'u': code.ctype = U'd'; break;
+                case U'o':
+                case U'x':
+                case U'e':
+                case U'f':
+                case U'g':
+                case U'c':
+                case U's':
+                case U'%': code.ctype = c; break;
+                case U'X':
+                case U'E':
+                case U'F':
+                case U'G':
+                    code.ctype = c - U'A' + U'a';
+                    code.caps = true;
+                    break;
+                default:
+                    throw makeError(loc,
+                                    "Unrecognised conversion type: " + encode_utf8(UString(1, c)));
+            }
+            codes.push_back(std::move(code));
+        }
+        rest = std::move(text);
+        return codes;
+    }
+
+    /** Add s to the left of str so that its length is at least w. */
+    static UString padLeft(const UString &str, double w, char32_t s)
+    {
+        UString r;
+        for (w -= str.length(); w > 0; w--)
+            r += s;
+        return r + str;
+    }
+
+    /** Add s to the right of str so that its length is at least w. */
+    static UString padRight(const UString &str, double w, char32_t s)
+    {
+        UString r = str;
+        for (w -= str.length(); w > 0; w--)
+            r += s;
+        return r;
+    }
+
+    /** The sign of a formatted number, or a blank, or nothing. */
+    static UString signPrefix(bool neg, bool blank, bool sign)
+    {
+        return neg ? U"-" : sign ? U"+" : blank ? U" " : U"";
+    }
+
+    /** Render an integer (e.g., decimal or octal). */
+    static UString renderInt(double n__, double min_chars, double min_digits, bool blank,
+                             bool sign, double radix, const UString &zero_prefix)
+    {
+        double n_ = n__ > 0 ? n__ : -n__;
+        UString dec = U"0";
+        if (std::floor(n_) != 0) {
+            UString digits;
+            for (double n = std::floor(n_); n != 0; n = std::floor(n / radix))
+                digits += U'0' + char32_t(std::fmod(n, radix));
+            dec = zero_prefix + UString(digits.rbegin(), digits.rend());
+        }
+        bool neg = n__ < 0;
+        double zp = min_chars - (neg || blank || sign ? 1 : 0);
+        double zp2 = zp > min_digits ? zp : min_digits;
+        return signPrefix(neg, blank, sign) + padLeft(dec, zp2, U'0');
+    }
+
+    /** Render an integer in hexadecimal. */
+    static UString renderHex(double n__, double min_chars, double min_digits, bool blank,
+                             bool sign, bool add_zerox, bool capitals)
+    {
+        const char32_t *numerals = capitals ? U"0123456789ABCDEF" : U"0123456789abcdef";
+        double n_ = n__ > 0 ? n__ : -n__;
+        UString hex = U"0";
+        if (std::floor(n_) != 0) {
+            UString digits;
+            for (double n = std::floor(n_); n != 0; n = std::floor(n / 16))
+                digits += numerals[int(std::fmod(n, 16))];
+            hex = UString(digits.rbegin(), digits.rend());
+        }
+        bool neg = n__ < 0;
+        double zp = min_chars - (neg || blank || sign ? 1 : 0) - (add_zerox ? 2 : 0);
+        double zp2 = zp > min_digits ? zp : min_digits;
+        UString zerox = add_zerox ? (capitals ? U"0X" : U"0x") : U"";
+        return signPrefix(neg, blank, sign) + zerox + padLeft(hex, zp2, U'0');
+    }
+
+    /** Render floating point in decimal form. */
+    UString renderFloatDec(const LocationRange &loc, double n__, double zero_pad, bool blank,
+                           bool sign, bool ensure_pt, bool trailing, double prec)
+    {
+        double n_ = n__ > 0 ? n__ : -n__;
+        double whole = std::floor(n_);
+        double dot_size = prec == 0 && !ensure_pt ? 0 : 1;
+        double zp = zero_pad - prec - dot_size;
+        double n_sign = n__ > 0 ? 1 : n__ < 0 ? -1 : 0;
+        UString str = renderInt(n_sign * whole, zp, 0, blank, sign, 10, U"");
+        if (prec == 0)
+            return ensure_pt ? str + U"." : str;
+        double scale = makeNumberCheck(loc, std::pow(10, prec)).v.d;
+        double frac = std::floor((n_ - whole) * scale + 0.5);
+        if (!trailing && frac <= 0)
+            return str;
+        UString frac_str = renderInt(frac, prec, 0, false, false, 10, U"");
+        if (!trailing) {
+            size_t end = frac_str.find_last_not_of(U'0');
+            frac_str = end == UString::npos ? U"" : frac_str.substr(0, end + 1);
+        }
+        return str + U"." + frac_str;
+    }
+
+    /** Render floating point in scientific form. */
+    UString renderFloatSci(const LocationRange &loc, double n__, double zero_pad, bool blank,
+                           bool sign, bool ensure_pt, bool trailing, bool caps, double prec)
+    {
+        double exponent =
+            n__ == 0 ? 0 : std::floor(std::log(n__ > 0 ? n__ : -n__) / std::log(10));
+        UString suff = (caps ? U"E" : U"e") + renderInt(exponent, 3, 0, false, true, 10, U"");
+        // Avoid a rounding error where std::pow(10, -324) is 0.  -324 is the smallest exponent
+        // possible.
+        double mantissa = exponent == -324 ? n__ * 10 / std::pow(10, exponent + 1)
+                                           : n__ / std::pow(10, exponent);
+        double zp2 = zero_pad - suff.length();
+        return renderFloatDec(loc, mantissa, zp2, blank, sign, ensure_pt, trailing, prec) + suff;
+    }
+
+    /** Field widths taken from the values are used in arithmetic, and fail as such. */
+    void checkFieldWidth(const LocationRange &loc, const Value &fw)
+    {
+        if (fw.t != Value::NUMBER) {
+            throw makeError(loc,
+                            "binary operator - requires matching types, got " + type_str(fw) +
+                                " and number.");
+        }
+    }
+
+    /** Render a value with a conversion of std.format.
+     *
+     * \param prec The precision, or null for the default.
+     * \param index Describes where val came from, for error messages.
+     */
+    UString formatCode(const LocationRange &loc, const Value &val, const FormatCode &code,
+                       const Value &fw, const Value &prec, const std::string &index)
+    {
+        if (code.ctype == U's') {
+            if (val.t == Value::STRING)
+                return static_cast<HeapString *>(val.v.h)->value();
+            scratch = val;
+            return toString(loc);
+        }
+        if (code.ctype == U'c') {
+            if (val.t == Value::NUMBER) {
+                builtinChar(loc, {val});
+                return static_cast<HeapString *>(scratch.v.h)->value();
+            }
+            if (val.t != Value::STRING)
+                throw makeError(loc, "%c expected number / string, got: " + type_str(val));
+            const UString &str = static_cast<HeapString *>(val.v.h)->value();
+            if (str.length() != 1) {
+                std::stringstream ss;
+                ss << "%c expected 1-sized string got: " << str.length();
+                throw makeError(loc, ss.str());
+            }
+            return str;
+        }
+        if (val.t != Value::NUMBER)
+            throw makeError(loc, "Format required number at " + index + ", got " + type_str(val));
+        if (prec.t != Value::NULL_TYPE && prec.t != Value::NUMBER)
+            throw makeError(loc, "Format required number at " + index + ", got " + type_str(prec));
+        double n = val.v.d;
+        bool has_prec = prec.t == Value::NUMBER;
+        double fpprec = has_prec ? prec.v.d : 6;
+        double iprec = has_prec ? prec.v.d : 0;
+        // %g chooses its form by the exponent, which fails for 0 before anything else.
+        double exponent = 0;
+        if (code.ctype == U'g') {
+            double log_abs = makeNumberCheck(loc, std::log(n > 0 ? n : -n)).v.d;
+            exponent = std::floor(log_abs / std::log(10));
+        }
+        double zp = 0;
+        if (code.zero && !code.left) {
+            checkFieldWidth(loc, fw);
+            zp = fw.v.d;
+        }
+        switch (code.ctype) {
+            case U'd': return renderInt(n, zp, iprec, code.blank, code.sign, 10, U"");
+
+            case U'o':
+                return renderInt(n, zp, iprec, code.blank, code.sign, 8, code.alt ? U"0" : U"");
+
+            case U'x': return renderHex(n, zp, iprec, code.blank, code.sign, code.alt, code.caps);
+
+            case U'f':
+                return renderFloatDec(loc, n, zp, code.blank, code.sign, code.alt, true, fpprec);
+
+            case U'e':
+                return renderFloatSci(
+                    loc, n, zp, code.blank, code.sign, code.alt, true, code.caps, fpprec);
+
+            default: {
+                // %g
+                if (exponent < -4 || exponent >= fpprec) {
+                    return renderFloatSci(loc, n, zp, code.blank, code.sign, code.alt, code.alt,
+                                          code.caps, fpprec - 1);
+                }
+                double digits_before_pt = exponent + 1 > 1 ? exponent + 1 : 1;
+                return renderFloatDec(loc, n, zp, code.blank, code.sign, code.alt, code.alt,
+                                      fpprec - digits_before_pt);
+            }
+        }
+    }
+
+    /** Render a format string with an array of values. */
+    UString formatArray(const LocationRange &loc, const std::vector<FormatCode> &codes,
+                        const UString &rest, const Value &vals)
+    {
+        // Anything other than an array is formatted as a single value.
+        HeapArray *arr = vals.t == Value::ARRAY ? static_cast<HeapArray *>(vals.v.h) : nullptr;
+        size_t size = arr == nullptr ? 1 : arr->size();
+        auto element = [&](size_t j) {
+            if (arr == nullptr)
+                return vals;
+            forceThunk(loc, arr->elements()[j]);
+            return scratch;
+        };
+        auto not_enough = [&](const char *expected, size_t j) {
+            std::stringstream ss;
+            ss << "Not enough values to format: " << size << ", expected " << expected << " "
+               << j;
+            return makeError(loc, ss.str());
+        };
+        UString r;
+        size_t j = 0;
+        for (const auto &code : codes) {
+            r += code.text;
+            Value fw = makeNumber(code.fw);
+            if (code.fwStar) {
+                if (j >= size)
+                    throw not_enough("at least", j);
+                fw = element(j);
+                j++;
+            }
+            // The precision is only forced after the value it applies to.
+            bool prec_element = code.precStar && j < size;
+            size_t prec_j = j;
+            if (code.precStar)
+                j++;
+            UString s = U"%";
+            if (code.ctype != U'%') {
+                if (j >= size)
+                    throw not_enough("more than", j);
+                Value val = element(j);
+                Value prec = makeNull();
+                if (prec_element && code.ctype != U's' && code.ctype != U'c')
+                    prec = element(prec_j);
+                else if (code.hasPrec && !code.precStar)
+                    prec = makeNumber(code.prec);
+                std::stringstream index;
+                index << j;
+                s = formatCode(loc, val, code, fw, prec, index.str());
+                j++;
+            }
+            checkFieldWidth(loc, fw);
+            r += code.left ? padRight(s, fw.v.d, U' ') : padLeft(s, fw.v.d, U' ');
+        }
+        if (j < size) {
+            std::stringstream ss;
+            ss << "Too many values to format: " << size << ", expected " << j;
+            throw makeError(loc, ss.str());
+        }
+        return r + rest;
+    }
+
+    /** Render a format string with an object of values. */
+    UString formatObject(const LocationRange &loc, const std::vector<FormatCode> &codes,
+                         const UString &rest, HeapObject *obj)
+    {
+        bool checked = false;
+        UString r;
+        for (const auto &code : codes) {
+            r += code.text;
+            if (code.fwStar)
+                throw makeError(loc, "Cannot use * field width with object.");
+            UString s = U"%";
+            if (code.ctype != U'%') {
+                if (!code.hasMkey)
+                    throw makeError(loc, "Mapping keys required.");
+                auto *fid = alloc->makeIdentifier(code.mkey);
+                unsigned found_at = 0;
+                if (findObject(fid, obj, 0, found_at) == nullptr)
+                    throw makeError(loc, "No such field: " + encode_utf8(code.mkey));
+                // Indexing the object checks its invariants.
+                if (!checked) {
+                    runInvariants(loc, obj);
+                    checked = true;
+                }
+                // pushes FRAME_CALL
+                const Value *cached;
+                const AST *body = objectIndex(loc, obj, fid, 0, cached);
+                if (cached == nullptr) {
+                    evaluate(body, stack.size());
+                    cacheField();
+                } else {
+                    scratch = *cached;
+                }
+                stack.pop();
+                Value val = scratch;
+                bool numeric = code.ctype != U's' && code.ctype != U'c';
+                if (code.precStar && numeric && val.t == Value::NUMBER)
+                    throw makeError(loc, "Cannot use * precision with object.");
+                Value prec = code.hasPrec && !code.precStar ? makeNumber(code.prec) : makeNull();
+                s = formatCode(
+                    loc, val, code, makeNumber(code.fw), prec, encode_utf8(code.mkey));
+            }
+            r += code.left ? padRight(s, code.fw, U' ') : padLeft(s, code.fw, U' ');
+        }
+        return r + rest;
+    }
+
+    const AST *builtinFormat(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        if (args[0].t != Value::STRING) {
+            std::stringstream ss;
+            ss << "Builtin function format expected string as first parameter but "
+               << "got " << type_str(args[0].t);
+            throw makeError(loc, ss.str());
+        }
+        UString rest;
+        auto codes = parseFormat(loc, static_cast<HeapString *>(args[0].v.h)->value(), rest);
+        UString r = args[1].t == Value::OBJECT
+                        ? formatObject(loc, codes, rest, static_cast<HeapObject *>(args[1].v.h))
+                        : formatArray(loc, codes, rest, args[1]);
+        scratch = makeString(r);
+        return nullptr;
+    }
+
+    const AST *builtinEscapeStringJson(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        UString str;
+        if (args[0].t == Value::STRING) {
+            str = static_cast<HeapString *>(args[0].v.h)->value();
+        } else {
+            scratch = args[0];
+            str = toString(loc);
+        }
+        scratch = makeString(jsonnet_string_unparse(str, false));
+        return nullptr;
+    }
+
+    const AST *builtinManifestJsonEx(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        if (args[1].t != Value::STRING) {
+            std::stringstream ss;
+            ss << "Builtin function manifestJsonEx expected string as second parameter but "
+               << "got " << type_str(args[1].t);
+            throw makeError(loc, ss.str());
+        }
+        const UString &indent = static_cast<HeapString *>(args[1].v.h)->value();
+        std::vector<UString> path;
+        scratch = args[0];
+        scratch = makeString(manifestJsonEx(loc, indent, U"", path));
+        return nullptr;
+    }
+
+    const AST *builtinManifestYamlDocImpl(const LocationRange &loc,
+                                          const std::vector<Value> &args)
+    {
+        if (args[1].t != Value::BOOLEAN) {
+            std::stringstream ss;
+            ss << "Builtin function manifestYamlDocImpl expected boolean as second parameter "
+               << "but got " << type_str(args[1].t);
+            throw makeError(loc, ss.str());
+        }
+        UString out;
+        std::vector<UString> path;
+        scratch = args[0];
+        manifestYaml(loc, args[1].v.b, U"", path, out);
+        scratch = makeString(out);
+        return nullptr;
+    }
+
+    const AST *builtinManifestYamlStreamImpl(const LocationRange &loc,
+                                             const std::vector<Value> &args)
+    {
+        if (args[0].t != Value::ARRAY) {
+            throw makeError(loc, "manifestYamlStream only takes arrays, got " + type_str(args[0]));
+        }
+        validateBuiltinArgs(loc,
+                            "manifestYamlStreamImpl",
+                            args,
+                            {Value::ARRAY, Value::BOOLEAN, Value::BOOLEAN});
+        UString out = U"---\n";
+        std::vector<UString> path;
+        const auto &elements = static_cast<HeapArray *>(args[0].v.h)->elements();
+        for (size_t i = 0; i < elements.size(); ++i) {
+            if (i > 0)
+                out += U"\n---\n";
+            forceThunk(loc, elements[i]);
+            manifestYaml(loc, args[1].v.b, U"", path, out);
+        }
+        out += args[2].v.b ? U"\n...\n" : U"\n";
+        scratch = makeString(out);
+        return nullptr;
+    }
+
+    const AST *builtinTrace(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        if(args[0].t != Value::STRING) {
+            std::stringstream ss;
+            ss << "Builtin function trace expected string as first parameter but "
+               << "got " << type_str(args[0].t);
+            throw makeError(loc, ss.str());
+        }
+
+        std::string str = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
+        std::cerr << "TRACE: " << loc.file << ":" << loc.begin.line << " " <<  str
+            << std::endl;
+
+        scratch = args[1];
+        return nullptr;
+    }
+
+    const AST *builtinSplitLimit(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "splitLimit", args, {Value::STRING, Value::STRING, Value::NUMBER});
+        const auto *str = static_cast<const HeapString *>(args[0].v.h);
+        const auto *c = static_cast<const HeapString *>(args[1].v.h);
+        long maxsplits = long(args[2].v.d);
+        unsigned start = 0;
+        unsigned test = 0;
+        scratch = makeArray({});
+        auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements();
+        while (test < str->value().size() && (maxsplits == -1 ||
+                                            size_t(maxsplits) > elements.size())) {
+            if (c->value()[0] == str->value()[test]) {
+                auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
+                elements.push_back(th);
+                th->fill(makeString(str->value().substr(start, test - start)));
+                heap.remember(th);
+                heap.remember(scratch.v.h);
+                start = test + 1;
+                test = start;
+            } else {
+                ++test;
+            }
+        }
+        auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
+        elements.push_back(th);
+        th->fill(makeString(str->value().substr(start)));
+        heap.remember(th);
+        heap.remember(scratch.v.h);
+
+        return nullptr;
+    }
+
+    const AST *builtinSubstr(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "substr", args, {Value::STRING, Value::NUMBER, Value::NUMBER});
+        const auto *str = static_cast<const HeapString *>(args[0].v.h);
+        long from = long(args[1].v.d);
+        long len = long(args[2].v.d);
+        if (from < 0) {
+            std::stringstream ss;
+            ss << "substr second parameter should be greater than zero, got " << from;
+            throw makeError(loc, ss.str());
+        }
+        if (len < 0) {
+            std::stringstream ss;
+            ss << "substr third parameter should be greater than zero, got " << len;
+            throw makeError(loc, ss.str());
+        }
+        if (static_cast<unsigned long>(from) > str->value().size()) {
+            scratch = makeString(UString());
+            return nullptr;
+        }
+        if (size_t(len + from) > str->value().size()) {
+          len = str->value().size() - from;
+        }
+        scratch = makeString(str->value().substr(from, len));
+        return nullptr;
+    }
+
+    const AST *builtinRange(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "range", args, {Value::NUMBER, Value::NUMBER});
+        long from = long(args[0].v.d);
+        long to = long(args[1].v.d);
+        long len = to - from + 1;
+        scratch = makeArray({});
+        if (len > 0) {
+            auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements();
+            for (int i = 0; i < len; ++i) {
+                auto *th = makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr);
+                elements.push_back(th);
+                th->fill(makeNumber(from + i));
+                heap.remember(th);
+                heap.remember(scratch.v.h);
+            }
+        }
+        return nullptr;
+    }
+
+    const AST *builtinStrReplace(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "strReplace", args, {Value::STRING, Value::STRING, Value::STRING});
+        const auto *str = static_cast<const HeapString *>(args[0].v.h);
+        const auto *from = static_cast<const HeapString *>(args[1].v.h);
+        const auto *to = static_cast<const HeapString *>(args[2].v.h);
+        if (from->value().empty()) {
+          throw makeError(loc, "'from' string must not be zero length.");
+        }
+        UString new_str(str->value());
+        UString::size_type pos = 0;
+        while (pos < new_str.size()) {
+            auto index = new_str.find(from->value(), pos);
+            if (index == new_str.npos) {
+                break;
+            }
+            new_str.replace(index, from->value().size(), to->value());
+            pos = index + to->value().size();
+        }
+        scratch = makeString(new_str);
+        return nullptr;
+    }
+
+    const AST *builtinAsciiLower(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "asciiLower", args, {Value::STRING});
+        const auto *str = static_cast<const HeapString *>(args[0].v.h);
+        UString new_str(str->value());
+        for (size_t i = 0; i < new_str.size(); ++i) {
+            if (new_str[i] >= 'A' && new_str[i] <= 'Z') {
+                new_str[i] = new_str[i] - 'A' + 'a';
+            }
+        }
+        scratch = makeString(new_str);
+        return nullptr;
+    }
+
+    const AST *builtinAsciiUpper(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "asciiUpper", args, {Value::STRING});
+        const auto *str = static_cast<const HeapString *>(args[0].v.h);
+        UString new_str(str->value());
+        for (size_t i = 0; i < new_str.size(); ++i) {
+            if (new_str[i] >= 'a' && new_str[i] <= 'z') {
+                new_str[i] = new_str[i] - 'a' + 'A';
+            }
+        }
+        scratch = makeString(new_str);
+        return nullptr;
+    }
+
+    const AST *builtinParseJson(const LocationRange &loc, const std::vector<Value> &args)
+    {
+        validateBuiltinArgs(loc, "parseJson", args, {Value::STRING});
+
+        std::string value = encode_utf8(static_cast<HeapString *>(args[0].v.h)->value());
+
+        auto j = json::parse(value);
+
+        bool filled;
+
+        otherJsonToHeap(j, filled, scratch);
+
+        return nullptr;
+    }
+
+    void otherJsonToHeap(const json &v, bool &filled, Value &attach) {
         // In order to not anger the garbage collector, assign to attach immediately after
         // making the heap object.
         switch (v.type()) {
@@ -1561,19 +3027,27 @@ class Interpreter {
                 filled = true;
                 auto *arr = static_cast<HeapArray *>(attach.v.h);
                 for (size_t i = 0; i < v.size(); ++i) {
-                    arr->elements.push_back(makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr));
-                    otherJsonToHeap(v[i], arr->elements[i]->filled, arr->elements[i]->content);
+                    arr->elements().push_back(
+                        makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr));
+                    heap.remember(arr);
+                    heap.remember(arr->elements()[i]);
+                    otherJsonToHeap(v[i], arr->elements()[i]->filled, arr->elements()[i]->content);
                 }
             } break;
 
             case json::value_t::object: {
                 attach = makeObject<HeapComprehensionObject>(
-                    BindingFrame{}, jsonObjVar, idJsonObjVar, BindingFrame{});
+                    BindingFrame{},
+                    jsonObjVar,
+                    idJsonObjVar,
+                    std::map<const Identifier *, HeapThunk *>{});
                 filled = true;
                 auto *obj = static_cast<HeapComprehensionObject *>(attach.v.h);
                 for (auto it = v.begin(); it != v.end(); ++it) {
                     auto *thunk = makeHeap<HeapThunk>(idJsonObjVar, nullptr, 0, nullptr);
                     obj->compValues[alloc->makeIdentifier(decode_utf8(it.key()))] = thunk;
+                    heap.remember(obj);
+                    heap.remember(thunk);
                     otherJsonToHeap(it.value(), thunk->filled, thunk->content);
                 }
             } break;
@@ -1592,30 +3066,31 @@ class Interpreter {
         if (elt.t != Value::STRING) {
             std::stringstream ss;
             ss << "expected string but arr[" << idx << "] was " << type_str(elt);
-            throw makeError(stack.top().location, ss.str());
+            throw makeError(stack.top().location(), ss.str());
         }
         if (!first) {
-            running.append(static_cast<HeapString *>(sep.v.h)->value);
+            running.append(static_cast<HeapString *>(sep.v.h)->value());
         }
         first = false;
-        running.append(static_cast<HeapString *>(elt.v.h)->value);
+        running.append(static_cast<HeapString *>(elt.v.h)->value());
     }
 
     const AST *joinStrings(void)
     {
         Frame &f = stack.top();
-        const auto& elements = static_cast<HeapArray*>(f.val2.v.h)->elements;
+        UString &str = stack.payload(f).str;
+        const auto& elements = static_cast<HeapArray*>(f.val2.v.h)->elements();
         while (f.elementId < elements.size()) {
             auto *th = elements[f.elementId];
             if (th->filled) {
-                joinString(f.first, f.str, f.val, f.elementId, th->content);
+                joinString(f.first, str, f.val, f.elementId, th->content);
                 f.elementId++;
             } else {
-                stack.newCall(f.location, th, th->self, th->offset, th->upValues);
+                stack.newCall(f.location(), th, th->self, th->offset, &th->upValues);
                 return th->body;
             }
         }
-        scratch = makeString(f.str);
+        scratch = makeString(str);
         return nullptr;
     }
 
@@ -1628,28 +3103,28 @@ class Interpreter {
         if (elt.t != Value::ARRAY) {
             std::stringstream ss;
             ss << "expected array but arr[" << idx << "] was " << type_str(elt);
-            throw makeError(stack.top().location, ss.str());
+            throw makeError(stack.top().location(), ss.str());
         }
         if (!first) {
-            auto& elts = static_cast<HeapArray *>(sep.v.h)->elements;
+            auto& elts = static_cast<HeapArray *>(sep.v.h)->elements();
             running.insert(running.end(), elts.begin(), elts.end());
         }
         first = false;
-        auto& elts = static_cast<HeapArray *>(elt.v.h)->elements;
+        auto& elts = static_cast<HeapArray *>(elt.v.h)->elements();
         running.insert(running.end(), elts.begin(), elts.end());
     }
 
     const AST *joinArrays(void)
     {
         Frame &f = stack.top();
-        const auto& elements = static_cast<HeapArray*>(f.val2.v.h)->elements;
+        const auto& elements = static_cast<HeapArray*>(f.val2.v.h)->elements();
         while (f.elementId < elements.size()) {
             auto *th = elements[f.elementId];
             if (th->filled) {
                 joinArray(f.first, f.thunks, f.val, f.elementId, th->content);
                 f.elementId++;
             } else {
-                stack.newCall(f.location, th, th->self, th->offset, th->upValues);
+                stack.newCall(f.location(), th, th->self, th->offset, &th->upValues);
                 return th->body;
             }
         }
@@ -1674,7 +3149,7 @@ class Interpreter {
             f.kind = FRAME_BUILTIN_JOIN_STRINGS;
             f.val = args[0];  // sep
             f.val2 = args[1];  // arr
-            f.str.clear();
+            stack.payload(f).str.clear();
             f.first = true;
             f.elementId = 0;
             return joinStrings();
@@ -1689,7 +3164,7 @@ class Interpreter {
         }
     }
 
-    void jsonToHeap(const std::unique_ptr<JsonnetJsonValue> &v, bool &filled, Value &attach)
+    void jsonToHeap(const JsonnetJsonValue *v, bool &filled, Value &attach)
     {
         // In order to not anger the garbage collector, assign to attach immediately after
         // making the heap object.
@@ -1719,21 +3194,29 @@ class Interpreter {
                 filled = true;
                 auto *arr = static_cast<HeapArray *>(attach.v.h);
                 for (size_t i = 0; i < v->elements.size(); ++i) {
-                    arr->elements.push_back(
+                    arr->elements().push_back(
                         makeHeap<HeapThunk>(idArrayElement, nullptr, 0, nullptr));
-                    jsonToHeap(v->elements[i], arr->elements[i]->filled, arr->elements[i]->content);
+                    heap.remember(arr);
+                    heap.remember(arr->elements()[i]);
+                    jsonToHeap(v->elements[i].get(), arr->elements()[i]->filled,
+                               arr->elements()[i]->content);
                 }
             } break;
 
             case JsonnetJsonValue::OBJECT: {
                 attach = makeObject<HeapComprehensionObject>(
-                    BindingFrame{}, jsonObjVar, idJsonObjVar, BindingFrame{});
+                    BindingFrame{},
+                    jsonObjVar,
+                    idJsonObjVar,
+                    std::map<const Identifier *, HeapThunk *>{});
                 filled = true;
                 auto *obj = static_cast<HeapComprehensionObject *>(attach.v.h);
                 for (const auto &pair : v->fields) {
                     auto *thunk = makeHeap<HeapThunk>(idJsonObjVar, nullptr, 0, nullptr);
                     obj->compValues[alloc->makeIdentifier(decode_utf8(pair.first))] = thunk;
-                    jsonToHeap(pair.second, thunk->filled, thunk->content);
+                    heap.remember(obj);
+                    heap.remember(thunk);
+                    jsonToHeap(pair.second.get(), thunk->filled, thunk->content);
                 }
             } break;
         }
@@ -1741,7 +3224,9 @@ class Interpreter {
 
     UString toString(const LocationRange &loc)
     {
-        return manifestJson(loc, false, U"");
+        std::string json;
+        manifestJson(loc, false, json);
+        return decode_utf8(json);
     }
 
     /** Recursively collect an object's invariants.
@@ -1762,6 +3247,7 @@ class Interpreter {
                 for (AST *assert : simp->asserts) {
                     auto *el_th = makeHeap<HeapThunk>(idInvariant, self, counter, assert);
                     el_th->upValues = simp->upValues;
+                    heap.remember(el_th);
                     thunks.push_back(el_th);
                 }
             }
@@ -1770,13 +3256,17 @@ class Interpreter {
     }
 
     /** Index an object's field.
+     *
+     * Pushes the call frame in which the field is evaluated.  If the field has been evaluated
+     * with this object as self before, the returned body must not be evaluated again.
      *
      * \param loc Location where the e.f occured.
      * \param obj The target
      * \param f The field
+     * \param cached Set to the value of the field, or nullptr if it has not been evaluated yet.
      */
     const AST *objectIndex(const LocationRange &loc, HeapObject *obj, const Identifier *f,
-                           unsigned offset)
+                           unsigned offset, const Value *&cached)
     {
         unsigned found_at = 0;
         HeapObject *self = obj;
@@ -1784,22 +3274,34 @@ class Interpreter {
         if (found == nullptr) {
             throw makeError(loc, "field does not exist: " + encode_utf8(f->name));
         }
+        const AST *body;
         if (auto *simp = dynamic_cast<HeapSimpleObject *>(found)) {
             auto it = simp->fields.find(f);
-            const AST *body = it->second.body;
+            body = it->second.body;
 
-            stack.newCall(loc, simp, self, found_at, simp->upValues);
-            return body;
+            stack.newCall(loc, simp, self, found_at, &simp->upValues);
         } else {
             // If a HeapLeafObject is not HeapSimpleObject, it must be HeapComprehensionObject.
             auto *comp = static_cast<HeapComprehensionObject *>(found);
             auto it = comp->compValues.find(f);
             auto *th = it->second;
-            BindingFrame binds = comp->upValues;
-            binds[comp->id] = th;
-            stack.newCall(loc, comp, self, found_at, binds);
-            return comp->value;
+            BindingFrame binds;
+            binds.append(comp->id, th);
+            stack.newCall(loc, comp, self, found_at, &comp->upValues, std::move(binds));
+            body = comp->value;
         }
+        stack.top().field = f;
+        auto it = self->fieldValues.find(std::make_pair(f, found_at));
+        cached = it == self->fieldValues.end() ? nullptr : &it->second;
+        return body;
+    }
+
+    /** Store scratch as the value of the field evaluated by the call frame at the top. */
+    void cacheField(void)
+    {
+        const Frame &f = stack.top();
+        f.self->fieldValues[std::make_pair(f.field, f.offset)] = scratch;
+        heap.remember(f.self);
     }
 
     void runInvariants(const LocationRange &loc, HeapObject *self)
@@ -1819,7 +3321,7 @@ class Interpreter {
         HeapThunk *thunk = thunks[0];
         stack.top().elementId = 1;
         stack.top().self = self;
-        stack.newCall(loc, thunk, thunk->self, thunk->offset, thunk->upValues);
+        stack.newCall(loc, thunk, thunk->self, thunk->offset, &thunk->upValues);
         evaluate(thunk->body, initial_stack_size);
     }
 
@@ -1853,11 +3355,16 @@ class Interpreter {
                 unsigned offset;
                 stack.getSelfBinding(self, offset);
                 scratch = makeArray({});
-                auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements;
+                auto &elements = static_cast<HeapArray *>(scratch.v.h)->elements();
                 for (const auto &el : ast.elements) {
-                    auto *el_th = makeHeap<HeapThunk>(idArrayElement, self, offset, el.expr);
-                    el_th->upValues = capture(el.expr->freeVariables);
+                    HeapThunk *el_th = sharedThunk(el.expr);
+                    if (el_th == nullptr) {
+                        el_th = makeHeap<HeapThunk>(idArrayElement, self, offset, el.expr);
+                        el_th->upValues = capture(el.expr->freeVariables);
+                        heap.remember(el_th);
+                    }
                     elements.push_back(el_th);
+                    heap.remember(scratch.v.h);
                 }
             } break;
 
@@ -1870,13 +3377,19 @@ class Interpreter {
 
             case AST_BUILTIN_FUNCTION: {
                 const auto &ast = *static_cast<const BuiltinFunction *>(ast_);
-                HeapClosure::Params params;
-                params.reserve(ast.params.size());
-                for (const auto &p : ast.params) {
-                    // None of the builtins have default args.
-                    params.emplace_back(p, nullptr);
+                HeapClosure *&closure = builtinClosures[ast.builtin];
+                if (closure == nullptr) {
+                    HeapClosure::Params params;
+                    params.reserve(ast.params.size());
+                    for (const auto &p : ast.params) {
+                        // None of the builtins have default args.
+                        params.emplace_back(p, nullptr);
+                    }
+                    Value v = makeBuiltin(ast.builtin, ast.name, params);
+                    closure = static_cast<HeapClosure *>(v.v.h);
                 }
-                scratch = makeBuiltin(ast.name, params);
+                scratch.t = Value::FUNCTION;
+                scratch.v.h = closure;
             } break;
 
             case AST_CONDITIONAL: {
@@ -1913,7 +3426,7 @@ class Interpreter {
                 if (thunk->filled) {
                     scratch = thunk->content;
                 } else {
-                    stack.newCall(ast.location, thunk, thunk->self, thunk->offset, thunk->upValues);
+                    stack.newCall(&ast, thunk, thunk->self, thunk->offset, &thunk->upValues);
                     ast_ = thunk->body;
                     goto recurse;
                 }
@@ -1950,13 +3463,18 @@ class Interpreter {
                 for (const auto &bind : ast.binds) {
                     // Note that these 2 lines must remain separate to avoid the GC running
                     // when bindings has a nullptr for key bind.first.
-                    auto *th = makeHeap<HeapThunk>(bind.var, self, offset, bind.body);
+                    HeapThunk *th = shares_thunk(ast, bind) ? sharedThunk(bind.body) : nullptr;
+                    if (th == nullptr)
+                        th = makeHeap<HeapThunk>(bind.var, self, offset, bind.body);
                     f.bindings[bind.var] = th;
                 }
                 // Now capture the environment (including the new thunks, to make cycles).
                 for (const auto &bind : ast.binds) {
+                    if (shares_thunk(ast, bind))
+                        continue;
                     auto *thunk = f.bindings[bind.var];
                     thunk->upValues = capture(bind.body->freeVariables);
+                    heap.remember(thunk);
                 }
                 ast_ = ast.body;
                 goto recurse;
@@ -2037,7 +3555,7 @@ class Interpreter {
                 if (thunk->filled) {
                     scratch = thunk->content;
                 } else {
-                    stack.newCall(ast.location, thunk, thunk->self, thunk->offset, thunk->upValues);
+                    stack.newCall(&ast, thunk, thunk->self, thunk->offset, &thunk->upValues);
                     ast_ = thunk->body;
                     goto recurse;
                 }
@@ -2062,15 +3580,13 @@ class Interpreter {
                     }
                     auto *func = static_cast<HeapClosure *>(scratch.v.h);
 
-                    std::set<const Identifier *> params_needed;
-                    for (const auto &param : func->params) {
-                        params_needed.insert(param.id);
-                    }
-
                     // Create thunks for arguments.
-                    std::vector<HeapThunk *> positional_args;
                     BindingFrame args;
+                    args.reserve(func->params.size());
                     bool got_named = false;
+                    HeapObject *self;
+                    unsigned offset;
+                    stack.getSelfBinding(self, offset);
                     for (unsigned i = 0; i < ast.args.size(); ++i) {
                         const auto &arg = ast.args[i];
 
@@ -2096,11 +3612,12 @@ class Interpreter {
                         // Special case for builtin functions -- leave identifier blank for
                         // them in the thunk.  This removes the thunk frame from the stacktrace.
                         const Identifier *name_ = func->body == nullptr ? nullptr : name;
-                        HeapObject *self;
-                        unsigned offset;
-                        stack.getSelfBinding(self, offset);
-                        auto *thunk = makeHeap<HeapThunk>(name_, self, offset, arg.expr);
-                        thunk->upValues = capture(arg.expr->freeVariables);
+                        HeapThunk *thunk = sharedThunk(arg.expr);
+                        if (thunk == nullptr) {
+                            thunk = makeHeap<HeapThunk>(name_, self, offset, arg.expr);
+                            thunk->upValues = capture(arg.expr->freeVariables);
+                            heap.remember(thunk);
+                        }
                         // While making the thunks, keep them in a frame to avoid premature garbage
                         // collection.
                         f.thunks.push_back(thunk);
@@ -2110,7 +3627,7 @@ class Interpreter {
                             throw makeError(ast.location, ss.str());
                         }
                         args[name] = thunk;
-                        if (params_needed.find(name) == params_needed.end()) {
+                        if (arg.id != nullptr && !has_param(func, name)) {
                             std::stringstream ss;
                             ss << "function has no parameter " << encode_utf8(name->name);
                             throw makeError(ast.location, ss.str());
@@ -2144,16 +3661,18 @@ class Interpreter {
                         args[param.id] = thunk;
                     }
 
-                    BindingFrame up_values = func->upValues;
-                    up_values.insert(args.begin(), args.end());
-
                     // Fill in upvalues
-                    for (HeapThunk *thunk : def_arg_thunks) {
-                        thunk->upValues = up_values;
+                    if (!def_arg_thunks.empty()) {
+                        BindingFrame up_values = func->upValues;
+                        up_values.insert(args.begin(), args.end());
+                        for (HeapThunk *thunk : def_arg_thunks) {
+                            thunk->upValues = up_values;
+                            heap.remember(thunk);
+                        }
                     }
 
                     // Cache these, because pop will invalidate them.
-                    std::vector<HeapThunk *> thunks_copy = f.thunks;
+                    std::vector<HeapThunk *> thunks_copy = std::move(f.thunks);
 
                     const AST *f_ast = f.ast;
                     stack.pop();
@@ -2163,12 +3682,15 @@ class Interpreter {
                         // Give nullptr for self because noone looking at this frame will
                         // attempt to bind to self (it's native code).
                         stack.newFrame(FRAME_BUILTIN_FORCE_THUNKS, f_ast);
-                        stack.top().thunks = thunks_copy;
+                        stack.top().thunks = std::move(thunks_copy);
                         stack.top().val = scratch;
                         goto replaceframe;
                     } else {
                         // User defined function.
-                        stack.newCall(ast.location, func, func->self, func->offset, up_values);
+                        // The arguments bind exactly the parameters, which are never among the
+                        // closure's upvalues, so the latter can be shared rather than copied.
+                        stack.newCall(
+                            &ast, func, func->self, func->offset, &func->upValues, std::move(args));
                         if (ast.tailstrict) {
                             stack.top().tailCall = true;
                             if (thunks_copy.size() == 0) {
@@ -2177,7 +3699,7 @@ class Interpreter {
                                 goto recurse;
                             } else {
                                 // The check for args.size() > 0
-                                stack.top().thunks = thunks_copy;
+                                stack.top().thunks = std::move(thunks_copy);
                                 stack.top().val = scratch;
                                 goto replaceframe;
                             }
@@ -2254,7 +3776,7 @@ class Interpreter {
                             switch (rhs.t) {
                                 case Value::OBJECT: {
                                     auto *obj = static_cast<HeapObject *>(rhs.v.h);
-                                    auto *fid = alloc->makeIdentifier(field->value);
+                                    auto *fid = alloc->makeIdentifier(field->value());
                                     unsigned unused_found_at = 0;
                                     bool in = findObject(fid, obj, 0, unused_found_at);
                                     scratch = makeBoolean(in);
@@ -2285,12 +3807,7 @@ class Interpreter {
                             if (ast.op == BOP_PLUS) {
                                 auto *arr_l = static_cast<HeapArray *>(lhs.v.h);
                                 auto *arr_r = static_cast<HeapArray *>(rhs.v.h);
-                                std::vector<HeapThunk *> elements;
-                                for (auto *el : arr_l->elements)
-                                    elements.push_back(el);
-                                for (auto *el : arr_r->elements)
-                                    elements.push_back(el);
-                                scratch = makeArray(elements);
+                                scratch = makeArrayConcat(arr_l, arr_r);
                             } else {
                                 throw makeError(ast.location,
                                                 "binary operator " + bop_string(ast.op) +
@@ -2402,11 +3919,16 @@ class Interpreter {
                         } break;
 
                         case Value::STRING: {
-                            const UString &lhs_str = static_cast<HeapString *>(lhs.v.h)->value;
-                            const UString &rhs_str = static_cast<HeapString *>(rhs.v.h)->value;
+                            auto *lhs_heap = static_cast<HeapString *>(lhs.v.h);
+                            auto *rhs_heap = static_cast<HeapString *>(rhs.v.h);
+                            if (ast.op == BOP_PLUS) {
+                                // Does not need the characters of a rope.
+                                scratch = makeStringConcat(lhs_heap, rhs_heap);
+                                break;
+                            }
+                            const UString &lhs_str = lhs_heap->value();
+                            const UString &rhs_str = rhs_heap->value();
                             switch (ast.op) {
-                                case BOP_PLUS: scratch = makeString(lhs_str + rhs_str); break;
-
                                 case BOP_LESS_EQ: scratch = makeBoolean(lhs_str <= rhs_str); break;
 
                                 case BOP_GREATER_EQ:
@@ -2436,16 +3958,21 @@ class Interpreter {
                             "filter function must return boolean, got: " + type_str(scratch));
                     }
                     if (scratch.v.b)
-                        f.thunks.push_back(arr->elements[f.elementId]);
+                        f.thunks.push_back(arr->elements()[f.elementId]);
                     f.elementId++;
                     // Iterate through arr, calling the function on each.
-                    if (f.elementId == arr->elements.size()) {
+                    if (f.elementId == arr->size()) {
                         scratch = makeArray(f.thunks);
                     } else {
-                        auto *thunk = arr->elements[f.elementId];
-                        BindingFrame bindings = func->upValues;
-                        bindings[func->params[0].id] = thunk;
-                        stack.newCall(ast.location, func, func->self, func->offset, bindings);
+                        auto *thunk = arr->elements()[f.elementId];
+                        BindingFrame bindings;
+                        bindings.append(func->params[0].id, thunk);
+                        stack.newCall(&ast,
+                                      func,
+                                      func->self,
+                                      func->offset,
+                                      &func->upValues,
+                                      std::move(bindings));
                         ast_ = func->body;
                         goto recurse;
                     }
@@ -2462,9 +3989,8 @@ class Interpreter {
                         for (auto *th : f.thunks) {
                             args.push_back(th->content);
                         }
-                        BuiltinMap::const_iterator bit = builtins.find(builtin_name);
-                        if (bit != builtins.end()) {
-                            const AST *new_ast = (this->*bit->second)(loc, args);
+                        if (func->builtin != HeapClosure::NO_BUILTIN) {
+                            const AST *new_ast = (this->*builtins[func->builtin])(loc, args);
                             if (new_ast != nullptr) {
                                 ast_ = new_ast;
                                 goto recurse;
@@ -2473,39 +3999,21 @@ class Interpreter {
                         }
                         VmNativeCallbackMap::const_iterator nit =
                             nativeCallbacks.find(builtin_name);
-                        // TODO(dcunnin): Support arrays.
-                        // TODO(dcunnin): Support objects.
-                        std::vector<JsonnetJsonValue> args2;
+                        // Arrays and objects are evaluated all the way down, as when they
+                        // are manifested.  Their thunks are filled for later use.
+                        std::vector<std::unique_ptr<JsonnetJsonValue>> args2;
                         for (const Value &arg : args) {
-                            switch (arg.t) {
-                                case Value::STRING:
-                                    args2.emplace_back(
-                                        JsonnetJsonValue::STRING,
-                                        encode_utf8(static_cast<HeapString *>(arg.v.h)->value),
-                                        0);
-                                    break;
-
-                                case Value::BOOLEAN:
-                                    args2.emplace_back(
-                                        JsonnetJsonValue::BOOL, "", arg.v.b ? 1.0 : 0.0);
-                                    break;
-
-                                case Value::NUMBER:
-                                    args2.emplace_back(JsonnetJsonValue::NUMBER, "", arg.v.d);
-                                    break;
-
-                                case Value::NULL_TYPE:
-                                    args2.emplace_back(JsonnetJsonValue::NULL_KIND, "", 0);
-                                    break;
-
-                                default:
-                                    throw makeError(ast.location,
-                                                    "native extensions can only take primitives.");
+                            if (arg.t == Value::FUNCTION) {
+                                throw makeError(ast.location,
+                                                "native extensions cannot take functions.");
                             }
+                            scratch = arg;
+                            args2.emplace_back(static_cast<JsonnetJsonValue *>(
+                                manifestValue(loc, json_builder, nullptr)));
                         }
                         std::vector<const JsonnetJsonValue *> args3;
                         for (size_t i = 0; i < args2.size(); ++i) {
-                            args3.push_back(&args2[i]);
+                            args3.push_back(args2[i].get());
                         }
                         if (nit == nativeCallbacks.end()) {
                             throw makeError(ast.location,
@@ -2518,7 +4026,7 @@ class Interpreter {
 
                         if (succ) {
                             bool unused;
-                            jsonToHeap(r, unused, scratch);
+                            jsonToHeap(r.get(), unused, scratch);
                         } else {
                             if (r->kind != JsonnetJsonValue::STRING) {
                                 throw makeError(
@@ -2533,10 +4041,12 @@ class Interpreter {
                         // Not all arguments forced yet.
                         HeapThunk *th = f.thunks[f.elementId++];
                         if (!th->filled) {
-                            stack.newCall(ast.location, th, th->self, th->offset, th->upValues);
+                            stack.newCall(&ast, th, th->self, th->offset, &th->upValues);
                             ast_ = th->body;
                             goto recurse;
                         }
+                        // Shared thunks may be forced already.
+                        goto replaceframe;
                     }
                 } break;
 
@@ -2544,15 +4054,19 @@ class Interpreter {
                     if (auto *thunk = dynamic_cast<HeapThunk *>(f.context)) {
                         // If we called a thunk, cache result.
                         thunk->fill(scratch);
+                        heap.remember(thunk);
                     } else if (auto *closure = dynamic_cast<HeapClosure *>(f.context)) {
                         if (f.elementId < f.thunks.size()) {
                             // If tailstrict, force thunks
                             HeapThunk *th = f.thunks[f.elementId++];
                             if (!th->filled) {
-                                stack.newCall(f.location, th, th->self, th->offset, th->upValues);
+                                stack.newCall(
+                                    f.location(), th, th->self, th->offset, &th->upValues);
                                 ast_ = th->body;
                                 goto recurse;
                             }
+                            // Shared thunks may be forced already.
+                            goto replaceframe;
                         } else if (f.thunks.size() == 0) {
                             // Body has now been executed
                         } else {
@@ -2563,6 +4077,9 @@ class Interpreter {
                             goto recurse;
                         }
                     }
+                    if (f.field != nullptr) {
+                        cacheField();
+                    }
                     // Result of call is in scratch, just pop.
                 } break;
 
@@ -2570,7 +4087,7 @@ class Interpreter {
                     const auto &ast = *static_cast<const Error *>(f.ast);
                     UString msg;
                     if (scratch.t == Value::STRING) {
-                        msg = static_cast<HeapString *>(scratch.v.h)->value;
+                        msg = static_cast<HeapString *>(scratch.v.h)->value();
                     } else {
                         msg = toString(ast.location);
                     }
@@ -2605,11 +4122,14 @@ class Interpreter {
                             "super index must be string, got " + type_str(scratch) + ".");
                     }
 
-                    const UString &index_name = static_cast<HeapString *>(scratch.v.h)->value;
+                    const UString &index_name = static_cast<HeapString *>(scratch.v.h)->value();
                     auto *fid = alloc->makeIdentifier(index_name);
                     stack.pop();
-                    ast_ = objectIndex(ast.location, self, fid, offset);
-                    goto recurse;
+                    const Value *cached;
+                    ast_ = objectIndex(ast.location, self, fid, offset, cached);
+                    if (cached == nullptr)
+                        goto recurse;
+                    scratch = *cached;
                 } break;
 
                 case FRAME_IN_SUPER_ELEMENT: {
@@ -2627,7 +4147,8 @@ class Interpreter {
                         // There is no super object.
                         scratch = makeBoolean(false);
                     } else {
-                        const UString &element_name = static_cast<HeapString *>(scratch.v.h)->value;
+                        const UString &element_name =
+                            static_cast<HeapString *>(scratch.v.h)->value();
                         auto *fid = alloc->makeIdentifier(element_name);
                         unsigned unused_found_at = 0;
                         bool in = findObject(fid, self, offset, unused_found_at);
@@ -2641,7 +4162,7 @@ class Interpreter {
                     if (target.t == Value::ARRAY) {
                         const auto *array = static_cast<HeapArray *>(target.v.h);
                         if (scratch.t == Value::STRING) {
-                            const UString &str = static_cast<HeapString *>(scratch.v.h)->value;
+                            const UString &str = static_cast<HeapString *>(scratch.v.h)->value();
                             throw makeError(
                                 ast.location,
                                 "attempted index an array with string \""
@@ -2653,7 +4174,7 @@ class Interpreter {
                                 "array index must be number, got " + type_str(scratch) + ".");
                         }
                         double index = ::floor(scratch.v.d);
-                        long sz = array->elements.size();
+                        long sz = array->size();
                         if (index < 0 || index >= sz) {
                             std::stringstream ss;
                             ss << "array bounds error: " << index << " not within [0, " << sz
@@ -2666,13 +4187,13 @@ class Interpreter {
                             throw makeError(ast.location, ss.str());
                         }
                         // index < sz <= SIZE_T_MAX
-                        auto *thunk = array->elements[size_t(index)];
+                        auto *thunk = array->elements()[size_t(index)];
                         if (thunk->filled) {
                             scratch = thunk->content;
                         } else {
                             stack.pop();
                             stack.newCall(
-                                ast.location, thunk, thunk->self, thunk->offset, thunk->upValues);
+                                &ast, thunk, thunk->self, thunk->offset, &thunk->upValues);
                             ast_ = thunk->body;
                             goto recurse;
                         }
@@ -2684,11 +4205,14 @@ class Interpreter {
                                 ast.location,
                                 "object index must be string, got " + type_str(scratch) + ".");
                         }
-                        const UString &index_name = static_cast<HeapString *>(scratch.v.h)->value;
+                        const UString &index_name = static_cast<HeapString *>(scratch.v.h)->value();
                         auto *fid = alloc->makeIdentifier(index_name);
                         stack.pop();
-                        ast_ = objectIndex(ast.location, obj, fid, 0);
-                        goto recurse;
+                        const Value *cached;
+                        ast_ = objectIndex(ast.location, obj, fid, 0, cached);
+                        if (cached == nullptr)
+                            goto recurse;
+                        scratch = *cached;
                     } else if (target.t == Value::STRING) {
                         auto *obj = static_cast<HeapString *>(target.v.h);
                         assert(obj != nullptr);
@@ -2697,14 +4221,14 @@ class Interpreter {
                                 ast.location,
                                 "string index must be a number, got " + type_str(scratch) + ".");
                         }
-                        long sz = obj->value.length();
+                        long sz = obj->value().length();
                         long i = (long)scratch.v.d;
                         if (i < 0 || i >= sz) {
                             std::stringstream ss;
                             ss << "string bounds error: " << i << " not within [0, " << sz << ")";
                             throw makeError(ast.location, ss.str());
                         }
-                        char32_t ch[] = {obj->value[i], U'\0'};
+                        char32_t ch[] = {obj->value()[i], U'\0'};
                         scratch = makeString(ch);
                     } else {
                         std::cerr << "INTERNAL ERROR: not object / array / string." << std::endl;
@@ -2733,11 +4257,8 @@ class Interpreter {
                             if (f2.thunks.size() > 0) {
                                 auto *thunk = f2.thunks[0];
                                 f2.elementId = 1;
-                                stack.newCall(ast.location,
-                                              thunk,
-                                              thunk->self,
-                                              thunk->offset,
-                                              thunk->upValues);
+                                stack.newCall(
+                                    &ast, thunk, thunk->self, thunk->offset, &thunk->upValues);
                                 ast_ = thunk->body;
                                 goto recurse;
                             }
@@ -2760,7 +4281,8 @@ class Interpreter {
                         goto recurse;
                     }
                     auto *thunk = f.thunks[f.elementId++];
-                    stack.newCall(f.location, thunk, thunk->self, thunk->offset, thunk->upValues);
+                    stack.newCall(
+                        f.location(), thunk, thunk->self, thunk->offset, &thunk->upValues);
                     ast_ = thunk->body;
                     goto recurse;
                 } break;
@@ -2771,19 +4293,20 @@ class Interpreter {
 
                 case FRAME_OBJECT: {
                     const auto &ast = *static_cast<const DesugaredObject *>(f.ast);
+                    auto &fields = stack.payload(f).objectFields;
                     if (scratch.t != Value::NULL_TYPE) {
                         if (scratch.t != Value::STRING) {
                             throw makeError(ast.location, "field name was not a string.");
                         }
-                        const auto &fname = static_cast<const HeapString *>(scratch.v.h)->value;
+                        const auto &fname = static_cast<const HeapString *>(scratch.v.h)->value();
                         const Identifier *fid = alloc->makeIdentifier(fname);
-                        if (f.objectFields.find(fid) != f.objectFields.end()) {
+                        if (fields.find(fid) != fields.end()) {
                             std::string msg =
                                 "duplicate field name: \"" + encode_utf8(fname) + "\"";
                             throw makeError(ast.location, msg);
                         }
-                        f.objectFields[fid].hide = f.fit->hide;
-                        f.objectFields[fid].body = f.fit->body;
+                        fields[fid].hide = f.fit->hide;
+                        fields[fid].body = f.fit->body;
                     }
                     f.fit++;
                     if (f.fit != ast.fields.end()) {
@@ -2791,7 +4314,7 @@ class Interpreter {
                         goto recurse;
                     } else {
                         auto env = capture(ast.freeVariables);
-                        scratch = makeObject<HeapSimpleObject>(env, f.objectFields, ast.asserts);
+                        scratch = makeObject<HeapSimpleObject>(env, fields, ast.asserts);
                     }
                 } break;
 
@@ -2803,14 +4326,17 @@ class Interpreter {
                                         "object comprehension needs array, got " + type_str(arr_v));
                     }
                     const auto *arr = static_cast<const HeapArray *>(arr_v.v.h);
-                    if (arr->elements.size() == 0) {
+                    if (arr->size() == 0) {
                         // Degenerate case.  Just create the object now.
                         scratch = makeObject<HeapComprehensionObject>(
-                            BindingFrame{}, ast.value, ast.id, BindingFrame{});
+                            BindingFrame{},
+                            ast.value,
+                            ast.id,
+                            std::map<const Identifier *, HeapThunk *>{});
                     } else {
                         f.kind = FRAME_OBJECT_COMP_ELEMENT;
                         f.val = scratch;
-                        f.bindings[ast.id] = arr->elements[0];
+                        f.bindings[ast.id] = arr->elements()[0];
                         f.elementId = 0;
                         ast_ = ast.field;
                         goto recurse;
@@ -2820,28 +4346,29 @@ class Interpreter {
                 case FRAME_OBJECT_COMP_ELEMENT: {
                     const auto &ast = *static_cast<const ObjectComprehensionSimple *>(f.ast);
                     const auto *arr = static_cast<const HeapArray *>(f.val.v.h);
+                    auto &elements = stack.payload(f).elements;
                     if (scratch.t != Value::NULL_TYPE) {
                         if (scratch.t != Value::STRING) {
                             std::stringstream ss;
                             ss << "field must be string, got: " << type_str(scratch);
                             throw makeError(ast.location, ss.str());
                         }
-                        const auto &fname = static_cast<const HeapString *>(scratch.v.h)->value;
+                        const auto &fname = static_cast<const HeapString *>(scratch.v.h)->value();
                         const Identifier *fid = alloc->makeIdentifier(fname);
-                        if (f.elements.find(fid) != f.elements.end()) {
+                        if (elements.find(fid) != elements.end()) {
                             throw makeError(ast.location,
                                             "duplicate field name: \"" + encode_utf8(fname) + "\"");
                         }
-                        f.elements[fid] = arr->elements[f.elementId];
+                        elements[fid] = arr->elements()[f.elementId];
                     }
                     f.elementId++;
 
-                    if (f.elementId == arr->elements.size()) {
+                    if (f.elementId == arr->size()) {
                         auto env = capture(ast.freeVariables);
                         scratch =
-                            makeObject<HeapComprehensionObject>(env, ast.value, ast.id, f.elements);
+                            makeObject<HeapComprehensionObject>(env, ast.value, ast.id, elements);
                     } else {
-                        f.bindings[ast.id] = arr->elements[f.elementId];
+                        f.bindings[ast.id] = arr->elements()[f.elementId];
                         ast_ = ast.field;
                         goto recurse;
                     }
@@ -2851,20 +4378,19 @@ class Interpreter {
                     const auto &ast = *static_cast<const Binary *>(f.ast);
                     const Value &lhs = stack.top().val;
                     const Value &rhs = stack.top().val2;
-                    UString output;
-                    if (lhs.t == Value::STRING) {
-                        output.append(static_cast<const HeapString *>(lhs.v.h)->value);
-                    } else {
+                    Value lhs_str = lhs, rhs_str = rhs;
+                    if (lhs.t != Value::STRING) {
                         scratch = lhs;
-                        output.append(toString(ast.left->location));
+                        lhs_str = makeString(toString(ast.left->location));
+                        // Keep it alive while the other side is converted.
+                        stack.top().val = lhs_str;
                     }
-                    if (rhs.t == Value::STRING) {
-                        output.append(static_cast<const HeapString *>(rhs.v.h)->value);
-                    } else {
+                    if (rhs.t != Value::STRING) {
                         scratch = rhs;
-                        output.append(toString(ast.right->location));
+                        rhs_str = makeString(toString(ast.right->location));
                     }
-                    scratch = makeString(output);
+                    scratch = makeStringConcat(static_cast<HeapString *>(lhs_str.v.h),
+                                               static_cast<HeapString *>(rhs_str.v.h));
                 } break;
 
                 case FRAME_UNARY: {
@@ -2905,7 +4431,7 @@ class Interpreter {
                 } break;
 
                 case FRAME_BUILTIN_JOIN_STRINGS: {
-                    joinString(f.first, f.str, f.val, f.elementId, scratch);
+                    joinString(f.first, stack.payload(f).str, f.val, f.elementId, scratch);
                     f.elementId++;
                     auto *ast = joinStrings();
                     if (ast != nullptr) {
@@ -2932,6 +4458,19 @@ class Interpreter {
                     }
                 } break;
 
+                case FRAME_BUILTIN_SORT:
+                case FRAME_BUILTIN_UNIQ:
+                case FRAME_BUILTIN_SET_UNION:
+                case FRAME_BUILTIN_SET_INTER:
+                case FRAME_BUILTIN_SET_DIFF: {
+                    stack.payload(f).values.push_back(scratch);
+                    auto *ast = computeKeys();
+                    if (ast != nullptr) {
+                        ast_ = ast;
+                        goto recurse;
+                    }
+                } break;
+
                 default:
                     std::cerr << "INTERNAL ERROR: Unknown FrameKind:  " << f.kind << std::endl;
                     std::abort();
@@ -2945,100 +4484,643 @@ class Interpreter {
         }
     }
 
+    /** Evaluate the program and, if it yields a function, call it with the top-level arguments.
+     *
+     * The call is built here rather than by the desugarer, so that a program can be compiled
+     * once and executed with different arguments.
+     */
+    void evaluateTopLevel(const AST *ast, const ExtMap &tlas)
+    {
+        // The program is evaluated in a call, which counts towards the stack limit.
+        BindingFrame env;
+        env[idStd] = stdThunk;
+        stack.newCall(LocationRange(), nullptr, nullptr, 0, env);
+        evaluate(ast, stack.size());
+        stack.pop();
+        if (scratch.t != Value::FUNCTION)
+            return;
+
+        // local top_level = <scratch>; top_level(tlas...)
+        LocationRange tla_loc("Top-level function");
+        const Identifier *id_top_level = alloc->makeIdentifier(U"top_level");
+        Identifiers globals{idStd, id_top_level};
+        // Arguments given as values are bound alongside top_level, under names that cannot
+        // occur in Jsonnet code.
+        ArgParams args;
+        for (const auto &pair : tlas) {
+            AST *expr;
+            if (pair.second.value != nullptr) {
+                const Identifier *id = alloc->makeIdentifier(U"$tla:" + decode_utf8(pair.first));
+                expr = alloc->make<Var>(tla_loc, Fodder{}, id);
+                globals.push_back(id);
+            } else if (pair.second.isCode) {
+                expr = parseCode(alloc, "tla:" + pair.first, pair.second.data);
+            } else {
+                expr = alloc->make<LiteralString>(LocationRange(), Fodder{},
+                                                  decode_utf8(pair.second.data),
+                                                  LiteralString::DOUBLE, "", "");
+            }
+            // Add them as named arguments, so order does not matter.
+            args.emplace_back(Fodder{}, alloc->makeIdentifier(decode_utf8(pair.first)), Fodder{},
+                              expr, Fodder{});
+        }
+        AST *call = alloc->make<Apply>(tla_loc, Fodder{},
+                                       alloc->make<Var>(tla_loc, Fodder{}, id_top_level),
+                                       Fodder{}, args, false, Fodder{}, Fodder{}, false);
+        analyseCode(alloc, call, globals);
+
+        auto *thunk = makeHeap<HeapThunk>(id_top_level, nullptr, 0, nullptr);
+        thunk->fill(scratch);
+        heap.remember(thunk);
+        // The call is evaluated on top of the frame that binds $std.
+        stack.newFrame(FRAME_LOCAL, tla_loc);
+        stack.top().bindings[id_top_level] = thunk;
+        for (const auto &pair : tlas) {
+            if (pair.second.value == nullptr)
+                continue;
+            const Identifier *id = alloc->makeIdentifier(U"$tla:" + decode_utf8(pair.first));
+            auto *value = makeHeap<HeapThunk>(id, nullptr, 0, nullptr);
+            stack.top().bindings[id] = value;
+            jsonToHeap(pair.second.value.get(), value->filled, value->content);
+        }
+        evaluate(call, stack.size());
+        stack.pop();
+    }
+
+    /** Hand the output buffered in out to the sink, if there is one. */
+    void flushOutput(const LocationRange &loc, std::string &out, VmOutput *sink)
+    {
+        if (sink == nullptr || out.empty())
+            return;
+        if (!sink->write(out.data(), out.size()))
+            throw makeError(loc, "couldn't write output.");
+        out.clear();
+    }
+
     /** Manifest the scratch value by evaluating any remaining fields, and then convert to JSON.
      *
      * This can trigger a garbage collection cycle.  Be sure to stash any objects that aren't
      * reachable via the stack or heap.
      *
+     * Arrays and objects are walked without recursing, so that deeply nested values cannot
+     * overflow the native stack.
+     *
      * \param multiline If true, will print objects and arrays in an indented fashion.
+     * \param out The UTF-8 JSON is appended to this.
+     * \param sink If not null, out is handed to it whenever it grows large, so that only the last
+     *     piece is left in out.
      */
-    UString manifestJson(const LocationRange &loc, bool multiline, const UString &indent)
+    void manifestJson(const LocationRange &loc, bool multiline, std::string &out,
+                      VmOutput *sink = nullptr)
     {
         // Printing fields means evaluating and binding them, which can trigger
         // garbage collection.
 
+        // An array or object whose elements are being printed.  While an element is evaluated,
+        // the stack frame pushed for it holds the array or object in val, to keep it alive.
+        struct Level {
+            LocationRange loc;
+            // nullptr for an object
+            HeapArray *arr;
+            std::vector<std::pair<UString, const Identifier *>> fields;
+            size_t size;
+            size_t next;
+        };
+        std::vector<Level> levels;
+        LocationRange vloc = loc;
+        while (true) {
+            // Print the value in scratch, or start printing its elements.
+            bool opened = false;
+            switch (scratch.t) {
+                case Value::ARRAY: {
+                    auto *arr = static_cast<HeapArray *>(scratch.v.h);
+                    if (arr->size() == 0) {
+                        out += "[ ]";
+                    } else {
+                        out += '[';
+                        levels.push_back(Level{vloc, arr, {}, arr->size(), 0});
+                        opened = true;
+                    }
+                } break;
+
+                case Value::BOOLEAN: out += scratch.v.b ? "true" : "false"; break;
+
+                case Value::NUMBER: out += jsonnet_unparse_number(scratch.v.d); break;
+
+                case Value::FUNCTION:
+                    throw makeError(vloc, "couldn't manifest function in JSON output.");
+
+                case Value::NULL_TYPE: out += "null"; break;
+
+                case Value::OBJECT: {
+                    auto *obj = static_cast<HeapObject *>(scratch.v.h);
+                    runInvariants(vloc, obj);
+                    // The invariants overwrote scratch.
+                    scratch.t = Value::OBJECT;
+                    scratch.v.h = obj;
+                    // Using std::map has the useful side-effect of ordering the fields
+                    // alphabetically.
+                    std::map<UString, const Identifier *> fields;
+                    for (const auto &f : objectFields(obj, true)) {
+                        fields[f->name] = f;
+                    }
+                    if (fields.size() == 0) {
+                        out += "{ }";
+                    } else {
+                        out += '{';
+                        levels.push_back(Level{vloc, nullptr, {fields.begin(), fields.end()},
+                                               fields.size(), 0});
+                        opened = true;
+                    }
+                } break;
+
+                case Value::STRING: {
+                    const UString &str = static_cast<HeapString *>(scratch.v.h)->value();
+                    jsonnet_string_unparse_utf8(str, out);
+                } break;
+            }
+            if (out.size() >= OUTPUT_CHUNK_SIZE)
+                flushOutput(vloc, out, sink);
+
+            // Find the next element to print, closing the arrays and objects that are done.
+            bool element_done = !opened;
+            while (!levels.empty()) {
+                Level &l = levels.back();
+                if (element_done) {
+                    // Restore scratch to the array or object.
+                    scratch = stack.top().val;
+                    stack.pop();
+                }
+                if (l.next < l.size)
+                    break;
+                if (multiline) {
+                    out += '\n';
+                    out.append(3 * (levels.size() - 1), ' ');
+                }
+                out += l.arr != nullptr ? ']' : '}';
+                levels.pop_back();
+                element_done = true;
+            }
+            if (levels.empty())
+                return;
+
+            Level &l = levels.back();
+            size_t i = l.next++;
+            if (i > 0)
+                out += ',';
+            if (multiline) {
+                out += '\n';
+                out.append(3 * levels.size(), ' ');
+            } else if (i > 0) {
+                out += ' ';
+            }
+            if (l.arr != nullptr) {
+                HeapThunk *thunk = l.arr->elements()[i];
+                if (thunk->filled) {
+                    stack.newCall(l.loc, thunk, nullptr, 0, BindingFrame{});
+                    // Keep arr alive when scratch is overwritten
+                    stack.top().val = scratch;
+                    scratch = thunk->content;
+                } else {
+                    stack.newCall(l.loc, thunk, thunk->self, thunk->offset, &thunk->upValues);
+                    // Keep arr alive when scratch is overwritten
+                    stack.top().val = scratch;
+                    evaluate(thunk->body, stack.size());
+                }
+                vloc = thunk->body == nullptr ? l.loc : thunk->body->location;
+            } else {
+                jsonnet_string_unparse_utf8(l.fields[i].first, out);
+                out += ": ";
+                auto *obj = static_cast<HeapObject *>(scratch.v.h);
+                // pushes FRAME_CALL
+                const Value *cached;
+                const AST *body = objectIndex(l.loc, obj, l.fields[i].second, 0, cached);
+                // Keep obj alive when scratch is overwritten
+                stack.top().val = scratch;
+                if (cached == nullptr) {
+                    evaluate(body, stack.size());
+                    cacheField();
+                } else {
+                    scratch = *cached;
+                }
+                vloc = body->location;
+            }
+        }
+    }
+
+    /** The error of the std.manifest* functions for a function at the given path. */
+    RuntimeError manifestFunctionError(const LocationRange &loc, const std::vector<UString> &path)
+    {
+        UStringStream ss;
+        if (path.size() == 0) {
+            ss << U"[ ]";
+        } else {
+            const char32_t *prefix = U"[";
+            for (const auto &p : path) {
+                ss << prefix << p;
+                prefix = U", ";
+            }
+            ss << U"]";
+        }
+        return makeError(loc, "Tried to manifest function at " + encode_utf8(ss.str()));
+    }
+
+    /** Convert the scratch value to JSON in the style of std.manifestJsonEx.
+     *
+     * Unlike manifestJson, the invariants of objects without visible fields are not checked.
+     * This can trigger a garbage collection cycle.
+     *
+     * \param indent The string added to the indentation at each level of nesting.
+     * \param cindent The indentation of the current level.
+     * \param path The indexes leading to the value, for error messages.
+     */
+    UString manifestJsonEx(const LocationRange &loc, const UString &indent,
+                           const UString &cindent, std::vector<UString> &path)
+    {
         UStringStream ss;
         switch (scratch.t) {
             case Value::ARRAY: {
                 HeapArray *arr = static_cast<HeapArray *>(scratch.v.h);
-                if (arr->elements.size() == 0) {
-                    ss << U"[ ]";
-                } else {
-                    const char32_t *prefix = multiline ? U"[\n" : U"[";
-                    UString indent2 = multiline ? indent + U"   " : indent;
-                    for (auto *thunk : arr->elements) {
-                        LocationRange tloc = thunk->body == nullptr ? loc : thunk->body->location;
-                        if (thunk->filled) {
-                            stack.newCall(loc, thunk, nullptr, 0, BindingFrame{});
-                            // Keep arr alive when scratch is overwritten
-                            stack.top().val = scratch;
-                            scratch = thunk->content;
-                        } else {
-                            stack.newCall(loc, thunk, thunk->self, thunk->offset, thunk->upValues);
-                            // Keep arr alive when scratch is overwritten
-                            stack.top().val = scratch;
-                            evaluate(thunk->body, stack.size());
-                        }
-                        auto element = manifestJson(tloc, multiline, indent2);
-                        // Restore scratch
-                        scratch = stack.top().val;
-                        stack.pop();
-                        ss << prefix << indent2 << element;
-                        prefix = multiline ? U",\n" : U", ";
+                UString indent2 = cindent + indent;
+                const char32_t *prefix = U"";
+                ss << U"[\n";
+                for (size_t i = 0; i < arr->size(); ++i) {
+                    auto *thunk = arr->elements()[i];
+                    LocationRange tloc = thunk->body == nullptr ? loc : thunk->body->location;
+                    if (thunk->filled) {
+                        stack.newCall(loc, thunk, nullptr, 0, BindingFrame{});
+                        // Keep arr alive when scratch is overwritten
+                        stack.top().val = scratch;
+                        scratch = thunk->content;
+                    } else {
+                        stack.newCall(loc, thunk, thunk->self, thunk->offset, &thunk->upValues);
+                        // Keep arr alive when scratch is overwritten
+                        stack.top().val = scratch;
+                        evaluate(thunk->body, stack.size());
                     }
-                    ss << (multiline ? U"\n" : U"") << indent << U"]";
+                    path.push_back(decode_utf8(jsonnet_unparse_number(i)));
+                    auto element = manifestJsonEx(tloc, indent, indent2, path);
+                    path.pop_back();
+                    // Restore scratch
+                    scratch = stack.top().val;
+                    stack.pop();
+                    ss << prefix << indent2 << element;
+                    prefix = U",\n";
                 }
+                ss << U"\n" << cindent << U"]";
             } break;
 
             case Value::BOOLEAN: ss << (scratch.v.b ? U"true" : U"false"); break;
 
             case Value::NUMBER: ss << decode_utf8(jsonnet_unparse_number(scratch.v.d)); break;
 
-            case Value::FUNCTION:
-                throw makeError(loc, "couldn't manifest function in JSON output.");
+            case Value::FUNCTION: throw manifestFunctionError(loc, path);
 
             case Value::NULL_TYPE: ss << U"null"; break;
 
             case Value::OBJECT: {
                 auto *obj = static_cast<HeapObject *>(scratch.v.h);
-                runInvariants(loc, obj);
-                // Using std::map has the useful side-effect of ordering the fields
-                // alphabetically.
                 std::map<UString, const Identifier *> fields;
                 for (const auto &f : objectFields(obj, true)) {
                     fields[f->name] = f;
                 }
-                if (fields.size() == 0) {
-                    ss << U"{ }";
-                } else {
-                    UString indent2 = multiline ? indent + U"   " : indent;
-                    const char32_t *prefix = multiline ? U"{\n" : U"{";
-                    for (const auto &f : fields) {
-                        // pushes FRAME_CALL
-                        const AST *body = objectIndex(loc, obj, f.second, 0);
-                        stack.top().val = scratch;
+                // Indexing the object checks its invariants.
+                if (fields.size() > 0)
+                    runInvariants(loc, obj);
+                UString indent2 = cindent + indent;
+                const char32_t *prefix = U"";
+                ss << U"{\n";
+                for (const auto &f : fields) {
+                    // pushes FRAME_CALL
+                    const Value *cached;
+                    const AST *body = objectIndex(loc, obj, f.second, 0, cached);
+                    stack.top().val = scratch;
+                    if (cached == nullptr) {
                         evaluate(body, stack.size());
-                        auto vstr = manifestJson(body->location, multiline, indent2);
-                        // Reset scratch so that the object we're manifesting doesn't
-                        // get GC'd.
-                        scratch = stack.top().val;
-                        stack.pop();
-                        ss << prefix << indent2 << jsonnet_string_unparse(f.first, false) << U": "
-                           << vstr;
-                        prefix = multiline ? U",\n" : U", ";
+                        cacheField();
+                    } else {
+                        scratch = *cached;
                     }
-                    ss << (multiline ? U"\n" : U"") << indent << U"}";
+                    UString key = jsonnet_string_unparse(f.first, false);
+                    path.push_back(key);
+                    auto vstr = manifestJsonEx(body->location, indent, indent2, path);
+                    path.pop_back();
+                    // Reset scratch so that the object we're manifesting doesn't
+                    // get GC'd.
+                    scratch = stack.top().val;
+                    stack.pop();
+                    ss << prefix << indent2 << key << U": " << vstr;
+                    prefix = U",\n";
                 }
+                ss << U"\n" << cindent << U"}";
             } break;
 
             case Value::STRING: {
-                const UString &str = static_cast<HeapString *>(scratch.v.h)->value;
+                const UString &str = static_cast<HeapString *>(scratch.v.h)->value();
                 ss << jsonnet_string_unparse(str, false);
             } break;
         }
         return ss.str();
     }
 
+    /** Whether a value is laid out over several lines by std.manifestYamlDoc. */
+    bool yamlBlock(const Value &v)
+    {
+        if (v.t == Value::ARRAY)
+            return static_cast<HeapArray *>(v.v.h)->size() > 0;
+        if (v.t == Value::OBJECT)
+            return objectFields(static_cast<HeapObject *>(v.v.h), true).size() > 0;
+        return false;
+    }
+
+    /** Convert the scratch value to YAML in the style of std.manifestYamlDoc.
+     *
+     * Like manifestJsonEx, this can trigger a garbage collection cycle.
+     *
+     * \param cindent The indentation of the current level.
+     * \param path The indexes leading to the value, for error messages.
+     * \param out The YAML is appended to this.
+     */
+    void manifestYaml(const LocationRange &loc, bool indent_array_in_object,
+                      const UString &cindent, std::vector<UString> &path, UString &out)
+    {
+        switch (scratch.t) {
+            case Value::ARRAY: {
+                HeapArray *arr = static_cast<HeapArray *>(scratch.v.h);
+                if (arr->size() == 0) {
+                    out += U"[]";
+                    break;
+                }
+                for (size_t i = 0; i < arr->size(); ++i) {
+                    auto *thunk = arr->elements()[i];
+                    LocationRange tloc = thunk->body == nullptr ? loc : thunk->body->location;
+                    if (thunk->filled) {
+                        stack.newCall(loc, thunk, nullptr, 0, BindingFrame{});
+                        // Keep arr alive when scratch is overwritten
+                        stack.top().val = scratch;
+                        scratch = thunk->content;
+                    } else {
+                        stack.newCall(loc, thunk, thunk->self, thunk->offset, &thunk->upValues);
+                        // Keep arr alive when scratch is overwritten
+                        stack.top().val = scratch;
+                        evaluate(thunk->body, stack.size());
+                    }
+                    if (i > 0)
+                        out += U"\n" + cindent;
+                    // Nested arrays start on a new line, everything else after the -.
+                    UString new_indent = cindent;
+                    if (yamlBlock(scratch)) {
+                        new_indent += U"  ";
+                        out += scratch.t == Value::ARRAY ? U"-\n" + new_indent : U"- ";
+                    } else {
+                        out += U"- ";
+                    }
+                    path.push_back(decode_utf8(jsonnet_unparse_number(i)));
+                    manifestYaml(tloc, indent_array_in_object, new_indent, path, out);
+                    path.pop_back();
+                    // Restore scratch
+                    scratch = stack.top().val;
+                    stack.pop();
+                }
+            } break;
+
+            case Value::BOOLEAN: out += scratch.v.b ? U"true" : U"false"; break;
+
+            case Value::NUMBER: out += decode_utf8(jsonnet_unparse_number(scratch.v.d)); break;
+
+            case Value::FUNCTION: throw manifestFunctionError(loc, path);
+
+            case Value::NULL_TYPE: out += U"null"; break;
+
+            case Value::OBJECT: {
+                auto *obj = static_cast<HeapObject *>(scratch.v.h);
+                std::map<UString, const Identifier *> fields;
+                for (const auto &f : objectFields(obj, true)) {
+                    fields[f->name] = f;
+                }
+                if (fields.size() == 0) {
+                    out += U"{}";
+                    break;
+                }
+                // Indexing the object checks its invariants.
+                runInvariants(loc, obj);
+                bool first = true;
+                for (const auto &f : fields) {
+                    // pushes FRAME_CALL
+                    const Value *cached;
+                    const AST *body = objectIndex(loc, obj, f.second, 0, cached);
+                    stack.top().val = scratch;
+                    if (cached == nullptr) {
+                        evaluate(body, stack.size());
+                        cacheField();
+                    } else {
+                        scratch = *cached;
+                    }
+                    if (!first)
+                        out += U"\n" + cindent;
+                    first = false;
+                    out += jsonnet_string_unparse(f.first, false);
+                    out += U":";
+                    // Arrays are only indented if asked, which allows e.g.
+                    // ports:
+                    // - 80
+                    UString new_indent = cindent;
+                    if (yamlBlock(scratch)) {
+                        if (scratch.t == Value::OBJECT || indent_array_in_object)
+                            new_indent += U"  ";
+                        out += U"\n" + new_indent;
+                    } else {
+                        out += U" ";
+                    }
+                    path.push_back(jsonnet_string_unparse(f.first, false));
+                    manifestYaml(body->location, indent_array_in_object, new_indent, path, out);
+                    path.pop_back();
+                    // Reset scratch so that the object we're manifesting doesn't
+                    // get GC'd.
+                    scratch = stack.top().val;
+                    stack.pop();
+                }
+            } break;
+
+            case Value::STRING: {
+                const UString &str = static_cast<HeapString *>(scratch.v.h)->value();
+                if (str.length() == 0) {
+                    out += U"\"\"";
+                } else if (str.back() == U'\n') {
+                    // A block literal, one line per line of the string.
+                    out += U"|";
+                    size_t start = 0;
+                    for (size_t end = str.find(U'\n'); end != UString::npos;
+                         end = str.find(U'\n', start)) {
+                        out += U"\n" + cindent + U"  ";
+                        out.append(str, start, end - start);
+                        start = end + 1;
+                    }
+                } else {
+                    out += jsonnet_string_unparse(str, false);
+                }
+            } break;
+        }
+    }
+
+    /** Manifest the scratch value by evaluating any remaining fields, and then convert it with the
+     * given builder.
+     *
+     * Like manifestJson, this can trigger a garbage collection cycle, and walks arrays and objects
+     * without recursing.
+     *
+     * \param forced The value was forced by forceValue, so no Jsonnet code runs, not even the
+     *     object invariants, and the builder is only called once the value is complete.
+     */
+    void *manifestValue(const LocationRange &loc, const JsonnetValueBuilder &b, void *ctx,
+                        bool forced = false)
+    {
+        // An array or object whose elements are being built.  While an element is evaluated, the
+        // stack frame pushed for it holds the array or object in val, to keep it alive.
+        struct Level {
+            LocationRange loc;
+            // nullptr for an object
+            HeapArray *arr;
+            std::vector<std::pair<UString, const Identifier *>> fields;
+            size_t size;
+            size_t next;
+            // The value built so far, owned until it is appended to the enclosing one.
+            void *r;
+        };
+        std::vector<Level> levels;
+        try {
+            LocationRange vloc = loc;
+            while (true) {
+                // Build the value in scratch, or start building its elements.
+                void *r = nullptr;
+                bool opened = false;
+                switch (scratch.t) {
+                    case Value::ARRAY: {
+                        auto *arr = static_cast<HeapArray *>(scratch.v.h);
+                        r = b.make_array(ctx);
+                        if (r != nullptr && arr->size() > 0) {
+                            levels.push_back(Level{vloc, arr, {}, arr->size(), 0, r});
+                            opened = true;
+                        }
+                    } break;
+
+                    case Value::BOOLEAN: r = b.make_bool(ctx, scratch.v.b); break;
+
+                    case Value::NUMBER: r = b.make_number(ctx, scratch.v.d); break;
+
+                    case Value::FUNCTION:
+                        throw makeError(vloc, "couldn't manifest function in JSON output.");
+
+                    case Value::NULL_TYPE: r = b.make_null(ctx); break;
+
+                    case Value::OBJECT: {
+                        auto *obj = static_cast<HeapObject *>(scratch.v.h);
+                        if (!forced) {
+                            runInvariants(vloc, obj);
+                            // The invariants overwrote scratch.
+                            scratch.t = Value::OBJECT;
+                            scratch.v.h = obj;
+                        }
+                        // Same order as manifestJson.
+                        std::map<UString, const Identifier *> fields;
+                        for (const auto &f : objectFields(obj, true)) {
+                            fields[f->name] = f;
+                        }
+                        r = b.make_object(ctx);
+                        if (r != nullptr && fields.size() > 0) {
+                            levels.push_back(Level{vloc, nullptr, {fields.begin(), fields.end()},
+                                                   fields.size(), 0, r});
+                            opened = true;
+                        }
+                    } break;
+
+                    case Value::STRING: {
+                        std::string str =
+                            encode_utf8(static_cast<HeapString *>(scratch.v.h)->value());
+                        r = b.make_string(ctx, str.data(), str.length());
+                    } break;
+                }
+                if (r == nullptr)
+                    throw makeError(
+                        vloc, "couldn't build value of type " + type_str(scratch.t) + ".");
+
+                // Append the finished value to its array or object, and those that are finished
+                // in turn to theirs.
+                while (!opened && !levels.empty()) {
+                    Level &l = levels.back();
+                    // Restore scratch to the array or object.
+                    scratch = stack.top().val;
+                    stack.pop();
+                    // The builder owns the element now, even if appending fails.
+                    if (l.arr != nullptr) {
+                        if (!b.array_append(ctx, l.r, r))
+                            throw makeError(vloc, "couldn't build array element.");
+                    } else {
+                        std::string name = encode_utf8(l.fields[l.next - 1].first);
+                        if (!b.object_append(ctx, l.r, name.data(), name.length(), r))
+                            throw makeError(vloc, "couldn't build field " + name + ".");
+                    }
+                    if (l.next < l.size)
+                        break;
+                    r = l.r;
+                    vloc = l.loc;
+                    levels.pop_back();
+                }
+                if (levels.empty())
+                    return r;
+
+                // Start on the next element.
+                Level &l = levels.back();
+                size_t i = l.next++;
+                if (l.arr != nullptr) {
+                    HeapThunk *thunk = l.arr->elements()[i];
+                    if (thunk->filled) {
+                        stack.newCall(l.loc, thunk, nullptr, 0, BindingFrame{});
+                        // Keep arr alive when scratch is overwritten
+                        stack.top().val = scratch;
+                        scratch = thunk->content;
+                    } else {
+                        stack.newCall(l.loc, thunk, thunk->self, thunk->offset, &thunk->upValues);
+                        // Keep arr alive when scratch is overwritten
+                        stack.top().val = scratch;
+                        evaluate(thunk->body, stack.size());
+                        thunk->fill(scratch);
+                        heap.remember(thunk);
+                    }
+                    vloc = thunk->body == nullptr ? l.loc : thunk->body->location;
+                } else {
+                    auto *obj = static_cast<HeapObject *>(scratch.v.h);
+                    // pushes FRAME_CALL
+                    const Value *cached;
+                    const AST *body = objectIndex(l.loc, obj, l.fields[i].second, 0, cached);
+                    // Keep obj alive when scratch is overwritten
+                    stack.top().val = scratch;
+                    if (cached == nullptr) {
+                        evaluate(body, stack.size());
+                        cacheField();
+                    } else {
+                        scratch = *cached;
+                    }
+                    vloc = body->location;
+                }
+            }
+        } catch (...) {
+            for (const auto &l : levels)
+                b.destroy(ctx, l.r);
+            throw;
+        }
+    }
+
+    /** Evaluate the scratch value all the way down, as manifesting it would.
+     *
+     * Afterwards, the value can be manifested with forced set, without running any Jsonnet code
+     * or failing (other than in the builder or sink).
+     */
+    void forceValue(const LocationRange &loc)
+    {
+        manifestValue(loc, force_builder, nullptr);
+    }
+
     UString manifestString(const LocationRange &loc)
     {
         if (scratch.t != Value::STRING) {
@@ -3046,13 +5128,15 @@ class Interpreter {
             ss << "expected string result, got: " << type_str(scratch.t);
             throw makeError(loc, ss.str());
         }
-        return static_cast<HeapString *>(scratch.v.h)->value;
+        return static_cast<HeapString *>(scratch.v.h)->value();
     }
 
-    StrMap manifestMulti(bool string)
+    /** Check the scratch value is an object whose fields hold the files of multi mode.
+     *
+     * \returns The visible fields, in output order.
+     */
+    std::vector<const Identifier *> multiFields(const LocationRange &loc)
     {
-        StrMap r;
-        LocationRange loc("During manifestation");
         if (scratch.t != Value::OBJECT) {
             std::stringstream ss;
             ss << "multi mode: top-level object was a " << type_str(scratch.t) << ", "
@@ -3066,26 +5150,55 @@ class Interpreter {
         for (const auto &f : objectFields(obj, true)) {
             fields[f->name] = f;
         }
+        std::vector<const Identifier *> r;
         for (const auto &f : fields) {
-            // pushes FRAME_CALL
-            const AST *body = objectIndex(loc, obj, f.second, 0);
-            stack.top().val = scratch;
-            evaluate(body, stack.size());
-            auto vstr =
-                string ? manifestString(body->location) : manifestJson(body->location, true, U"");
-            // Reset scratch so that the object we're manifesting doesn't
-            // get GC'd.
-            scratch = stack.top().val;
-            stack.pop();
-            r[encode_utf8(f.first)] = encode_utf8(vstr);
+            r.push_back(f.second);
         }
         return r;
     }
 
-    std::vector<std::string> manifestStream(void)
+    /** Manifest a field of the object in scratch, which is restored afterwards. */
+    std::string manifestMultiField(const LocationRange &loc, const Identifier *field, bool string)
     {
-        std::vector<std::string> r;
+        auto *obj = static_cast<HeapObject *>(scratch.v.h);
+        // pushes FRAME_CALL
+        const Value *cached;
+        const AST *body = objectIndex(loc, obj, field, 0, cached);
+        stack.top().val = scratch;
+        if (cached == nullptr) {
+            evaluate(body, stack.size());
+            cacheField();
+        } else {
+            scratch = *cached;
+        }
+        std::string vstr;
+        if (string)
+            encode_utf8(manifestString(body->location), vstr);
+        else
+            manifestJson(body->location, true, vstr);
+        // Reset scratch so that the object we're manifesting doesn't
+        // get GC'd.
+        scratch = stack.top().val;
+        stack.pop();
+        return vstr;
+    }
+
+    StrMap manifestMulti(bool string)
+    {
+        StrMap r;
         LocationRange loc("During manifestation");
+        for (const auto *f : multiFields(loc)) {
+            r[encode_utf8(f->name)] = manifestMultiField(loc, f, string);
+        }
+        return r;
+    }
+
+    /** Check the scratch value is an array whose elements hold the documents of stream mode.
+     *
+     * \returns The number of documents.
+     */
+    size_t streamSize(const LocationRange &loc)
+    {
         if (scratch.t != Value::ARRAY) {
             std::stringstream ss;
             ss << "stream mode: top-level object was a " << type_str(scratch.t) << ", "
@@ -3093,86 +5206,261 @@ class Interpreter {
                << "the JSON for each document in the stream.";
             throw makeError(loc, ss.str());
         }
-        auto *arr = static_cast<HeapArray *>(scratch.v.h);
-        for (auto *thunk : arr->elements) {
-            LocationRange tloc = thunk->body == nullptr ? loc : thunk->body->location;
-            if (thunk->filled) {
-                stack.newCall(loc, thunk, nullptr, 0, BindingFrame{});
-                // Keep arr alive when scratch is overwritten
-                stack.top().val = scratch;
-                scratch = thunk->content;
-            } else {
-                stack.newCall(loc, thunk, thunk->self, thunk->offset, thunk->upValues);
-                // Keep arr alive when scratch is overwritten
-                stack.top().val = scratch;
-                evaluate(thunk->body, stack.size());
-            }
-            UString element = manifestJson(tloc, true, U"");
-            scratch = stack.top().val;
-            stack.pop();
-            r.push_back(encode_utf8(element));
+        return static_cast<HeapArray *>(scratch.v.h)->size();
+    }
+
+    /** Manifest an element of the array in scratch, which is restored afterwards. */
+    std::string manifestStreamElement(const LocationRange &loc, size_t i)
+    {
+        auto *thunk = static_cast<HeapArray *>(scratch.v.h)->elements()[i];
+        LocationRange tloc = thunk->body == nullptr ? loc : thunk->body->location;
+        if (thunk->filled) {
+            stack.newCall(loc, thunk, nullptr, 0, BindingFrame{});
+            // Keep arr alive when scratch is overwritten
+            stack.top().val = scratch;
+            scratch = thunk->content;
+        } else {
+            stack.newCall(loc, thunk, thunk->self, thunk->offset, &thunk->upValues);
+            // Keep arr alive when scratch is overwritten
+            stack.top().val = scratch;
+            evaluate(thunk->body, stack.size());
+        }
+        std::string element;
+        manifestJson(tloc, true, element);
+        scratch = stack.top().val;
+        stack.pop();
+        return element;
+    }
+
+    std::vector<std::string> manifestStream(void)
+    {
+        std::vector<std::string> r;
+        LocationRange loc("During manifestation");
+        size_t size = streamSize(loc);
+        for (size_t i = 0; i < size; ++i) {
+            r.push_back(manifestStreamElement(loc, i));
         }
         return r;
     }
+
+    /** Keep the scratch value alive until restoreScratch, while other values are evaluated. */
+    void pinScratch(void)
+    {
+        stack.newFrame(FRAME_LOCAL, LocationRange());
+        stack.top().val = scratch;
+    }
+
+    /** Restore the scratch value given to pinScratch. */
+    void restoreScratch(void)
+    {
+        scratch = stack.top().val;
+    }
+};
+
+/** Manifests the documents of multi or stream mode one at a time. */
+class InterpreterIterator : public VmIterator {
+    VmCache &cache;
+    Interpreter vm;
+    LocationRange loc;
+    bool multi;
+    bool stringOutput;
+    std::vector<const Identifier *> fields;
+    size_t size;
+    size_t next_;
+
+   public:
+    InterpreterIterator(Allocator *alloc, VmCache &cache, const AST *ast, const ExtMap &ext_vars,
+                        const ExtMap &tlas, unsigned max_stack, double gc_min_objects,
+                        double gc_growth_trigger, double gc_nursery_objects,
+                        const VmNativeCallbackMap &natives,
+                        JsonnetImportCallback *import_callback, void *ctx, bool multi,
+                        bool string_output)
+        : cache(cache),
+          vm(alloc,
+             cache,
+             ext_vars,
+             max_stack,
+             gc_min_objects,
+             gc_growth_trigger,
+             gc_nursery_objects,
+             natives,
+             import_callback,
+             ctx),
+          loc("During manifestation"),
+          multi(multi),
+          stringOutput(string_output),
+          next_(0)
+    {
+        VmTimer execute_timer(cache.stats.execute_seconds);
+        vm.evaluateTopLevel(ast, tlas);
+        if (multi) {
+            fields = vm.multiFields(loc);
+            size = fields.size();
+        } else {
+            size = vm.streamSize(loc);
+        }
+        vm.pinScratch();
+    }
+
+    bool next(std::string &name, std::string &document)
+    {
+        if (next_ >= size)
+            return false;
+        size_t i = next_++;
+        VmTimer manifest_timer(cache.stats.manifest_seconds);
+        vm.restoreScratch();
+        if (multi) {
+            name = encode_utf8(fields[i]->name);
+            document = vm.manifestMultiField(loc, fields[i], stringOutput);
+        } else {
+            document = vm.manifestStreamElement(loc, i);
+        }
+        return true;
+    }
 };
 
 }  // namespace
 
-std::string jsonnet_vm_execute(Allocator *alloc, const AST *ast, const ExtMap &ext_vars,
-                               unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
-                               const VmNativeCallbackMap &natives,
-                               JsonnetImportCallback *import_callback, void *ctx,
-                               bool string_output)
+Allocator *VmCache::allocator(void)
+{
+    if (!sharesStdlib) {
+        VmTimer timer(stats.desugar_seconds);
+        alloc.share(&shared_stdlib().alloc);
+        sharesStdlib = true;
+    }
+    return &alloc;
+}
+
+void jsonnet_vm_execute(Allocator *alloc, VmCache &cache, const AST *ast,
+                        const ExtMap &ext_vars, const ExtMap &tlas, unsigned max_stack,
+                        double gc_min_objects, double gc_growth_trigger, double gc_nursery_objects,
+                        const VmNativeCallbackMap &natives, JsonnetImportCallback *import_callback,
+                        void *ctx, bool string_output, VmOutput &output)
 {
+    VmTimer execute_timer(cache.stats.execute_seconds);
     Interpreter vm(alloc,
+                   cache,
                    ext_vars,
                    max_stack,
                    gc_min_objects,
                    gc_growth_trigger,
+                   gc_nursery_objects,
                    natives,
                    import_callback,
                    ctx);
-    vm.evaluate(ast, 0);
+    vm.evaluateTopLevel(ast, tlas);
+    execute_timer.stop();
+    VmTimer manifest_timer(cache.stats.manifest_seconds);
+    LocationRange loc("During manifestation");
+    std::string out;
     if (string_output) {
-        return encode_utf8(vm.manifestString(LocationRange("During manifestation")));
+        encode_utf8(vm.manifestString(loc), out);
     } else {
-        return encode_utf8(vm.manifestJson(LocationRange("During manifestation"), true, U""));
+        vm.manifestJson(loc, true, out, &output);
     }
+    out += '\n';
+    vm.flushOutput(loc, out, &output);
 }
 
-StrMap jsonnet_vm_execute_multi(Allocator *alloc, const AST *ast, const ExtMap &ext_vars,
-                                unsigned max_stack, double gc_min_objects, double gc_growth_trigger,
+void *jsonnet_vm_execute_value(Allocator *alloc, VmCache &cache, const AST *ast,
+                               const ExtMap &ext_vars, const ExtMap &tlas, unsigned max_stack,
+                               double gc_min_objects, double gc_growth_trigger,
+                               double gc_nursery_objects,
+                               const VmNativeCallbackMap &natives,
+                               JsonnetImportCallback *import_callback, void *ctx,
+                               const JsonnetValueBuilder &builder, void *builder_ctx)
+{
+    VmTimer execute_timer(cache.stats.execute_seconds);
+    Interpreter vm(alloc,
+                   cache,
+                   ext_vars,
+                   max_stack,
+                   gc_min_objects,
+                   gc_growth_trigger,
+                   gc_nursery_objects,
+                   natives,
+                   import_callback,
+                   ctx);
+    vm.evaluateTopLevel(ast, tlas);
+    execute_timer.stop();
+    VmTimer manifest_timer(cache.stats.manifest_seconds);
+    LocationRange loc("During manifestation");
+    vm.forceValue(loc);
+    return vm.manifestValue(loc, builder, builder_ctx, true);
+}
+
+StrMap jsonnet_vm_execute_multi(Allocator *alloc, VmCache &cache, const AST *ast,
+                                const ExtMap &ext_vars, const ExtMap &tlas, unsigned max_stack,
+                                double gc_min_objects, double gc_growth_trigger,
+                                double gc_nursery_objects,
                                 const VmNativeCallbackMap &natives,
                                 JsonnetImportCallback *import_callback, void *ctx,
                                 bool string_output)
 {
+    VmTimer execute_timer(cache.stats.execute_seconds);
     Interpreter vm(alloc,
+                   cache,
                    ext_vars,
                    max_stack,
                    gc_min_objects,
                    gc_growth_trigger,
+                   gc_nursery_objects,
                    natives,
                    import_callback,
                    ctx);
-    vm.evaluate(ast, 0);
+    vm.evaluateTopLevel(ast, tlas);
+    execute_timer.stop();
+    VmTimer manifest_timer(cache.stats.manifest_seconds);
     return vm.manifestMulti(string_output);
 }
 
-std::vector<std::string> jsonnet_vm_execute_stream(Allocator *alloc, const AST *ast,
-                                                   const ExtMap &ext_vars, unsigned max_stack,
+std::vector<std::string> jsonnet_vm_execute_stream(Allocator *alloc, VmCache &cache,
+                                                   const AST *ast, const ExtMap &ext_vars,
+                                                   const ExtMap &tlas, unsigned max_stack,
                                                    double gc_min_objects, double gc_growth_trigger,
+                                                   double gc_nursery_objects,
                                                    const VmNativeCallbackMap &natives,
                                                    JsonnetImportCallback *import_callback,
                                                    void *ctx)
 {
+    VmTimer execute_timer(cache.stats.execute_seconds);
     Interpreter vm(alloc,
+                   cache,
                    ext_vars,
                    max_stack,
                    gc_min_objects,
                    gc_growth_trigger,
+                   gc_nursery_objects,
                    natives,
                    import_callback,
                    ctx);
-    vm.evaluate(ast, 0);
+    vm.evaluateTopLevel(ast, tlas);
+    execute_timer.stop();
+    VmTimer manifest_timer(cache.stats.manifest_seconds);
     return vm.manifestStream();
 }
+
+std::unique_ptr<VmIterator> jsonnet_vm_execute_iter(Allocator *alloc, VmCache &cache,
+                                                    const AST *ast, const ExtMap &ext_vars,
+                                                    const ExtMap &tlas, unsigned max_stack,
+                                                    double gc_min_objects, double gc_growth_trigger,
+                                                    double gc_nursery_objects,
+                                                    const VmNativeCallbackMap &natives,
+                                                    JsonnetImportCallback *import_callback,
+                                                    void *ctx, bool multi, bool string_output)
+{
+    return std::unique_ptr<VmIterator>(new InterpreterIterator(alloc,
+                                                               cache,
+                                                               ast,
+                                                               ext_vars,
+                                                               tlas,
+                                                               max_stack,
+                                                               gc_min_objects,
+                                                               gc_growth_trigger,
+                                                               gc_nursery_objects,
+                                                               natives,
+                                                               import_callback,
+                                                               ctx,
+                                                               multi,
+                                                               string_output));
+}
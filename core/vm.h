@@ -17,6 +17,9 @@ limitations under the License.
 #ifndef JSONNET_VM_H
 #define JSONNET_VM_H
 
+#include <chrono>
+#include <memory>
+
 #include <libjsonnet.h>
 
 #include "ast.h"
@@ -57,42 +60,170 @@ typedef std::map<std::string, VmNativeCallback> VmNativeCallbackMap;
 struct VmExt {
     std::string data;
     bool isCode;
+    /** If set, the var is bound to this value rather than to data. */
+    std::shared_ptr<const JsonnetJsonValue> value;
     VmExt() : isCode(false) {}
     VmExt(const std::string &data, bool is_code) : data(data), isCode(is_code) {}
+    VmExt(const std::shared_ptr<const JsonnetJsonValue> &value) : isCode(false), value(value) {}
+};
+
+/** A parsed imported file, kept so that it need not be parsed again if it has not changed. */
+struct VmCachedImport {
+    /** The content of the file when it was parsed. */
+    std::string content;
+    /** Owns expr.  Its parent is VmCache::alloc, which interns its identifiers. */
+    std::unique_ptr<Allocator> alloc;
+    /** The desugared and analysed file. */
+    AST *expr;
+    VmCachedImport() : expr(nullptr) {}
+};
+
+/** State that outlives a single execution.
+ *
+ * Executions that share a cache only parse an imported file again if the import callback returns
+ * different content for it.  The stdlib is only parsed once per process.  The import callback is
+ * still called for every execution, so edits to files are always seen.  A cache must not be used
+ * by two threads at the same time, but executions may interleave, e.g. other executions may run
+ * while a VmIterator is alive.
+ */
+struct VmCache {
+    /** Owns the cached ASTs, apart from those of imports.  Also interns the identifiers of every
+     * allocator that has it as parent, which must be the case for the allocator given to
+     * jsonnet_vm_execute.  Only use it through allocator().
+     */
+    Allocator alloc;
+
+    /** Whether alloc shares the identifiers of the stdlib yet. */
+    bool sharesStdlib;
+
+    /** Imported Jsonnet files, keyed by the path where they were found. */
+    std::map<std::string, VmCachedImport> imports;
+
+    /** The allocators of cached imports that were replaced by newer content.
+     *
+     * The thunks of any execution still alive may refer to their ASTs, so they are only freed
+     * once there is none.
+     */
+    std::vector<std::unique_ptr<Allocator>> replacedImports;
+
+    /** The number of executions alive, i.e. of Interpreters using this cache. */
+    unsigned interpreters;
+
+    /** The statistics of the latest execution, which the caller resets before each one. */
+    JsonnetStats stats;
+
+    VmCache() : sharesStdlib(false), interpreters(0), stats() {}
+
+    /** Returns alloc, ready to be the parent of the allocator given to jsonnet_vm_execute.
+     *
+     * The first call builds the stdlib, if no other cache in the process has done so already.
+     */
+    Allocator *allocator(void);
+};
+
+/** Adds the time from its construction to its destruction (or stop) to the given total. */
+class VmTimer {
+    double *total;
+    std::chrono::steady_clock::time_point start;
+
+   public:
+    VmTimer(double &total) : total(&total), start(std::chrono::steady_clock::now()) {}
+
+    ~VmTimer(void)
+    {
+        stop();
+    }
+
+    void stop(void)
+    {
+        if (total == nullptr)
+            return;
+        std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - start;
+        *total += elapsed.count();
+        total = nullptr;
+    }
 };
 
-/** Execute the program and return the value as a JSON string.
+/** Receives the output of an execution a piece at a time, as it is manifested. */
+class VmOutput {
+   public:
+    virtual ~VmOutput(void) {}
+
+    /** Write the next piece of the output.
+     *
+     * \param buf UTF-8, not \0 terminated.
+     * \returns false if the output could not be written, which aborts the execution.
+     */
+    virtual bool write(const char *buf, size_t len) = 0;
+};
+
+/** Execute the program and write the value as JSON to the given output.
  *
- * \param alloc The allocator used to create the ast.
+ * The JSON is written in pieces while it is manifested, so it is never held in memory as a
+ * whole.  It is followed by a newline.
+ *
+ * \param alloc Allocator for code parsed during execution, which shares identifiers with ast.
+ * \param cache State shared with other executions.
  * \param ast The program to execute.
  * \param ext The external vars / code.
+ * \param tla The top-level arguments (strings or code), used if the program yields a function.
  * \param max_stack Recursion beyond this level gives an error.
  * \param gc_min_objects The garbage collector does not run when the heap is this small.
  * \param gc_growth_trigger Growth since last garbage collection cycle to trigger a new cycle.
+ * \param gc_nursery_objects Entities allocated since the last cycle that trigger a minor cycle.
  * \param import_callback A callback to handle imports
  * \param import_callback_ctx Context param for the import callback.
  * \param output_string Whether to expect a string and output it without JSON encoding
- * \throws RuntimeError reports runtime errors in the program.
- * \returns The JSON result in string form.
+ * \param output Where the JSON result is written.
+ * \throws RuntimeError reports runtime errors in the program, or a failing output.
  */
-std::string jsonnet_vm_execute(Allocator *alloc, const AST *ast,
-                               const std::map<std::string, VmExt> &ext, unsigned max_stack,
+void jsonnet_vm_execute(Allocator *alloc, VmCache &cache, const AST *ast,
+                        const std::map<std::string, VmExt> &ext,
+                        const std::map<std::string, VmExt> &tla, unsigned max_stack,
+                        double gc_min_objects, double gc_growth_trigger, double gc_nursery_objects,
+                        const VmNativeCallbackMap &natives, JsonnetImportCallback *import_callback,
+                        void *import_callback_ctx, bool string_output, VmOutput &output);
+
+/** Execute the program and return the value as built by the given builder.
+ *
+ * \param alloc Allocator for code parsed during execution, which shares identifiers with ast.
+ * \param cache State shared with other executions.
+ * \param ast The program to execute.
+ * \param ext The external vars / code.
+ * \param tla The top-level arguments (strings or code), used if the program yields a function.
+ * \param max_stack Recursion beyond this level gives an error.
+ * \param gc_min_objects The garbage collector does not run when the heap is this small.
+ * \param gc_growth_trigger Growth since last garbage collection cycle to trigger a new cycle.
+ * \param gc_nursery_objects Entities allocated since the last cycle that trigger a minor cycle.
+ * \param import_callback A callback to handle imports
+ * \param import_callback_ctx Context param for the import callback.
+ * \param builder Callbacks used to build the value, once it has been evaluated all the way down.
+ * \param builder_ctx Context param for the builder.
+ * \throws RuntimeError reports runtime errors in the program, or a failing builder.
+ * \returns The value made by the builder.
+ */
+void *jsonnet_vm_execute_value(Allocator *alloc, VmCache &cache, const AST *ast,
+                               const std::map<std::string, VmExt> &ext,
+                               const std::map<std::string, VmExt> &tla, unsigned max_stack,
                                double gc_min_objects, double gc_growth_trigger,
+                               double gc_nursery_objects,
                                const VmNativeCallbackMap &natives,
                                JsonnetImportCallback *import_callback, void *import_callback_ctx,
-                               bool string_output);
+                               const JsonnetValueBuilder &builder, void *builder_ctx);
 
 /** Execute the program and return the value as a number of named JSON files.
  *
  * This assumes the given program yields an object whose keys are filenames.
  *
- * \param alloc The allocator used to create the ast.
+ * \param alloc Allocator for code parsed during execution, which shares identifiers with ast.
+ * \param cache State shared with other executions.
  * \param ast The program to execute.
  * \param ext The external vars / code.
- * \param tla The top-level arguments (strings or code).
+ * \param tla The top-level arguments (strings or code), used if the program yields a function.
  * \param max_stack Recursion beyond this level gives an error.
  * \param gc_min_objects The garbage collector does not run when the heap is this small.
  * \param gc_growth_trigger Growth since last garbage collection cycle to trigger a new cycle.
+ * \param gc_nursery_objects Entities allocated since the last cycle that trigger a minor cycle.
  * \param import_callback A callback to handle imports
  * \param import_callback_ctx Context param for the import callback.
  * \param output_string Whether to expect a string and output it without JSON encoding
@@ -100,8 +231,10 @@ std::string jsonnet_vm_execute(Allocator *alloc, const AST *ast,
  * \returns A mapping from filename to the JSON strings for that file.
  */
 std::map<std::string, std::string> jsonnet_vm_execute_multi(
-    Allocator *alloc, const AST *ast, const std::map<std::string, VmExt> &ext, unsigned max_stack,
-    double gc_min_objects, double gc_growth_trigger, const VmNativeCallbackMap &natives,
+    Allocator *alloc, VmCache &cache, const AST *ast, const std::map<std::string, VmExt> &ext,
+    const std::map<std::string, VmExt> &tla, unsigned max_stack, double gc_min_objects,
+    double gc_growth_trigger, double gc_nursery_objects,
+    const VmNativeCallbackMap &natives,
     JsonnetImportCallback *import_callback, void *import_callback_ctx, bool string_output);
 
 /** Execute the program and return the value as a stream of JSON files.
@@ -109,13 +242,15 @@ std::map<std::string, std::string> jsonnet_vm_execute_multi(
  * This assumes the given program yields an array whose elements are individual
  * JSON files.
  *
- * \param alloc The allocator used to create the ast.
+ * \param alloc Allocator for code parsed during execution, which shares identifiers with ast.
+ * \param cache State shared with other executions.
  * \param ast The program to execute.
  * \param ext The external vars / code.
- * \param tla The top-level arguments (strings or code).
+ * \param tla The top-level arguments (strings or code), used if the program yields a function.
  * \param max_stack Recursion beyond this level gives an error.
  * \param gc_min_objects The garbage collector does not run when the heap is this small.
  * \param gc_growth_trigger Growth since last garbage collection cycle to trigger a new cycle.
+ * \param gc_nursery_objects Entities allocated since the last cycle that trigger a minor cycle.
  * \param import_callback A callback to handle imports
  * \param import_callback_ctx Context param for the import callback.
  * \param output_string Whether to expect a string and output it without JSON encoding
@@ -123,8 +258,41 @@ std::map<std::string, std::string> jsonnet_vm_execute_multi(
  * \returns A mapping from filename to the JSON strings for that file.
  */
 std::vector<std::string> jsonnet_vm_execute_stream(
-    Allocator *alloc, const AST *ast, const std::map<std::string, VmExt> &ext, unsigned max_stack,
-    double gc_min_objects, double gc_growth_trigger, const VmNativeCallbackMap &natives,
+    Allocator *alloc, VmCache &cache, const AST *ast, const std::map<std::string, VmExt> &ext,
+    const std::map<std::string, VmExt> &tla, unsigned max_stack, double gc_min_objects,
+    double gc_growth_trigger, double gc_nursery_objects,
+    const VmNativeCallbackMap &natives,
     JsonnetImportCallback *import_callback, void *import_callback_ctx);
 
+/** The documents of a multi or stream mode execution, manifested one at a time. */
+class VmIterator {
+   public:
+    virtual ~VmIterator(void) {}
+
+    /** Manifest the next document.
+     *
+     * \param name Set to the filename in multi mode.
+     * \param document Set to the JSON (or string) for the document.
+     * \throws RuntimeError reports runtime errors in the program.
+     * \returns false if there are no more documents.
+     */
+    virtual bool next(std::string &name, std::string &document) = 0;
+};
+
+/** Execute the program up to the object (multi mode) or array (stream mode) holding the
+ * documents, which are then manifested on demand by the returned iterator.
+ *
+ * The parameters are as for jsonnet_vm_execute_multi.  The allocator and cache must outlive the
+ * iterator.
+ *
+ * \param multi Whether to use multi mode rather than stream mode.
+ * \throws RuntimeError reports runtime errors in the program.
+ */
+std::unique_ptr<VmIterator> jsonnet_vm_execute_iter(
+    Allocator *alloc, VmCache &cache, const AST *ast, const std::map<std::string, VmExt> &ext,
+    const std::map<std::string, VmExt> &tla, unsigned max_stack, double gc_min_objects,
+    double gc_growth_trigger, double gc_nursery_objects, const VmNativeCallbackMap &natives,
+    JsonnetImportCallback *import_callback, void *import_callback_ctx, bool multi,
+    bool string_output);
+
 #endif
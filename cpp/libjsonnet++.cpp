@@ -53,6 +53,11 @@ void Jsonnet::setGcGrowthTrigger(double growth)
     ::jsonnet_gc_growth_trigger(vm_, growth);
 }
 
+void Jsonnet::setGcNurseryObjects(uint32_t objects)
+{
+    ::jsonnet_gc_nursery_objects(vm_, static_cast<unsigned>(objects));
+}
+
 void Jsonnet::setStringOutput(bool string_output)
 {
     ::jsonnet_string_output(vm_, string_output);
@@ -56,6 +56,10 @@ class Jsonnet {
     /// objects.
     void setGcGrowthTrigger(double growth);
 
+    /// Run a minor garbage collection cycle once this many objects were
+    /// allocated since the previous cycle, or never if 0.
+    void setGcNurseryObjects(uint32_t objects);
+
     /// Set whether to expect a string as output and don't JSON encode it.
     void setStringOutput(bool string_output);
 
@@ -39,7 +39,13 @@ limitations under the License.
  */
 const char *jsonnet_version(void);
 
-/** Jsonnet virtual machine context. */
+/** Jsonnet virtual machine context.
+ *
+ * A vm can be used for any number of evaluations.  It caches the parsed standard library and
+ * imported files between them, so re-using a vm is much cheaper than making a new one for each
+ * evaluation.  Imported files are still loaded each time and only parsed again if they changed.
+ * A vm must not be used from more than one thread at a time.
+ */
 struct JsonnetVm;
 
 /** Create a new Jsonnet virtual machine. */
@@ -54,6 +60,11 @@ void jsonnet_gc_min_objects(struct JsonnetVm *vm, unsigned v);
 /** Run the garbage collector after this amount of growth in the number of objects. */
 void jsonnet_gc_growth_trigger(struct JsonnetVm *vm, double v);
 
+/** Run a minor garbage collection cycle, which only collects the objects allocated since the
+ * previous cycle, once there are this many of them.  0 disables minor cycles.
+ */
+void jsonnet_gc_nursery_objects(struct JsonnetVm *vm, unsigned v);
+
 /** Expect a string as output and don't JSON encode it. */
 void jsonnet_string_output(struct JsonnetVm *vm, int v);
 
@@ -147,6 +158,8 @@ void jsonnet_json_destroy(struct JsonnetVm *vm, struct JsonnetJsonValue *v);
  * along with the objects rooted at argv by libjsonnet when no-longer needed.  Return a string upon
  * failure, which will appear in Jsonnet as an error.  The argv pointer is an array whose size
  * matches the array of parameters supplied when the native callback was originally registered.
+ * Array and object arguments are fully evaluated before the call, with hidden fields omitted; use
+ * jsonnet_json_extract_value to read them.
  *
  * \param ctx User pointer, given in jsonnet_native_callback.
  * \param argv Array of arguments from Jsonnet code.
@@ -210,6 +223,25 @@ void jsonnet_tla_var(struct JsonnetVm *vm, const char *key, const char *val);
  */
 void jsonnet_tla_code(struct JsonnetVm *vm, const char *key, const char *val);
 
+/** Bind a Jsonnet external var to the given value, built with the jsonnet_json_make_* functions.
+ *
+ * Unlike jsonnet_ext_code, the value is not lexed or parsed, which matters for large data.  The vm
+ * takes ownership of val.
+ */
+void jsonnet_ext_value(struct JsonnetVm *vm, const char *key, struct JsonnetJsonValue *val);
+
+/** Bind a top-level argument for a top-level parameter to the given value.
+ *
+ * \see jsonnet_ext_value
+ */
+void jsonnet_tla_value(struct JsonnetVm *vm, const char *key, struct JsonnetJsonValue *val);
+
+/** Forget all external vars, code and values bound so far. */
+void jsonnet_ext_clear(struct JsonnetVm *vm);
+
+/** Forget all top-level arguments bound so far. */
+void jsonnet_tla_clear(struct JsonnetVm *vm);
+
 /** Set the number of lines of stack trace to display (0 for all of them). */
 void jsonnet_max_trace(struct JsonnetVm *vm, unsigned v);
 
@@ -241,6 +273,41 @@ char *jsonnet_evaluate_file(struct JsonnetVm *vm, const char *filename, int *err
 char *jsonnet_evaluate_snippet(struct JsonnetVm *vm, const char *filename, const char *snippet,
                                int *error);
 
+/** Callback used to write the output of an evaluation a piece at a time.
+ * \see jsonnet_evaluate_file_to.
+ *
+ * \param ctx User pointer, given in jsonnet_evaluate_file_to.
+ * \param buf The next piece of the UTF8 output, not \0 terminated.
+ * \param len The length of buf.
+ * \returns Non-zero on success, or 0 to abort the evaluation.
+ */
+typedef int JsonnetOutputCallback(void *ctx, const char *buf, size_t len);
+
+/** Evaluate a file containing Jsonnet code, writing the JSON to the given callback.
+ *
+ * The output is the same as that of jsonnet_evaluate_file, but it is written while it is being
+ * manifested, so it is never held in memory as a whole.  If there is an error, some of it may
+ * already have been written.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param cb Called with each piece of the output, in order.
+ * \param ctx User pointer, passed to cb.
+ * \param error Set to NULL on success, otherwise to the error message, which should be cleaned up
+ *     with jsonnet_realloc.
+ */
+void jsonnet_evaluate_file_to(struct JsonnetVm *vm, const char *filename,
+                              JsonnetOutputCallback *cb, void *ctx, char **error);
+
+/** Evaluate a string containing Jsonnet code, writing the JSON to the given callback.
+ *
+ * \see jsonnet_evaluate_file_to.
+ *
+ * \param filename Path to a file (used in error messages).
+ * \param snippet Jsonnet code to execute.
+ */
+void jsonnet_evaluate_snippet_to(struct JsonnetVm *vm, const char *filename, const char *snippet,
+                                 JsonnetOutputCallback *cb, void *ctx, char **error);
+
 /** Evaluate a file containing Jsonnet code, return a number of named JSON files.
  *
  * The returned character buffer contains an even number of strings, the filename and JSON for each
@@ -289,6 +356,237 @@ char *jsonnet_evaluate_file_stream(struct JsonnetVm *vm, const char *filename, i
 char *jsonnet_evaluate_snippet_stream(struct JsonnetVm *vm, const char *filename,
                                       const char *snippet, int *error);
 
+/** Callbacks that build the result of an evaluation in the caller's own representation, instead of
+ * manifesting it as a JSON string.  \see jsonnet_evaluate_file_value.
+ *
+ * Values are built bottom-up: an element or field is complete when it is added to its array or
+ * object, which takes ownership of it (even if the append fails).  Object fields are added in the
+ * same order as in the JSON output, and hidden fields are omitted.  Any callback returning NULL (or
+ * 0) aborts the evaluation, after which libjsonnet destroys the values it still owns.
+ *
+ * The builder is only called once the value has been evaluated all the way down, so no Jsonnet
+ * code (e.g. native callbacks or imports) runs between the callbacks.
+ */
+struct JsonnetValueBuilder {
+    void *(*make_null)(void *ctx);
+    void *(*make_bool)(void *ctx, int v);
+    void *(*make_number)(void *ctx, double v);
+    /** The UTF8 string v is not \0 terminated. */
+    void *(*make_string)(void *ctx, const char *v, size_t len);
+    void *(*make_array)(void *ctx);
+    int (*array_append)(void *ctx, void *arr, void *v);
+    void *(*make_object)(void *ctx);
+    /** The UTF8 field name f is not \0 terminated. */
+    int (*object_append)(void *ctx, void *obj, const char *f, size_t len, void *v);
+    void (*destroy)(void *ctx, void *v);
+};
+
+/** Evaluate a file containing Jsonnet code, return the value built by the given builder.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param builder Callbacks used to build the value.
+ * \param ctx User pointer, passed to the builder callbacks.
+ * \param error Set to NULL on success, otherwise to the error message, which should be cleaned up
+ *     with jsonnet_realloc.
+ * \returns The value, or NULL if there was an error.
+ */
+void *jsonnet_evaluate_file_value(struct JsonnetVm *vm, const char *filename,
+                                  const struct JsonnetValueBuilder *builder, void *ctx,
+                                  char **error);
+
+/** Evaluate a string containing Jsonnet code, return the value built by the given builder.
+ *
+ * \param filename Path to a file (used in error messages).
+ * \param snippet Jsonnet code to execute.
+ * \param builder Callbacks used to build the value.
+ * \param ctx User pointer, passed to the builder callbacks.
+ * \param error Set to NULL on success, otherwise to the error message, which should be cleaned up
+ *     with jsonnet_realloc.
+ * \returns The value, or NULL if there was an error.
+ */
+void *jsonnet_evaluate_snippet_value(struct JsonnetVm *vm, const char *filename,
+                                     const char *snippet,
+                                     const struct JsonnetValueBuilder *builder, void *ctx,
+                                     char **error);
+
+/** Convert a value given to a native callback with the given builder, e.g. to turn an array or
+ * object argument into the caller's own representation.
+ *
+ * \param builder Callbacks used to build the value.
+ * \param ctx User pointer, passed to the builder callbacks.
+ * \returns The value, or NULL if a builder callback failed.
+ */
+void *jsonnet_json_extract_value(struct JsonnetVm *vm, const struct JsonnetJsonValue *v,
+                                 const struct JsonnetValueBuilder *builder, void *ctx);
+
+/** The documents of a multi or stream mode evaluation, which are manifested one at a time as they
+ * are requested, so only one is held in memory at once.
+ *
+ * An iterator belongs to the vm that made it, and must be destroyed before it.  The vm may be used
+ * for other evaluations in between calls to jsonnet_iterator_next.
+ */
+struct JsonnetIterator;
+
+/** Evaluate a file containing Jsonnet code, up to the object holding the JSON files of multi mode.
+ *
+ * \see jsonnet_evaluate_file_multi.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param error Set to NULL on success, otherwise to the error message, which should be cleaned up
+ *     with jsonnet_realloc.
+ * \returns An iterator over the files, or NULL if there was an error.
+ */
+struct JsonnetIterator *jsonnet_evaluate_file_multi_iter(struct JsonnetVm *vm, const char *filename,
+                                                         char **error);
+
+/** Evaluate a string containing Jsonnet code, up to the object holding the JSON files of multi
+ * mode.
+ *
+ * \see jsonnet_evaluate_file_multi_iter.
+ */
+struct JsonnetIterator *jsonnet_evaluate_snippet_multi_iter(struct JsonnetVm *vm,
+                                                            const char *filename,
+                                                            const char *snippet, char **error);
+
+/** Evaluate a file containing Jsonnet code, up to the array holding the JSON documents of stream
+ * mode.
+ *
+ * \see jsonnet_evaluate_file_multi_iter.
+ */
+struct JsonnetIterator *jsonnet_evaluate_file_stream_iter(struct JsonnetVm *vm,
+                                                          const char *filename, char **error);
+
+/** Evaluate a string containing Jsonnet code, up to the array holding the JSON documents of stream
+ * mode.
+ *
+ * \see jsonnet_evaluate_file_multi_iter.
+ */
+struct JsonnetIterator *jsonnet_evaluate_snippet_stream_iter(struct JsonnetVm *vm,
+                                                             const char *filename,
+                                                             const char *snippet, char **error);
+
+/** Manifest the next document.
+ *
+ * The returned strings should be cleaned up with jsonnet_realloc.  After an error, there are no
+ * more documents.
+ *
+ * \param name Set to the filename in multi mode, otherwise NULL.
+ * \param error Return by reference whether or not there was an error.
+ * \returns The JSON document, the error message, or NULL if there are no more documents.
+ */
+char *jsonnet_iterator_next(struct JsonnetVm *vm, struct JsonnetIterator *it, char **name,
+                            int *error);
+
+/** Clean up an iterator, whether or not all its documents were manifested. */
+void jsonnet_iterator_destroy(struct JsonnetVm *vm, struct JsonnetIterator *it);
+
+/** A program that has been lexed, parsed, desugared and statically analysed, ready to be evaluated
+ * any number of times with different external variables and top-level arguments.
+ *
+ * A program belongs to the vm that compiled it.  It can only be evaluated with that vm and must be
+ * destroyed before it.
+ */
+struct JsonnetProgram;
+
+/** Compile a file containing Jsonnet code.
+ *
+ * \param filename Path to a file containing Jsonnet code.
+ * \param error Set to NULL on success, otherwise to the error message, which should be cleaned up
+ *     with jsonnet_realloc.
+ * \returns The program, or NULL if there was an error.
+ */
+struct JsonnetProgram *jsonnet_compile_file(struct JsonnetVm *vm, const char *filename,
+                                            char **error);
+
+/** Compile a string containing Jsonnet code.
+ *
+ * \param filename Path to a file (used in error messages).
+ * \param snippet Jsonnet code to compile.
+ * \param error Set to NULL on success, otherwise to the error message, which should be cleaned up
+ *     with jsonnet_realloc.
+ * \returns The program, or NULL if there was an error.
+ */
+struct JsonnetProgram *jsonnet_compile_snippet(struct JsonnetVm *vm, const char *filename,
+                                               const char *snippet, char **error);
+
+/** Evaluate a compiled program with the vm's current settings, return a JSON string.
+ *
+ * The returned string should be cleaned up with jsonnet_realloc.
+ *
+ * \param error Return by reference whether or not there was an error.
+ * \returns Either JSON or the error message.
+ */
+char *jsonnet_program_evaluate(struct JsonnetVm *vm, struct JsonnetProgram *program, int *error);
+
+/** Evaluate a compiled program, return the value built by the given builder.
+ *
+ * \see jsonnet_evaluate_file_value for the parameters.
+ */
+void *jsonnet_program_evaluate_value(struct JsonnetVm *vm, struct JsonnetProgram *program,
+                                     const struct JsonnetValueBuilder *builder, void *ctx,
+                                     char **error);
+
+/** Evaluate a compiled program, writing the JSON to the given callback.
+ *
+ * \see jsonnet_evaluate_file_to for the parameters.
+ */
+void jsonnet_program_evaluate_to(struct JsonnetVm *vm, struct JsonnetProgram *program,
+                                 JsonnetOutputCallback *cb, void *ctx, char **error);
+
+/** Clean up a compiled program. */
+void jsonnet_program_destroy(struct JsonnetVm *vm, struct JsonnetProgram *program);
+
+/** Counters and timings of an evaluation, to find out why it is slow.
+ *
+ * The lex, parse, desugar and static analysis times include imported files, code given as ext vars
+ * or top-level arguments.  The first evaluation in the process also builds the stdlib, which is
+ * counted as desugaring.  The execute time covers evaluating the program up to its value, which is
+ * lazy; the fields and elements of that value are evaluated while it is manifested, and counted as
+ * manifest time.  Both include the time spent loading imports and collecting garbage.
+ */
+struct JsonnetStats {
+    double lex_seconds;
+    double parse_seconds;
+    double desugar_seconds;
+    double static_analysis_seconds;
+    double execute_seconds;
+    double manifest_seconds;
+
+    /** Heap entities allocated, by type. */
+    unsigned long heap_thunks;
+    unsigned long heap_arrays;
+    unsigned long heap_closures;
+    unsigned long heap_strings;
+    unsigned long heap_simple_objects;
+    unsigned long heap_comprehension_objects;
+    unsigned long heap_extended_objects;
+
+    /** The most entities there were on the heap at once. */
+    unsigned long max_heap_entities;
+    unsigned long gc_cycles;
+    /** Of gc_cycles, those that only collected the objects allocated since the previous one. */
+    unsigned long gc_minor_cycles;
+    double gc_mark_seconds;
+    double gc_sweep_seconds;
+
+    /** The most calls there were on the stack at once, see jsonnet_max_stack. */
+    unsigned max_stack_depth;
+
+    /** Imports of Jsonnet code that did not need parsing, because the file was already imported
+     * by this evaluation, or by an earlier one on the same vm with the same content.
+     */
+    unsigned long import_cache_hits;
+    /** Imports of Jsonnet code that were parsed. */
+    unsigned long import_cache_misses;
+};
+
+/** The statistics of the latest evaluation, or compilation, with this vm.
+ *
+ * They are also updated as the documents of an iterator are manifested.  The result is valid
+ * until the vm is destroyed.
+ */
+const struct JsonnetStats *jsonnet_stats(struct JsonnetVm *vm);
+
 /** Complement of \see jsonnet_vm_make. */
 void jsonnet_destroy(struct JsonnetVm *vm);
 
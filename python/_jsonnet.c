@@ -14,8 +14,10 @@ See the License for the specific language governing permissions and
 limitations under the License.
 */
 
+#include <math.h>
 #include <stdlib.h>
 #include <stdio.h>
+#include <string.h>
 
 #include <Python.h>
 
@@ -40,6 +42,122 @@ static const char *exc_to_str(void)
 #endif
 }
 
+/* Builds Python objects from the result of an evaluation, or from the arguments of a native
+ * callback, see struct JsonnetValueBuilder.  The context is a struct PythonBuilder, or NULL if the
+ * GIL is held and keys need not be shared.
+ */
+struct PythonBuilder {
+    /* The thread state saved when evaluation released the GIL, or NULL if the GIL is held.  The
+     * first callback then takes the GIL back and keeps it until the evaluation returns, rather
+     * than taking it for every value.  This is only done once the value has been evaluated all
+     * the way down, so no Jsonnet code runs with the GIL held.
+     */
+    PyThreadState *save;
+    /* The field names built so far, so that equal keys share one str, as with json.loads. */
+    PyObject *keys;
+};
+
+static void python_builder_lock(void *ctx)
+{
+    struct PythonBuilder *b = ctx;
+    if (b != NULL && b->save != NULL) {
+        PyEval_RestoreThread(b->save);
+        b->save = NULL;
+    }
+}
+
+static void *python_make_null(void *ctx)
+{
+    python_builder_lock(ctx);
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static void *python_make_bool(void *ctx, int v)
+{
+    python_builder_lock(ctx);
+    return PyBool_FromLong(v);
+}
+
+static void *python_make_number(void *ctx, double v)
+{
+    python_builder_lock(ctx);
+    /* Give what json.loads gives for the JSON output: jsonnet_unparse_number prints every
+     * integral number without a fraction or exponent (even 1e300), so they become ints.
+     */
+    if (v == floor(v))
+        return PyLong_FromDouble(v);
+    return PyFloat_FromDouble(v);
+}
+
+static void *python_make_string(void *ctx, const char *v, size_t len)
+{
+    python_builder_lock(ctx);
+    return PyUnicode_DecodeUTF8(v, len, NULL);
+}
+
+static void *python_make_array(void *ctx)
+{
+    python_builder_lock(ctx);
+    return PyList_New(0);
+}
+
+static int python_array_append(void *ctx, void *arr, void *v)
+{
+    int r;
+    python_builder_lock(ctx);
+    r = PyList_Append(arr, v) == 0;
+    Py_DECREF((PyObject *)v);
+    return r;
+}
+
+static void *python_make_object(void *ctx)
+{
+    python_builder_lock(ctx);
+    return PyDict_New();
+}
+
+static int python_object_append(void *ctx, void *obj, const char *f, size_t len, void *v)
+{
+    PyObject *key;
+    int r;
+    struct PythonBuilder *b = ctx;
+    python_builder_lock(ctx);
+    key = PyUnicode_DecodeUTF8(f, len, NULL);
+    if (key != NULL && b != NULL) {
+        PyObject *shared = PyDict_GetItem(b->keys, key);
+        if (shared != NULL) {
+            Py_INCREF(shared);
+            Py_DECREF(key);
+            key = shared;
+        } else if (PyDict_SetItem(b->keys, key, key) != 0) {
+            Py_CLEAR(key);
+        }
+    }
+    r = key != NULL && PyDict_SetItem(obj, key, v) == 0;
+    Py_XDECREF(key);
+    Py_DECREF((PyObject *)v);
+    return r;
+}
+
+static void python_destroy(void *ctx, void *v)
+{
+    python_builder_lock(ctx);
+    Py_DECREF((PyObject *)v);
+}
+
+static const struct JsonnetValueBuilder python_builder = {
+    python_make_null,
+    python_make_bool,
+    python_make_number,
+    python_make_string,
+    python_make_array,
+    python_array_append,
+    python_make_object,
+    python_object_append,
+    python_destroy,
+};
+
 struct NativeCtx {
     struct JsonnetVm *vm;
     PyObject *callback;
@@ -47,7 +165,10 @@ struct NativeCtx {
 };
 
 static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyObject *v,
-                                                       const char **err_msg)
+                                                       const char **err_msg);
+
+static struct JsonnetJsonValue *python_to_jsonnet_json_aux(struct JsonnetVm *vm, PyObject *v,
+                                                           const char **err_msg)
 {
 #if PY_MAJOR_VERSION < 3
     if (PyString_Check(v)) {
@@ -58,6 +179,12 @@ static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyO
 #endif
         struct JsonnetJsonValue *r;
         PyObject *str = PyUnicode_AsUTF8String(v);
+        if (str == NULL) {
+            /* E.g. a lone surrogate. */
+            PyErr_Clear();
+            *err_msg = "String not encodable as UTF-8";
+            return NULL;
+        }
 #if PY_MAJOR_VERSION >= 3
         const char *cstr = PyBytes_AsString(str);
 #else
@@ -69,10 +196,25 @@ static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyO
     } else if (PyBool_Check(v)) {
         return jsonnet_json_make_bool(vm, PyObject_IsTrue(v));
     } else if (PyFloat_Check(v)) {
-        return jsonnet_json_make_number(vm, PyFloat_AsDouble(v));
+        double d = PyFloat_AsDouble(v);
+        if (!isfinite(d)) {
+            *err_msg = "Non-finite number";
+            return NULL;
+        }
+        return jsonnet_json_make_number(vm, d);
 #if PY_MAJOR_VERSION >= 3
     } else if (PyLong_Check(v)) {
-        return jsonnet_json_make_number(vm, (double)(PyLong_AsLong(v)));
+        double d = PyLong_AsDouble(v);
+        if (PyErr_Occurred()) {
+            PyErr_Clear();
+            *err_msg = "Integer too large";
+            return NULL;
+        }
+        return jsonnet_json_make_number(vm, d);
+    } else if (PyBytes_Check(v) || PyByteArray_Check(v)) {
+        /* These are sequences, but of ints rather than of characters. */
+        *err_msg = "Bytes instead of str";
+        return NULL;
 #else
     } else if (PyInt_Check(v)) {
         return jsonnet_json_make_number(vm, (double)(PyInt_AsLong(v)));
@@ -84,6 +226,11 @@ static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyO
         struct JsonnetJsonValue *arr;
         // Convert it to a O(1) indexable form if necessary.
         PyObject *fast = PySequence_Fast(v, "python_to_jsonnet_json internal error: not sequence");
+        if (fast == NULL) {
+            PyErr_Clear();
+            *err_msg = "Sequence could not be read";
+            return NULL;
+        }
         len = PySequence_Fast_GET_SIZE(fast);
         arr = jsonnet_json_make_array(vm);
         for (i = 0; i < len; ++i) {
@@ -112,7 +259,8 @@ static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyO
             const char *key_ = PyString_AsString(key);
 #endif
             if (key_ == NULL) {
-                *err_msg = "Non-string key in dict returned from Python Jsonnet native extension.";
+                PyErr_Clear();
+                *err_msg = "Non-string key in dict";
                 jsonnet_json_destroy(vm, obj);
                 return NULL;
             }
@@ -125,19 +273,35 @@ static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyO
         }
         return obj;
     } else {
-        *err_msg = "Unrecognized type return from Python Jsonnet native extension.";
+        *err_msg = "Unrecognized type";
         return NULL;
     }
 }
 
-/* This function is bound for every native callback, but with a different
- * context.
+/* Convert a value returned from a native callback, or given as an ext / tla value.  Upon failure,
+ * returns NULL and sets err_msg to what was wrong with the value.
+ *
+ * A list or dict that contains itself would otherwise recurse until the C stack overflows.
  */
-static struct JsonnetJsonValue *cpython_native_callback(
+static struct JsonnetJsonValue *python_to_jsonnet_json(struct JsonnetVm *vm, PyObject *v,
+                                                       const char **err_msg)
+{
+    struct JsonnetJsonValue *r;
+    if (Py_EnterRecursiveCall(" converting a native extension result")) {
+        PyErr_Clear();
+        *err_msg = "Cyclic or too deeply nested value";
+        return NULL;
+    }
+    r = python_to_jsonnet_json_aux(vm, v, err_msg);
+    Py_LeaveRecursiveCall();
+    return r;
+}
+
+static struct JsonnetJsonValue *cpython_native_callback_locked(
     void *ctx_, const struct JsonnetJsonValue * const *argv, int *succ)
 {
     const struct NativeCtx *ctx = ctx_;
-    int i;
+    size_t i;
 
     PyObject *arglist;  // Will hold a tuple of strings.
     PyObject *result;  // Will hold a string.
@@ -158,23 +322,26 @@ static struct JsonnetJsonValue *cpython_native_callback(
             pyobj = PyString_FromString(param_str);
 #endif
         } else if (param_null) {
+            Py_INCREF(Py_None);
             pyobj = Py_None;
         } else if (param_bool != 2) {
             pyobj = PyBool_FromLong(param_bool);
         } else if (param_num) {
             pyobj = PyFloat_FromDouble(d);
         } else {
-            // TODO(dcunnin): Support arrays (to tuples).
-            // TODO(dcunnin): Support objects (to dicts).
-            Py_DECREF(arglist);
-            *succ = 0;
-            return jsonnet_json_make_string(ctx->vm, "Non-primitive param.");
+            // Arrays and objects, as lists and dicts.
+            pyobj = jsonnet_json_extract_value(ctx->vm, argv[i], &python_builder, NULL);
+            if (pyobj == NULL) {
+                Py_DECREF(arglist);
+                *succ = 0;
+                return jsonnet_json_make_string(ctx->vm, exc_to_str());
+            }
         }
         PyTuple_SetItem(arglist, i, pyobj);
     }
 
     // Call python function.
-    result = PyEval_CallObject(ctx->callback, arglist);
+    result = PyObject_Call(ctx->callback, arglist, NULL);
     Py_DECREF(arglist);
 
     if (result == NULL) {
@@ -190,28 +357,99 @@ static struct JsonnetJsonValue *cpython_native_callback(
     if (r != NULL) {
         *succ = 1;
     } else {
+        char msg[128];
+        snprintf(msg, sizeof msg, "%s returned from Python Jsonnet native extension.", err_msg);
         *succ = 0;
-        r = jsonnet_json_make_string(ctx->vm, err_msg);
+        r = jsonnet_json_make_string(ctx->vm, msg);
     }
     return r;
 }
 
+/* This function is bound for every native callback, but with a different
+ * context.  Evaluation runs without the GIL, so take it back for the call.
+ */
+static struct JsonnetJsonValue *cpython_native_callback(
+    void *ctx_, const struct JsonnetJsonValue * const *argv, int *succ)
+{
+    PyGILState_STATE gil = PyGILState_Ensure();
+    struct JsonnetJsonValue *r = cpython_native_callback_locked(ctx_, argv, succ);
+    PyGILState_Release(gil);
+    return r;
+}
+
 
 struct ImportCtx {
     struct JsonnetVm *vm;
     PyObject *callback;
+    /* The asyncio event loop on which awaitables returned by the callback run, or NULL. */
+    PyObject *loop;
 };
 
-static char *cpython_import_callback(void *ctx_, const char *base, const char *rel,
-                                     char **found_here, int *success)
+/** If v is awaitable, await it on the given event loop, and wait for its result.
+ *
+ * This is called from the thread evaluating, never from the loop's own thread.  The wait releases
+ * the GIL, so the loop carries on meanwhile.
+ *
+ * \param v Stolen reference.
+ * \returns A new reference, or NULL with exception set upon failure.
+ */
+static PyObject *await_on_loop(PyObject *loop, PyObject *v)
+{
+    PyObject *asyncio = NULL, *inspect, *test, *coroutine, *future, *r = NULL;
+
+    inspect = PyImport_ImportModule("inspect");
+    if (inspect == NULL)
+        goto out;
+    test = PyObject_CallMethod(inspect, "isawaitable", "O", v);
+    Py_DECREF(inspect);
+    if (test == NULL)
+        goto out;
+    if (!PyObject_IsTrue(test)) {
+        Py_DECREF(test);
+        return v;
+    }
+    Py_DECREF(test);
+    asyncio = PyImport_ImportModule("asyncio");
+    if (asyncio == NULL)
+        goto out;
+    test = PyObject_CallMethod(asyncio, "iscoroutine", "O", v);
+    if (test == NULL)
+        goto out;
+    if (PyObject_IsTrue(test)) {
+        Py_INCREF(v);
+        coroutine = v;
+    } else {
+        /* Futures, tasks and other awaitables have to be awaited by a coroutine. */
+        coroutine = PyObject_CallMethod(asyncio, "wait_for", "OO", v, Py_None);
+    }
+    Py_DECREF(test);
+    if (coroutine == NULL)
+        goto out;
+    future = PyObject_CallMethod(asyncio, "run_coroutine_threadsafe", "OO", coroutine, loop);
+    Py_DECREF(coroutine);
+    if (future == NULL)
+        goto out;
+    r = PyObject_CallMethod(future, "result", NULL);
+    Py_DECREF(future);
+
+    out:
+    Py_XDECREF(asyncio);
+    Py_DECREF(v);
+    return r;
+}
+
+static char *cpython_import_callback_locked(void *ctx_, const char *base, const char *rel,
+                                            char **found_here, int *success)
 {
     const struct ImportCtx *ctx = ctx_;
     PyObject *arglist, *result;
     char *out;
 
     arglist = Py_BuildValue("(s, s)", base, rel);
-    result = PyEval_CallObject(ctx->callback, arglist);
+    result = PyObject_Call(ctx->callback, arglist, NULL);
     Py_DECREF(arglist);
+    if (result != NULL && ctx->loop != NULL)
+        result = await_on_loop(ctx->loop, result);
 
     if (result == NULL) {
         // Get string from exception
@@ -256,12 +494,21 @@ static char *cpython_import_callback(void *ctx_, const char *base, const char *r
     return out;
 }
 
+/* Evaluation runs without the GIL, so take it back for the call. */
+static char *cpython_import_callback(void *ctx_, const char *base, const char *rel,
+                                     char **found_here, int *success)
+{
+    PyGILState_STATE gil = PyGILState_Ensure();
+    char *out = cpython_import_callback_locked(ctx_, base, rel, found_here, success);
+    PyGILState_Release(gil);
+    return out;
+}
+
 static PyObject *handle_result(struct JsonnetVm *vm, char *out, int error)
 {
     if (error) {
         PyErr_SetString(PyExc_RuntimeError, out);
         jsonnet_realloc(vm, out, 0);
-        jsonnet_destroy(vm);
         return NULL;
     } else {
 #if PY_MAJOR_VERSION >= 3
@@ -270,7 +517,6 @@ static PyObject *handle_result(struct JsonnetVm *vm, char *out, int error)
         PyObject *ret = PyString_FromString(out);
 #endif
         jsonnet_realloc(vm, out, 0);
-        jsonnet_destroy(vm);
         return ret;
     }
 }
@@ -289,7 +535,6 @@ int handle_vars(struct JsonnetVm *vm, PyObject *map, int code, int tla)
         const char *key_ = PyString_AsString(key);
 #endif
         if (key_ == NULL) {
-            jsonnet_destroy(vm);
             return 0;
         }
 #if PY_MAJOR_VERSION >= 3
@@ -298,7 +543,6 @@ int handle_vars(struct JsonnetVm *vm, PyObject *map, int code, int tla)
         const char *val_ = PyString_AsString(val);
 #endif
         if (val_ == NULL) {
-            jsonnet_destroy(vm);
             return 0;
         }
         if (!tla && !code) {
@@ -314,13 +558,49 @@ int handle_vars(struct JsonnetVm *vm, PyObject *map, int code, int tla)
     return 1;
 }
 
+/** Bind ext / tla vars to Python values, which are converted without going through JSON text.
+ *
+ * \returns 1 on success, 0 with exception set upon failure.
+ */
+static int handle_values(struct JsonnetVm *vm, PyObject *map, int tla)
+{
+    if (map == NULL) return 1;
+
+    PyObject *key, *val;
+    Py_ssize_t pos = 0;
+
+    while (PyDict_Next(map, &pos, &key, &val)) {
+        struct JsonnetJsonValue *json_val;
+        const char *err_msg;
+#if PY_MAJOR_VERSION >= 3
+        const char *key_ = PyUnicode_AsUTF8(key);
+#else
+        const char *key_ = PyString_AsString(key);
+#endif
+        if (key_ == NULL) {
+            return 0;
+        }
+        json_val = python_to_jsonnet_json(vm, val, &err_msg);
+        if (json_val == NULL) {
+            PyErr_Format(PyExc_TypeError, "%s in %s[\"%s\"]", err_msg,
+                         tla ? "tla_values" : "ext_values", key_);
+            return 0;
+        }
+        if (tla) {
+            jsonnet_tla_value(vm, key_, json_val);
+        } else {
+            jsonnet_ext_value(vm, key_, json_val);
+        }
+    }
+    return 1;
+}
+
 
 int handle_import_callback(struct ImportCtx *ctx, PyObject *import_callback)
 {
     if (import_callback == NULL) return 1;
 
     if (!PyCallable_Check(import_callback)) {
-        jsonnet_destroy(ctx->vm);
         PyErr_SetString(PyExc_TypeError, "import_callback must be callable");
         return 0;
     }
@@ -398,7 +678,6 @@ static int handle_native_callbacks(struct JsonnetVm *vm, PyObject *native_callba
         continue;
 
         bad:
-        jsonnet_destroy(vm);
         return 0;
     }
 
@@ -444,37 +723,197 @@ static int handle_native_callbacks(struct JsonnetVm *vm, PyObject *native_callba
     return 1;
 }
 
+/** Convert the statistics of the vm's latest evaluation to a dict. */
+static PyObject *stats_to_python(struct JsonnetVm *vm)
+{
+    const struct JsonnetStats *stats = jsonnet_stats(vm);
+    return Py_BuildValue(
+        "{s:d,s:d,s:d,s:d,s:d,s:d,s:{s:k,s:k,s:k,s:k,s:k,s:k,s:k},s:k,s:k,s:k,s:d,s:d,s:I,s:k,s:k}",
+        "lex_seconds", stats->lex_seconds,
+        "parse_seconds", stats->parse_seconds,
+        "desugar_seconds", stats->desugar_seconds,
+        "static_analysis_seconds", stats->static_analysis_seconds,
+        "execute_seconds", stats->execute_seconds,
+        "manifest_seconds", stats->manifest_seconds,
+        "heap_allocations",
+            "thunks", stats->heap_thunks,
+            "arrays", stats->heap_arrays,
+            "closures", stats->heap_closures,
+            "strings", stats->heap_strings,
+            "simple_objects", stats->heap_simple_objects,
+            "comprehension_objects", stats->heap_comprehension_objects,
+            "extended_objects", stats->heap_extended_objects,
+        "max_heap_entities", stats->max_heap_entities,
+        "gc_cycles", stats->gc_cycles,
+        "gc_minor_cycles", stats->gc_minor_cycles,
+        "gc_mark_seconds", stats->gc_mark_seconds,
+        "gc_sweep_seconds", stats->gc_sweep_seconds,
+        "max_stack_depth", stats->max_stack_depth,
+        "import_cache_hits", stats->import_cache_hits,
+        "import_cache_misses", stats->import_cache_misses);
+}
 
-static PyObject* evaluate_file(PyObject* self, PyObject* args, PyObject *keywds)
+/** The JSON output of an evaluation, collected by append_output. */
+struct OutputBuffer {
+    char *buf;
+    size_t len;
+    size_t cap;
+    /** Whether growing buf failed. */
+    int failed;
+};
+
+/** A JsonnetOutputCallback appending to an OutputBuffer, called with the GIL released. */
+static int append_output(void *ctx, const char *buf, size_t len)
+{
+    struct OutputBuffer *out = ctx;
+    if (out->len + len > out->cap) {
+        size_t cap = out->cap * 2 > out->len + len ? out->cap * 2 : out->len + len;
+        char *grown = realloc(out->buf, cap);
+        if (grown == NULL) {
+            out->failed = 1;
+            return 0;
+        }
+        out->buf = grown;
+        out->cap = cap;
+    }
+    memcpy(out->buf + out->len, buf, len);
+    out->len += len;
+    return 1;
+}
+
+/** Evaluate with the GIL released.
+ *
+ * With to_python, the GIL is only taken back to build the Python objects, once the value has been
+ * evaluated all the way down.
+ *
+ * \param program A compiled program to evaluate, or NULL to use filename and src.
+ * \param src The code to evaluate, or NULL to evaluate the file filename.
+ * \param to_python Return Python objects rather than a JSON string.
+ * \param stats Return a (result, stats) tuple, see stats_to_python.
+ * \returns The result, or NULL with exception set upon failure.
+ */
+static PyObject *evaluate_vm(struct JsonnetVm *vm, struct JsonnetProgram *program,
+                             const char *filename, const char *src, int to_python, int stats)
+{
+    PyObject *ret;
+    if (to_python) {
+        void *r;
+        char *error;
+        struct PythonBuilder b;
+        b.keys = PyDict_New();
+        if (b.keys == NULL)
+            return NULL;
+        /* The builder takes the GIL back when it starts, see python_builder_lock. */
+        b.save = PyEval_SaveThread();
+        if (program != NULL) {
+            r = jsonnet_program_evaluate_value(vm, program, &python_builder, &b, &error);
+        } else if (src == NULL) {
+            r = jsonnet_evaluate_file_value(vm, filename, &python_builder, &b, &error);
+        } else {
+            r = jsonnet_evaluate_snippet_value(vm, filename, src, &python_builder, &b, &error);
+        }
+        if (b.save != NULL)
+            PyEval_RestoreThread(b.save);
+        Py_DECREF(b.keys);
+        if (r == NULL) {
+            /* Keep the exception of a failed builder callback, e.g. MemoryError. */
+            if (!PyErr_Occurred())
+                PyErr_SetString(PyExc_RuntimeError, error);
+            jsonnet_realloc(vm, error, 0);
+        }
+        ret = r;
+    } else {
+        /* The JSON is written straight into out as it is manifested. */
+        struct OutputBuffer out = {NULL, 0, 0, 0};
+        char *error;
+        Py_BEGIN_ALLOW_THREADS
+        if (program != NULL) {
+            jsonnet_program_evaluate_to(vm, program, append_output, &out, &error);
+        } else if (src == NULL) {
+            jsonnet_evaluate_file_to(vm, filename, append_output, &out, &error);
+        } else {
+            jsonnet_evaluate_snippet_to(vm, filename, src, append_output, &out, &error);
+        }
+        Py_END_ALLOW_THREADS
+        if (error != NULL) {
+            if (out.failed)
+                PyErr_NoMemory();
+            else
+                PyErr_SetString(PyExc_RuntimeError, error);
+            jsonnet_realloc(vm, error, 0);
+            ret = NULL;
+        } else {
+#if PY_MAJOR_VERSION >= 3
+            ret = PyUnicode_FromStringAndSize(out.buf, out.len);
+#else
+            ret = PyString_FromStringAndSize(out.buf, out.len);
+#endif
+        }
+        free(out.buf);
+    }
+    if (ret == NULL || !stats)
+        return ret;
+    PyObject *dict = stats_to_python(vm);
+    if (dict == NULL) {
+        Py_DECREF(ret);
+        return NULL;
+    }
+    return Py_BuildValue("(NN)", ret, dict);
+}
+
+/** Implements the module's evaluate functions, with a new vm for each call.
+ *
+ * \param snippet Whether the arguments include the code to evaluate, or name a file.
+ * \param loop The event loop to await awaitables returned by the import callback on, or NULL.
+ */
+static PyObject* evaluate_aux(PyObject* args, PyObject *keywds, int snippet, int to_python,
+                              PyObject *loop)
 {
-    const char *filename;
+    const char *filename, *src = NULL;
     const char *jpathdir = NULL;
-    char *out;
     unsigned max_stack = 500, gc_min_objects = 1000, max_trace = 20;
+    unsigned gc_nursery_objects = 2000;
     double gc_growth_trigger = 2;
-    int error;
     PyObject *ext_vars = NULL, *ext_codes = NULL;
     PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *ext_values = NULL, *tla_values = NULL;
     PyObject *import_callback = NULL;
     PyObject *native_callbacks = NULL;
+    int stats = 0;
     struct JsonnetVm *vm;
-    static char *kwlist[] = {
+    static char *file_kwlist[] = {
         "filename", "jpathdir",
         "max_stack", "gc_min_objects", "gc_growth_trigger", "ext_vars",
         "ext_codes", "tla_vars", "tla_codes", "max_trace", "import_callback",
-        "native_callbacks",
+        "native_callbacks", "ext_values", "tla_values", "stats", "gc_nursery_objects",
+        NULL
+    };
+    static char *snippet_kwlist[] = {
+        "filename", "src", "jpathdir",
+        "max_stack", "gc_min_objects", "gc_growth_trigger", "ext_vars",
+        "ext_codes", "tla_vars", "tla_codes", "max_trace", "import_callback",
+        "native_callbacks", "ext_values", "tla_values", "stats", "gc_nursery_objects",
         NULL
     };
 
-    (void) self;
-
-    if (!PyArg_ParseTupleAndKeywords(
-        args, keywds, "s|sIIdOOOOIOO", kwlist,
-        &filename, &jpathdir,
-        &max_stack, &gc_min_objects, &gc_growth_trigger, &ext_vars,
-        &ext_codes, &tla_vars, &tla_codes, &max_trace, &import_callback,
-        &native_callbacks)) {
-        return NULL;
+    if (snippet) {
+        if (!PyArg_ParseTupleAndKeywords(
+            args, keywds, "ss|sIIdOOOOIOOOOiI", snippet_kwlist,
+            &filename, &src, &jpathdir,
+            &max_stack, &gc_min_objects, &gc_growth_trigger, &ext_vars,
+            &ext_codes, &tla_vars, &tla_codes, &max_trace, &import_callback,
+            &native_callbacks, &ext_values, &tla_values, &stats, &gc_nursery_objects)) {
+            return NULL;
+        }
+    } else {
+        if (!PyArg_ParseTupleAndKeywords(
+            args, keywds, "s|sIIdOOOOIOOOOiI", file_kwlist,
+            &filename, &jpathdir,
+            &max_stack, &gc_min_objects, &gc_growth_trigger, &ext_vars,
+            &ext_codes, &tla_vars, &tla_codes, &max_trace, &import_callback,
+            &native_callbacks, &ext_values, &tla_values, &stats, &gc_nursery_objects)) {
+            return NULL;
+        }
     }
 
     vm = jsonnet_make();
@@ -482,81 +921,930 @@ static PyObject* evaluate_file(PyObject* self, PyObject* args, PyObject *keywds)
     jsonnet_gc_min_objects(vm, gc_min_objects);
     jsonnet_max_trace(vm, max_trace);
     jsonnet_gc_growth_trigger(vm, gc_growth_trigger);
+    jsonnet_gc_nursery_objects(vm, gc_nursery_objects);
     if (jpathdir != NULL)
       jsonnet_jpath_add(vm, jpathdir);
-    if (!handle_vars(vm, ext_vars, 0, 0)) return NULL;
-    if (!handle_vars(vm, ext_codes, 1, 0)) return NULL;
-    if (!handle_vars(vm, tla_vars, 0, 1)) return NULL;
-    if (!handle_vars(vm, tla_codes, 1, 1)) return NULL;
-    struct ImportCtx ctx = { vm, import_callback };
-    if (!handle_import_callback(&ctx, import_callback)) {
-        return NULL;
-    }
+    struct ImportCtx ctx = { vm, import_callback, loop };
     struct NativeCtx *ctxs = NULL;
-    if (!handle_native_callbacks(vm, native_callbacks, &ctxs)) {
+    if (!handle_vars(vm, ext_vars, 0, 0) || !handle_vars(vm, ext_codes, 1, 0) ||
+        !handle_vars(vm, tla_vars, 0, 1) || !handle_vars(vm, tla_codes, 1, 1) ||
+        !handle_values(vm, ext_values, 0) || !handle_values(vm, tla_values, 1) ||
+        !handle_import_callback(&ctx, import_callback) ||
+        !handle_native_callbacks(vm, native_callbacks, &ctxs)) {
         free(ctxs);
+        jsonnet_destroy(vm);
         return NULL;
     }
-    out = jsonnet_evaluate_file(vm, filename, &error);
+    PyObject *ret = evaluate_vm(vm, NULL, filename, src, to_python, stats);
     free(ctxs);
-    return handle_result(vm, out, error);
+    jsonnet_destroy(vm);
+    return ret;
+}
+
+static PyObject* evaluate_file(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_aux(args, keywds, 0, 0, NULL);
 }
 
 static PyObject* evaluate_snippet(PyObject* self, PyObject* args, PyObject *keywds)
 {
-    const char *filename, *src;
+    (void) self;
+    return evaluate_aux(args, keywds, 1, 0, NULL);
+}
+
+static PyObject* evaluate_file_to_python(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_aux(args, keywds, 0, 1, NULL);
+}
+
+static PyObject* evaluate_snippet_to_python(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_aux(args, keywds, 1, 1, NULL);
+}
+
+/* Runs in the executor: (loop, snippet, args, keywds) -> the result of evaluate_aux. */
+static PyObject* evaluate_async_job(PyObject* self, PyObject* job)
+{
+    PyObject *loop, *args, *keywds;
+    int snippet;
+
+    (void) self;
+    if (!PyArg_ParseTuple(job, "OiOO", &loop, &snippet, &args, &keywds))
+        return NULL;
+    return evaluate_aux(args, keywds == Py_None ? NULL : keywds, snippet, 0, loop);
+}
+
+static PyMethodDef evaluate_async_job_def = {
+    "evaluate_async_job", evaluate_async_job, METH_VARARGS, NULL
+};
+
+/** Implements the module's async evaluate functions.
+ *
+ * The evaluation runs in the loop's default executor, so that it does not block the loop.
+ *
+ * \returns An awaitable for the JSON string.
+ */
+static PyObject* evaluate_async_aux(PyObject* args, PyObject *keywds, int snippet)
+{
+    PyObject *asyncio, *loop = NULL, *job = NULL, *r = NULL;
+
+    asyncio = PyImport_ImportModule("asyncio");
+    if (asyncio == NULL)
+        return NULL;
+    /* Raises unless called from a coroutine, or a callback, running on the loop. */
+    loop = PyObject_CallMethod(asyncio, "get_running_loop", NULL);
+    if (loop == NULL)
+        goto out;
+    job = PyCFunction_New(&evaluate_async_job_def, NULL);
+    if (job == NULL)
+        goto out;
+    r = PyObject_CallMethod(loop, "run_in_executor", "OOOiOO", Py_None, job, loop, snippet, args,
+                            keywds == NULL ? Py_None : keywds);
+
+    out:
+    Py_XDECREF(job);
+    Py_XDECREF(loop);
+    Py_DECREF(asyncio);
+    return r;
+}
+
+static PyObject* evaluate_file_async(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_async_aux(args, keywds, 0);
+}
+
+static PyObject* evaluate_snippet_async(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_async_aux(args, keywds, 1);
+}
+
+
+/** A Jsonnet VM that outlives a single evaluation.
+ *
+ * The underlying JsonnetVm keeps every imported file between calls, and the stdlib is shared by
+ * every vm in the process, so repeated evaluations only pay for the code that is new.  The
+ * configuration and callbacks are fixed at construction; ext / tla vars are given per call.  A Vm
+ * may only run one evaluation at a time; threads that evaluate concurrently should each have their
+ * own.
+ */
+typedef struct {
+    PyObject_HEAD
+    struct JsonnetVm *vm;
+    /* Owned references, kept alive for as long as the vm may call them. */
+    PyObject *import_callback;
+    PyObject *native_callbacks;
+    struct ImportCtx import_ctx;
+    struct NativeCtx *native_ctxs;
+    /* Set while an evaluation is running.  The GIL is released during evaluation, so this
+     * rejects both re-entrant calls from callbacks and calls from other threads.
+     */
+    int busy;
+    /* Set while a Documents iterator over this vm is unfinished.  Its execution is still alive
+     * and shares the vm's cache, so no other evaluation may start until it is exhausted or
+     * deleted.
+     */
+    int iterating;
+} VmObject;
+
+static int Vm_init(VmObject *self, PyObject *args, PyObject *keywds)
+{
     const char *jpathdir = NULL;
-    char *out;
     unsigned max_stack = 500, gc_min_objects = 1000, max_trace = 20;
+    unsigned gc_nursery_objects = 2000;
     double gc_growth_trigger = 2;
-    int error;
-    PyObject *ext_vars = NULL, *ext_codes = NULL;
-    PyObject *tla_vars = NULL, *tla_codes = NULL;
     PyObject *import_callback = NULL;
     PyObject *native_callbacks = NULL;
-    struct JsonnetVm *vm;
     static char *kwlist[] = {
-        "filename", "src", "jpathdir",
-        "max_stack", "gc_min_objects", "gc_growth_trigger", "ext_vars",
-        "ext_codes", "tla_vars", "tla_codes", "max_trace", "import_callback",
-        "native_callbacks",
+        "jpathdir", "max_stack", "gc_min_objects", "gc_growth_trigger", "max_trace",
+        "import_callback", "native_callbacks", "gc_nursery_objects",
         NULL
     };
 
-    (void) self;
+    if (!PyArg_ParseTupleAndKeywords(
+        args, keywds, "|sIIdIOOI", kwlist,
+        &jpathdir, &max_stack, &gc_min_objects, &gc_growth_trigger, &max_trace,
+        &import_callback, &native_callbacks, &gc_nursery_objects)) {
+        return -1;
+    }
+    if (self->vm != NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Vm is already initialized");
+        return -1;
+    }
+    if (native_callbacks != NULL && !PyDict_Check(native_callbacks)) {
+        PyErr_SetString(PyExc_TypeError, "native_callbacks must be a dict");
+        return -1;
+    }
+
+    self->vm = jsonnet_make();
+    jsonnet_max_stack(self->vm, max_stack);
+    jsonnet_gc_min_objects(self->vm, gc_min_objects);
+    jsonnet_max_trace(self->vm, max_trace);
+    jsonnet_gc_growth_trigger(self->vm, gc_growth_trigger);
+    jsonnet_gc_nursery_objects(self->vm, gc_nursery_objects);
+    if (jpathdir != NULL)
+      jsonnet_jpath_add(self->vm, jpathdir);
+
+    self->import_ctx.vm = self->vm;
+    self->import_ctx.callback = import_callback;
+    self->import_ctx.loop = NULL;
+    if (!handle_import_callback(&self->import_ctx, import_callback))
+        return -1;
+    Py_XINCREF(import_callback);
+    self->import_callback = import_callback;
+
+    if (native_callbacks != NULL) {
+        /* Take a copy so later changes to the caller's dict cannot free the callbacks. */
+        self->native_callbacks = PyDict_Copy(native_callbacks);
+        if (self->native_callbacks == NULL)
+            return -1;
+        if (!handle_native_callbacks(self->vm, self->native_callbacks, &self->native_ctxs))
+            return -1;
+    }
+    return 0;
+}
+
+static void Vm_dealloc(VmObject *self)
+{
+    if (self->vm != NULL)
+        jsonnet_destroy(self->vm);
+    free(self->native_ctxs);
+    Py_XDECREF(self->import_callback);
+    Py_XDECREF(self->native_callbacks);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/** Bind the per-call ext / tla vars, replacing those of the previous call.
+ *
+ * \returns 1 on success, 0 with exception set upon failure.
+ */
+static int Vm_begin(VmObject *self, PyObject *ext_vars, PyObject *ext_codes,
+                    PyObject *tla_vars, PyObject *tla_codes,
+                    PyObject *ext_values, PyObject *tla_values)
+{
+    if (self->vm == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Vm is not initialized");
+        return 0;
+    }
+    if (self->busy) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "Vm is already evaluating; use one Vm per thread");
+        return 0;
+    }
+    if (self->iterating) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "Vm has an unfinished Documents iterator; exhaust or delete it first");
+        return 0;
+    }
+    jsonnet_ext_clear(self->vm);
+    jsonnet_tla_clear(self->vm);
+    if (!handle_vars(self->vm, ext_vars, 0, 0) || !handle_vars(self->vm, ext_codes, 1, 0) ||
+        !handle_vars(self->vm, tla_vars, 0, 1) || !handle_vars(self->vm, tla_codes, 1, 1) ||
+        !handle_values(self->vm, ext_values, 0) || !handle_values(self->vm, tla_values, 1))
+        return 0;
+    return 1;
+}
+
+/** Implements the Vm evaluate methods.
+ *
+ * \param snippet Whether the arguments include the code to evaluate, or name a file.
+ */
+static PyObject* Vm_evaluate_aux(VmObject* self, PyObject* args, PyObject *keywds, int snippet,
+                                 int to_python)
+{
+    const char *filename, *src = NULL;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *ext_values = NULL, *tla_values = NULL;
+    int stats = 0;
+    static char *file_kwlist[] = {
+        "filename", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "ext_values", "tla_values",
+        "stats",
+        NULL
+    };
+    static char *snippet_kwlist[] = {
+        "filename", "src", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "ext_values",
+        "tla_values", "stats",
+        NULL
+    };
+
+    if (snippet) {
+        if (!PyArg_ParseTupleAndKeywords(
+            args, keywds, "ss|OOOOOOi", snippet_kwlist,
+            &filename, &src, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &ext_values,
+            &tla_values, &stats)) {
+            return NULL;
+        }
+    } else {
+        if (!PyArg_ParseTupleAndKeywords(
+            args, keywds, "s|OOOOOOi", file_kwlist,
+            &filename, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &ext_values,
+            &tla_values, &stats)) {
+            return NULL;
+        }
+    }
+    if (!Vm_begin(self, ext_vars, ext_codes, tla_vars, tla_codes, ext_values, tla_values))
+        return NULL;
+    self->busy = 1;
+    PyObject *ret = evaluate_vm(self->vm, NULL, filename, src, to_python, stats);
+    self->busy = 0;
+    return ret;
+}
+
+static PyObject* Vm_evaluate_file(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    return Vm_evaluate_aux(self, args, keywds, 0, 0);
+}
+
+static PyObject* Vm_evaluate_snippet(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    return Vm_evaluate_aux(self, args, keywds, 1, 0);
+}
+
+static PyObject* Vm_evaluate_file_to_python(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    return Vm_evaluate_aux(self, args, keywds, 0, 1);
+}
+
+static PyObject* Vm_evaluate_snippet_to_python(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    return Vm_evaluate_aux(self, args, keywds, 1, 1);
+}
+
+/** A program compiled by a Vm, see struct JsonnetProgram. */
+typedef struct {
+    PyObject_HEAD
+    /* Owned reference; the program can only be evaluated by, and must not outlive, this Vm. */
+    VmObject *vm;
+    struct JsonnetProgram *program;
+} ProgramObject;
+
+static PyTypeObject ProgramType;
+
+static PyObject* Vm_compile(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    const char *filename, *src = NULL;
+    struct JsonnetProgram *program;
+    char *error;
+    static char *kwlist[] = {"filename", "src", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "s|s", kwlist, &filename, &src)) {
+        return NULL;
+    }
+    if (!Vm_begin(self, NULL, NULL, NULL, NULL, NULL, NULL))
+        return NULL;
+    self->busy = 1;
+    Py_BEGIN_ALLOW_THREADS
+    if (src == NULL) {
+        program = jsonnet_compile_file(self->vm, filename, &error);
+    } else {
+        program = jsonnet_compile_snippet(self->vm, filename, src, &error);
+    }
+    Py_END_ALLOW_THREADS
+    self->busy = 0;
+    if (program == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, error);
+        jsonnet_realloc(self->vm, error, 0);
+        return NULL;
+    }
+
+    ProgramObject *r = PyObject_New(ProgramObject, &ProgramType);
+    if (r == NULL) {
+        jsonnet_program_destroy(self->vm, program);
+        return NULL;
+    }
+    Py_INCREF(self);
+    r->vm = self;
+    r->program = program;
+    return (PyObject *)r;
+}
+
+/** The documents of a multi or stream mode evaluation, see struct JsonnetIterator. */
+typedef struct {
+    PyObject_HEAD
+    /* Owned reference; the iterator must not outlive this Vm. */
+    VmObject *vm;
+    /* NULL once all the documents have been returned. */
+    struct JsonnetIterator *it;
+} DocumentsObject;
+
+static PyTypeObject DocumentsType;
+
+static PyObject* Vm_evaluate_iter_aux(VmObject* self, PyObject* args, PyObject *keywds,
+                                      int snippet, int multi)
+{
+    const char *filename, *src = NULL;
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *ext_values = NULL, *tla_values = NULL;
+    struct JsonnetIterator *it;
+    char *error;
+    static char *file_kwlist[] = {
+        "filename", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "ext_values", "tla_values",
+        NULL
+    };
+    static char *snippet_kwlist[] = {
+        "filename", "src", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "ext_values",
+        "tla_values",
+        NULL
+    };
+
+    if (snippet) {
+        if (!PyArg_ParseTupleAndKeywords(
+            args, keywds, "ss|OOOOOO", snippet_kwlist,
+            &filename, &src, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &ext_values,
+            &tla_values)) {
+            return NULL;
+        }
+    } else {
+        if (!PyArg_ParseTupleAndKeywords(
+            args, keywds, "s|OOOOOO", file_kwlist,
+            &filename, &ext_vars, &ext_codes, &tla_vars, &tla_codes, &ext_values,
+            &tla_values)) {
+            return NULL;
+        }
+    }
+    if (!Vm_begin(self, ext_vars, ext_codes, tla_vars, tla_codes, ext_values, tla_values))
+        return NULL;
+    self->busy = 1;
+    Py_BEGIN_ALLOW_THREADS
+    if (multi) {
+        it = snippet ? jsonnet_evaluate_snippet_multi_iter(self->vm, filename, src, &error)
+                     : jsonnet_evaluate_file_multi_iter(self->vm, filename, &error);
+    } else {
+        it = snippet ? jsonnet_evaluate_snippet_stream_iter(self->vm, filename, src, &error)
+                     : jsonnet_evaluate_file_stream_iter(self->vm, filename, &error);
+    }
+    Py_END_ALLOW_THREADS
+    self->busy = 0;
+    if (it == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, error);
+        jsonnet_realloc(self->vm, error, 0);
+        return NULL;
+    }
+
+    DocumentsObject *r = PyObject_New(DocumentsObject, &DocumentsType);
+    if (r == NULL) {
+        jsonnet_iterator_destroy(self->vm, it);
+        return NULL;
+    }
+    Py_INCREF(self);
+    r->vm = self;
+    r->it = it;
+    self->iterating = 1;
+    return (PyObject *)r;
+}
+
+static PyObject* Vm_evaluate_file_multi(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    return Vm_evaluate_iter_aux(self, args, keywds, 0, 1);
+}
+
+static PyObject* Vm_evaluate_snippet_multi(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    return Vm_evaluate_iter_aux(self, args, keywds, 1, 1);
+}
+
+static PyObject* Vm_evaluate_file_stream(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    return Vm_evaluate_iter_aux(self, args, keywds, 0, 0);
+}
+
+static PyObject* Vm_evaluate_snippet_stream(VmObject* self, PyObject* args, PyObject *keywds)
+{
+    return Vm_evaluate_iter_aux(self, args, keywds, 1, 0);
+}
+
+static PyMethodDef Vm_methods[] = {
+    {"evaluate_file", (PyCFunction)Vm_evaluate_file, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file."},
+    {"evaluate_snippet", (PyCFunction)Vm_evaluate_snippet, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code."},
+    {"evaluate_file_to_python", (PyCFunction)Vm_evaluate_file_to_python,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, returning Python objects instead of JSON."},
+    {"evaluate_snippet_to_python", (PyCFunction)Vm_evaluate_snippet_to_python,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, returning Python objects instead of JSON."},
+    {"compile", (PyCFunction)Vm_compile, METH_VARARGS | METH_KEYWORDS,
+     "Compile the given Jsonnet file, or the code src, for repeated evaluation."},
+    {"evaluate_file_multi", (PyCFunction)Vm_evaluate_file_multi, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, yielding (filename, JSON) pairs on demand."},
+    {"evaluate_snippet_multi", (PyCFunction)Vm_evaluate_snippet_multi,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, yielding (filename, JSON) pairs on demand."},
+    {"evaluate_file_stream", (PyCFunction)Vm_evaluate_file_stream,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, yielding JSON documents on demand."},
+    {"evaluate_snippet_stream", (PyCFunction)Vm_evaluate_snippet_stream,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, yielding JSON documents on demand."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject VmType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_jsonnet.Vm",                              /* tp_name */
+    sizeof(VmObject),                           /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor)Vm_dealloc,                     /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare / tp_as_async */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+    "A Jsonnet VM that caches the stdlib and imported files between evaluations.",
+    0,                                          /* tp_traverse */
+    0,                                          /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    0,                                          /* tp_iter */
+    0,                                          /* tp_iternext */
+    Vm_methods,                                 /* tp_methods */
+    0,                                          /* tp_members */
+    0,                                          /* tp_getset */
+    0,                                          /* tp_base */
+    0,                                          /* tp_dict */
+    0,                                          /* tp_descr_get */
+    0,                                          /* tp_descr_set */
+    0,                                          /* tp_dictoffset */
+    (initproc)Vm_init,                          /* tp_init */
+    0,                                          /* tp_alloc */
+    PyType_GenericNew,                          /* tp_new */
+};
+
+static void Program_dealloc(ProgramObject *self)
+{
+    jsonnet_program_destroy(self->vm->vm, self->program);
+    Py_DECREF(self->vm);
+    PyObject_Del(self);
+}
+
+static PyObject* Program_evaluate_aux(ProgramObject* self, PyObject* args, PyObject *keywds,
+                                      int to_python)
+{
+    PyObject *ext_vars = NULL, *ext_codes = NULL;
+    PyObject *tla_vars = NULL, *tla_codes = NULL;
+    PyObject *ext_values = NULL, *tla_values = NULL;
+    int stats = 0;
+    static char *kwlist[] = {
+        "ext_vars", "ext_codes", "tla_vars", "tla_codes", "ext_values", "tla_values", "stats",
+        NULL
+    };
 
     if (!PyArg_ParseTupleAndKeywords(
-        args, keywds, "ss|sIIdOOOOIOO", kwlist,
-        &filename, &src, &jpathdir,
-        &max_stack, &gc_min_objects, &gc_growth_trigger, &ext_vars,
-        &ext_codes, &tla_vars, &tla_codes, &max_trace, &import_callback,
-        &native_callbacks)) {
+        args, keywds, "|OOOOOOi", kwlist, &ext_vars, &ext_codes, &tla_vars, &tla_codes,
+        &ext_values, &tla_values, &stats)) {
+        return NULL;
+    }
+    if (!Vm_begin(self->vm, ext_vars, ext_codes, tla_vars, tla_codes, ext_values, tla_values))
+        return NULL;
+    self->vm->busy = 1;
+    PyObject *ret = evaluate_vm(self->vm->vm, self->program, NULL, NULL, to_python, stats);
+    self->vm->busy = 0;
+    return ret;
+}
+
+static PyObject* Program_evaluate(ProgramObject* self, PyObject* args, PyObject *keywds)
+{
+    return Program_evaluate_aux(self, args, keywds, 0);
+}
+
+static PyObject* Program_evaluate_to_python(ProgramObject* self, PyObject* args,
+                                            PyObject *keywds)
+{
+    return Program_evaluate_aux(self, args, keywds, 1);
+}
+
+static PyMethodDef Program_methods[] = {
+    {"evaluate", (PyCFunction)Program_evaluate, METH_VARARGS | METH_KEYWORDS,
+     "Evaluate the program with the given ext / tla vars."},
+    {"evaluate_to_python", (PyCFunction)Program_evaluate_to_python,
+     METH_VARARGS | METH_KEYWORDS,
+     "Evaluate the program, returning Python objects instead of JSON."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject ProgramType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_jsonnet.Program",                         /* tp_name */
+    sizeof(ProgramObject),                      /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor)Program_dealloc,                /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare / tp_as_async */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+    "A parsed and analysed Jsonnet program, made by Vm.compile or compile.",
+    0,                                          /* tp_traverse */
+    0,                                          /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    0,                                          /* tp_iter */
+    0,                                          /* tp_iternext */
+    Program_methods,                            /* tp_methods */
+};
+
+/** End the execution of the iterator, allowing other evaluations on its Vm again. */
+static void Documents_finish(DocumentsObject *self)
+{
+    if (self->it == NULL)
+        return;
+    jsonnet_iterator_destroy(self->vm->vm, self->it);
+    self->it = NULL;
+    self->vm->iterating = 0;
+}
+
+static void Documents_dealloc(DocumentsObject *self)
+{
+    Documents_finish(self);
+    Py_DECREF(self->vm);
+    PyObject_Del(self);
+}
+
+static PyObject* Documents_next(DocumentsObject *self)
+{
+    char *out, *name;
+    int error;
+    PyObject *ret;
+
+    if (self->it == NULL)
+        return NULL;
+    if (self->vm->busy) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "Vm is already evaluating; use one Vm per thread");
+        return NULL;
+    }
+    self->vm->busy = 1;
+    Py_BEGIN_ALLOW_THREADS
+    out = jsonnet_iterator_next(self->vm->vm, self->it, &name, &error);
+    Py_END_ALLOW_THREADS
+    self->vm->busy = 0;
+    if (out == NULL) {
+        /* No more documents, raises StopIteration. */
+        Documents_finish(self);
         return NULL;
     }
+    ret = handle_result(self->vm->vm, out, error);
+    if (name != NULL) {
+        if (ret != NULL)
+            ret = Py_BuildValue("(sN)", name, ret);
+        jsonnet_realloc(self->vm->vm, name, 0);
+    }
+    return ret;
+}
 
-    vm = jsonnet_make();
-    jsonnet_max_stack(vm, max_stack);
-    jsonnet_gc_min_objects(vm, gc_min_objects);
-    jsonnet_max_trace(vm, max_trace);
-    jsonnet_gc_growth_trigger(vm, gc_growth_trigger);
-    if (jpathdir != NULL)
-      jsonnet_jpath_add(vm, jpathdir);
-    if (!handle_vars(vm, ext_vars, 0, 0)) return NULL;
-    if (!handle_vars(vm, ext_codes, 1, 0)) return NULL;
-    if (!handle_vars(vm, tla_vars, 0, 1)) return NULL;
-    if (!handle_vars(vm, tla_codes, 1, 1)) return NULL;
-    struct ImportCtx ctx = { vm, import_callback };
-    if (!handle_import_callback(&ctx, import_callback)) {
+static PyTypeObject DocumentsType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_jsonnet.Documents",                       /* tp_name */
+    sizeof(DocumentsObject),                    /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor)Documents_dealloc,              /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare / tp_as_async */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+    "Iterator over the documents of a multi or stream evaluation, manifested on demand.",
+    0,                                          /* tp_traverse */
+    0,                                          /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    PyObject_SelfIter,                          /* tp_iter */
+    (iternextfunc)Documents_next,               /* tp_iternext */
+};
+
+/** Make a Vm for a module function whose result needs it after the call returns.
+ *
+ * \param call_keys The keyword arguments that are for the call rather than the Vm.
+ * \param call_kwargs Set to a new dict holding those arguments.
+ * \returns A new reference, or NULL with exception set upon failure.
+ */
+static PyObject *make_vm(PyObject *keywds, const char **call_keys, PyObject **call_kwargs)
+{
+    PyObject *vm_kwargs, *empty, *vm = NULL;
+    const char **key;
+
+    *call_kwargs = PyDict_New();
+    vm_kwargs = keywds == NULL ? PyDict_New() : PyDict_Copy(keywds);
+    empty = PyTuple_New(0);
+    if (*call_kwargs == NULL || vm_kwargs == NULL || empty == NULL)
+        goto out;
+    for (key = call_keys; *key != NULL; ++key) {
+        PyObject *v = PyDict_GetItemString(vm_kwargs, *key);
+        if (v == NULL)
+            continue;
+        if (PyDict_SetItemString(*call_kwargs, *key, v) < 0 ||
+            PyDict_DelItemString(vm_kwargs, *key) < 0)
+            goto out;
+    }
+    vm = PyObject_Call((PyObject *)&VmType, empty, vm_kwargs);
+
+    out:
+    if (vm == NULL) {
+        Py_CLEAR(*call_kwargs);
+    }
+    Py_XDECREF(vm_kwargs);
+    Py_XDECREF(empty);
+    return vm;
+}
+
+static PyObject* compile(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    static const char *call_keys[] = {"filename", "src", NULL};
+    PyObject *call_kwargs, *vm, *r;
+
+    (void) self;
+
+    vm = make_vm(keywds, call_keys, &call_kwargs);
+    if (vm == NULL)
         return NULL;
+    r = Vm_compile((VmObject *)vm, args, call_kwargs);
+    Py_DECREF(vm);
+    Py_DECREF(call_kwargs);
+    return r;
+}
+
+/** Implements the module's multi and stream functions, with a new Vm for each call. */
+static PyObject* evaluate_iter_aux(PyObject* args, PyObject *keywds, int snippet, int multi)
+{
+    static const char *call_keys[] = {
+        "filename", "src", "ext_vars", "ext_codes", "tla_vars", "tla_codes", "ext_values",
+        "tla_values", NULL
+    };
+    PyObject *call_kwargs, *vm, *r;
+
+    vm = make_vm(keywds, call_keys, &call_kwargs);
+    if (vm == NULL)
+        return NULL;
+    r = Vm_evaluate_iter_aux((VmObject *)vm, args, call_kwargs, snippet, multi);
+    Py_DECREF(vm);
+    Py_DECREF(call_kwargs);
+    return r;
+}
+
+static PyObject* evaluate_file_multi(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_iter_aux(args, keywds, 0, 1);
+}
+
+static PyObject* evaluate_snippet_multi(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_iter_aux(args, keywds, 1, 1);
+}
+
+static PyObject* evaluate_file_stream(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_iter_aux(args, keywds, 0, 0);
+}
+
+static PyObject* evaluate_snippet_stream(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    (void) self;
+    return evaluate_iter_aux(args, keywds, 1, 0);
+}
+
+/* Shared by the threads of evaluate_many, which only touch it with the GIL held. */
+struct ManyState {
+    PyObject *jobs;     /* From PySequence_Fast. */
+    PyObject *results;  /* A list of the same length, filled in as jobs finish. */
+    Py_ssize_t next;    /* The next job to start. */
+    int to_python;
+};
+
+/** Evaluate one job of evaluate_many: a filename, or a dict of arguments for Vm.evaluate_file,
+ * or for Vm.evaluate_snippet if it has "src".
+ */
+static PyObject* evaluate_many_job(VmObject *vm, PyObject *job, int to_python)
+{
+    PyObject *args, *r;
+    int snippet = 0;
+
+    if (PyDict_Check(job)) {
+        args = PyTuple_New(0);
+        snippet = PyDict_GetItemString(job, "src") != NULL;
+    } else {
+        args = PyTuple_Pack(1, job);
+        job = NULL;
     }
-    struct NativeCtx *ctxs = NULL;
-    if (!handle_native_callbacks(vm, native_callbacks, &ctxs)) {
-        free(ctxs);
+    if (args == NULL)
         return NULL;
+    r = Vm_evaluate_aux(vm, args, job, snippet, to_python);
+    Py_DECREF(args);
+    return r;
+}
+
+/* The target of each evaluate_many thread, bound to the ManyState. */
+static PyObject* evaluate_many_worker(PyObject* self, PyObject* vm)
+{
+    struct ManyState *state = PyCapsule_GetPointer(self, NULL);
+    Py_ssize_t num_jobs = PySequence_Fast_GET_SIZE(state->jobs);
+
+    while (state->next < num_jobs) {
+        Py_ssize_t i = state->next++;
+        PyObject *job = PySequence_Fast_GET_ITEM(state->jobs, i);
+        PyObject *r = evaluate_many_job((VmObject *)vm, job, state->to_python);
+        if (r == NULL) {
+            /* The job's result is its exception. */
+            PyObject *type, *value, *traceback;
+            PyErr_Fetch(&type, &value, &traceback);
+            PyErr_NormalizeException(&type, &value, &traceback);
+            Py_XDECREF(type);
+            Py_XDECREF(traceback);
+            r = value;
+        }
+        PyList_SET_ITEM(state->results, i, r);
     }
-    out = jsonnet_evaluate_snippet(vm, filename, src, &error);
-    free(ctxs);
-    return handle_result(vm, out, error);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef evaluate_many_worker_def = {
+    "evaluate_many_worker", evaluate_many_worker, METH_O, NULL
+};
+
+/** Evaluate many jobs on a pool of threads, each with its own Vm.
+ *
+ * Evaluation releases the GIL, so the threads run in parallel.
+ */
+static PyObject* evaluate_many(PyObject* self, PyObject* args, PyObject *keywds)
+{
+    static const char *call_keys[] = {"jobs", "workers", "to_python", NULL};
+    static char *kwlist[] = {"jobs", "workers", "to_python", NULL};
+    PyObject *call_kwargs = NULL, *jobs, *threading = NULL, *state_obj = NULL, *worker = NULL;
+    PyObject *threads = NULL, *r = NULL;
+    struct ManyState state = { NULL, NULL, 0, 0 };
+    PyObject *type, *value, *traceback;
+    int ok = 1;
+    int workers = 0;
+    Py_ssize_t i, num_jobs;
+
+    (void) self;
+
+    /* Splits the Vm's keyword arguments from ours, and checks them before any thread starts. */
+    r = make_vm(keywds, call_keys, &call_kwargs);
+    if (r == NULL)
+        return NULL;
+    Py_CLEAR(r);
+    if (!PyArg_ParseTupleAndKeywords(args, call_kwargs, "O|ii", kwlist,
+                                     &jobs, &workers, &state.to_python))
+        goto out;
+    state.jobs = PySequence_Fast(jobs, "jobs must be a sequence");
+    if (state.jobs == NULL)
+        goto out;
+    num_jobs = PySequence_Fast_GET_SIZE(state.jobs);
+    if (workers <= 0) {
+        PyObject *multiprocessing = PyImport_ImportModule("multiprocessing");
+        PyObject *cpus = multiprocessing == NULL
+            ? NULL : PyObject_CallMethod(multiprocessing, "cpu_count", NULL);
+        Py_XDECREF(multiprocessing);
+        if (cpus == NULL)
+            goto out;
+        workers = (int)PyLong_AsLong(cpus);
+        Py_DECREF(cpus);
+    }
+    if (workers > num_jobs)
+        workers = (int)num_jobs;
+
+    state.results = PyList_New(num_jobs);
+    threading = PyImport_ImportModule("threading");
+    state_obj = PyCapsule_New(&state, NULL, NULL);
+    threads = PyList_New(0);
+    if (state.results == NULL || threading == NULL || state_obj == NULL || threads == NULL)
+        goto out;
+    worker = PyCFunction_New(&evaluate_many_worker_def, state_obj);
+    if (worker == NULL)
+        goto out;
+
+    for (i = 0; i < workers && ok; ++i) {
+        PyObject *ignored, *vm, *thread = NULL;
+        vm = make_vm(keywds, call_keys, &ignored);
+        if (vm != NULL) {
+            Py_DECREF(ignored);
+            /* threading.Thread(None, worker, None, (vm,)) */
+            thread = PyObject_CallMethod(threading, "Thread", "OOO(N)",
+                                         Py_None, worker, Py_None, vm);
+        }
+        ok = thread != NULL && PyList_Append(threads, thread) == 0;
+        if (ok) {
+            PyObject *started = PyObject_CallMethod(thread, "start", NULL);
+            ok = started != NULL;
+            Py_XDECREF(started);
+        }
+        Py_XDECREF(thread);
+    }
+
+    /* The threads use state, so must all finish, even upon error. */
+    PyErr_Fetch(&type, &value, &traceback);
+    if (!ok)
+        state.next = num_jobs;
+    for (i = 0; i < PyList_GET_SIZE(threads); ++i) {
+        PyObject *joined = PyObject_CallMethod(PyList_GET_ITEM(threads, i), "join", NULL);
+        if (joined == NULL) {
+            /* Only likely for KeyboardInterrupt, so stop starting jobs and wait again. */
+            state.next = num_jobs;
+            if (type == NULL) {
+                PyErr_Fetch(&type, &value, &traceback);
+            } else {
+                PyErr_Clear();
+            }
+            --i;
+            continue;
+        }
+        Py_DECREF(joined);
+    }
+    PyErr_Restore(type, value, traceback);
+    if (ok && type == NULL) {
+        r = state.results;
+        state.results = NULL;
+    }
+
+    out:
+    Py_XDECREF(worker);
+    Py_XDECREF(threads);
+    Py_XDECREF(state_obj);
+    Py_XDECREF(threading);
+    Py_XDECREF(state.jobs);
+    Py_XDECREF(state.results);
+    Py_XDECREF(call_kwargs);
+    return r;
 }
 
 static PyMethodDef module_methods[] = {
@@ -564,6 +1852,31 @@ static PyMethodDef module_methods[] = {
      "Interpret the given Jsonnet file."},
     {"evaluate_snippet", (PyCFunction)evaluate_snippet, METH_VARARGS | METH_KEYWORDS,
      "Interpret the given Jsonnet code."},
+    {"evaluate_file_to_python", (PyCFunction)evaluate_file_to_python,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, returning Python objects instead of JSON."},
+    {"evaluate_snippet_to_python", (PyCFunction)evaluate_snippet_to_python,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, returning Python objects instead of JSON."},
+    {"evaluate_file_async", (PyCFunction)evaluate_file_async, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file off the asyncio event loop, returning an awaitable."},
+    {"evaluate_snippet_async", (PyCFunction)evaluate_snippet_async,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code off the asyncio event loop, returning an awaitable."},
+    {"compile", (PyCFunction)compile, METH_VARARGS | METH_KEYWORDS,
+     "Compile the given Jsonnet file, or the code src, for repeated evaluation."},
+    {"evaluate_many", (PyCFunction)evaluate_many, METH_VARARGS | METH_KEYWORDS,
+     "Interpret many Jsonnet files or snippets in parallel, returning their results in order."},
+    {"evaluate_file_multi", (PyCFunction)evaluate_file_multi, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, yielding (filename, JSON) pairs on demand."},
+    {"evaluate_snippet_multi", (PyCFunction)evaluate_snippet_multi,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, yielding (filename, JSON) pairs on demand."},
+    {"evaluate_file_stream", (PyCFunction)evaluate_file_stream, METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet file, yielding JSON documents on demand."},
+    {"evaluate_snippet_stream", (PyCFunction)evaluate_snippet_stream,
+     METH_VARARGS | METH_KEYWORDS,
+     "Interpret the given Jsonnet code, yielding JSON documents on demand."},
     {NULL, NULL, 0, NULL}
 };
 
@@ -579,11 +1892,40 @@ static struct PyModuleDef _jsonnet =
 
 PyMODINIT_FUNC PyInit__jsonnet(void)
 {
-    return PyModule_Create(&_jsonnet);
+    PyObject *module;
+#if PY_VERSION_HEX < 0x03070000
+    PyEval_InitThreads();
+#endif
+    if (PyType_Ready(&VmType) < 0 || PyType_Ready(&ProgramType) < 0 ||
+        PyType_Ready(&DocumentsType) < 0)
+        return NULL;
+    module = PyModule_Create(&_jsonnet);
+    if (module == NULL)
+        return NULL;
+    Py_INCREF(&VmType);
+    PyModule_AddObject(module, "Vm", (PyObject *)&VmType);
+    Py_INCREF(&ProgramType);
+    PyModule_AddObject(module, "Program", (PyObject *)&ProgramType);
+    Py_INCREF(&DocumentsType);
+    PyModule_AddObject(module, "Documents", (PyObject *)&DocumentsType);
+    return module;
 }
 #else
 PyMODINIT_FUNC init_jsonnet(void)
 {
-    Py_InitModule3("_jsonnet", module_methods, "A Python interface to Jsonnet.");
+    PyObject *module;
+    PyEval_InitThreads();
+    if (PyType_Ready(&VmType) < 0 || PyType_Ready(&ProgramType) < 0 ||
+        PyType_Ready(&DocumentsType) < 0)
+        return;
+    module = Py_InitModule3("_jsonnet", module_methods, "A Python interface to Jsonnet.");
+    if (module == NULL)
+        return;
+    Py_INCREF(&VmType);
+    PyModule_AddObject(module, "Vm", (PyObject *)&VmType);
+    Py_INCREF(&ProgramType);
+    PyModule_AddObject(module, "Program", (PyObject *)&ProgramType);
+    Py_INCREF(&DocumentsType);
+    PyModule_AddObject(module, "Documents", (PyObject *)&DocumentsType);
 }
 #endif
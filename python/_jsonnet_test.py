@@ -12,7 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import _jsonnet
@@ -93,5 +99,474 @@ class JsonnetTests(unittest.TestCase):
         )
         self.assertEqual(json_str, self.expected_str)
 
+    def test_evaluate_large_output(self):
+        # The JSON is handed over in several pieces while it is manifested.
+        json_str = _jsonnet.evaluate_snippet(
+            "snippet", "[{ i: i, s: '\\u00e9\\u2603 %d' % i } for i in std.range(1, 20000)]")
+        self.assertEqual(
+            json.loads(json_str),
+            [{"i": i, "s": u"\u00e9\u2603 %d" % i} for i in range(1, 20001)])
+        self.assertRaisesRegex(
+            RuntimeError, "RUNTIME ERROR: boom",
+            _jsonnet.evaluate_snippet, "snippet", "std.range(1, 20000) + [error 'boom']")
+
+    def test_evaluate_to_python(self):
+        src = """{
+            a: [1, 2.5, -3, 1e20, null, true, false, "\\u00e9\\u2603"],
+            n: [1e17, 1e22, 1e300, -0, 0.5, -1e-300, 9007199254740993],
+            b: { c: {}, d: [] },
+            h:: "hidden",
+            "\\u2603": 0.1,
+        }"""
+        expected = json.loads(_jsonnet.evaluate_snippet("snippet", src))
+        value = _jsonnet.evaluate_snippet_to_python("snippet", src)
+        self.assertEqual(value, expected)
+        self.assertEqual(list(value.keys()), sorted(expected.keys()))
+        for v, e in zip(value["a"] + value["n"], expected["a"] + expected["n"]):
+            self.assertIs(type(v), type(e))
+        self.assertEqual(
+            _jsonnet.evaluate_file_to_python(
+                self.input_filename,
+                import_callback=import_callback,
+                native_callbacks=native_callbacks,
+            ),
+            True)
+
+    def test_evaluate_to_python_errors(self):
+        self.assertRaisesRegex(
+            RuntimeError, "RUNTIME ERROR: boom",
+            _jsonnet.evaluate_snippet_to_python, "snippet", "[1, error 'boom']")
+        self.assertRaisesRegex(
+            RuntimeError, "couldn't manifest function",
+            _jsonnet.evaluate_snippet_to_python, "snippet",
+            "{ a: [function(x) x] }")
+
+    def test_evaluate_to_python_deeply_nested(self):
+        depth = 100000
+        nest = ("local nest(n, v) = if n == 0 then v else nest(n - 1, [v]) tailstrict; "
+                "local deep = nest(%d, {a: 1}); " % depth)
+
+        def check(value):
+            for _ in range(depth):
+                self.assertEqual(len(value), 1)
+                value = value[0]
+            self.assertEqual(value, {"a": 1})
+        check(_jsonnet.evaluate_snippet_to_python("snippet", nest + "deep", max_stack=10 ** 8))
+        args = []
+        natives = {"record": (("v",), lambda v: args.append(v) or True)}
+        self.assertEqual(
+            _jsonnet.evaluate_snippet_to_python(
+                "snippet", nest + 'std.native("record")(deep)',
+                native_callbacks=natives, max_stack=10 ** 8),
+            True)
+        check(args[0])
+
+    def test_vm_evaluate(self):
+        vm = _jsonnet.Vm(
+            import_callback=import_callback,
+            native_callbacks=native_callbacks,
+        )
+        for _ in range(3):
+            json_str = vm.evaluate_file(self.input_filename)
+            self.assertEqual(json_str, self.expected_str)
+            json_str = vm.evaluate_snippet("snippet", self.input_snippet)
+            self.assertEqual(json_str, self.expected_str)
+            self.assertEqual(
+                vm.evaluate_snippet_to_python("snippet", self.input_snippet),
+                True)
+
+    def test_vm_vars_are_per_call(self):
+        vm = _jsonnet.Vm()
+        src = "function(y) std.extVar('x') + y"
+        self.assertEqual(
+            vm.evaluate_snippet("snippet", src, ext_codes={"x": "1"},
+                                tla_codes={"y": "2"}),
+            "3\n")
+        self.assertEqual(
+            vm.evaluate_snippet("snippet", src, ext_codes={"x": "10"},
+                                tla_codes={"y": "20"}),
+            "30\n")
+        self.assertRaises(RuntimeError, vm.evaluate_snippet, "snippet", src)
+
+    def test_vm_reimports_changed_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            lib = os.path.join(tmpdir, "lib.libsonnet")
+            main = os.path.join(tmpdir, "main.jsonnet")
+            with open(main, "w") as f:
+                f.write("(import 'lib.libsonnet') + 1")
+            vm = _jsonnet.Vm()
+            with open(lib, "w") as f:
+                f.write("1")
+            self.assertEqual(vm.evaluate_file(main), "2\n")
+            with open(lib, "w") as f:
+                f.write("41")
+            self.assertEqual(vm.evaluate_file(main), "42\n")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_import_changed_during_evaluation(self):
+        # Both imports are found at the same path, but with different content.  The fields of a
+        # are still evaluated after b has replaced it in the cache.
+        def import_same_path(dir, rel):
+            return "lib.libsonnet", "{ x: %d, y: self.x * 10 }" % (1 if rel == "a" else 2)
+        vm = _jsonnet.Vm(import_callback=import_same_path)
+        snippet = "local a = import 'a', b = import 'b'; [a.x + b.x, a.y]"
+        self.assertEqual(vm.evaluate_snippet("snippet", snippet), "[\n   3,\n   10\n]\n")
+
+    def test_vm_rejects_reentrant_evaluation(self):
+        def reenter(dir, rel):
+            return rel, vm.evaluate_snippet("inner", "1")
+        vm = _jsonnet.Vm(import_callback=reenter)
+        self.assertRaisesRegex(
+            RuntimeError, "already evaluating",
+            vm.evaluate_snippet, "snippet", "import 'x'")
+
+    def test_compile(self):
+        program = _jsonnet.compile(
+            "snippet",
+            "function(tenant) { tenant: tenant, region: std.extVar('region') }")
+        for tenant in ["a", "b", "c"]:
+            self.assertEqual(
+                program.evaluate_to_python(ext_vars={"region": "eu"},
+                                           tla_vars={"tenant": tenant}),
+                {"tenant": tenant, "region": "eu"})
+        self.assertEqual(
+            program.evaluate(ext_vars={"region": "us"},
+                             tla_codes={"tenant": "1 + 1"}),
+            '{\n   "region": "us",\n   "tenant": 2\n}\n')
+        self.assertRaisesRegex(
+            RuntimeError, "undefined external variable: region",
+            program.evaluate, tla_vars={"tenant": "a"})
+
+    def test_compile_file(self):
+        program = _jsonnet.compile(
+            self.input_filename,
+            import_callback=import_callback,
+            native_callbacks=native_callbacks,
+        )
+        self.assertEqual(program.evaluate(), self.expected_str)
+        self.assertEqual(program.evaluate(), self.expected_str)
+        vm = _jsonnet.Vm(
+            import_callback=import_callback,
+            native_callbacks=native_callbacks,
+        )
+        program = vm.compile("snippet", src=self.input_snippet)
+        del vm
+        self.assertEqual(program.evaluate_to_python(), True)
+
+    def test_compile_errors(self):
+        self.assertRaisesRegex(
+            RuntimeError, "STATIC ERROR",
+            _jsonnet.compile, "snippet", src="{")
+        self.assertRaisesRegex(
+            RuntimeError, "Unknown variable: x",
+            _jsonnet.compile, "snippet", src="x")
+
+    def test_evaluate_many(self):
+        jobs = [
+            self.input_filename,
+            {"filename": "snippet", "src": 'std.extVar("x")', "ext_vars": {"x": "y"}},
+            {"filename": "snippet", "src": "error 'foo'"},
+        ] * 3
+        results = _jsonnet.evaluate_many(
+            jobs, workers=2, import_callback=import_callback,
+            native_callbacks=native_callbacks)
+        self.assertEqual(len(results), 9)
+        for i in range(0, 9, 3):
+            self.assertEqual(results[i], self.expected_str)
+            self.assertEqual(results[i + 1], '"y"\n')
+            self.assertIsInstance(results[i + 2], RuntimeError)
+            self.assertIn("RUNTIME ERROR: foo", str(results[i + 2]))
+        self.assertEqual(
+            _jsonnet.evaluate_many([{"filename": "snippet", "src": "[1]"}], to_python=True),
+            [[1]])
+        self.assertEqual(_jsonnet.evaluate_many([]), [])
+
+    def test_evaluate_async(self):
+        started = []
+
+        async def async_import_callback(dir, rel):
+            started.append(rel)
+            # Every evaluation has to reach its import before any of them can finish.
+            while len(started) < 3:
+                await asyncio.sleep(0.01)
+            return rel, "{name: '%s'}" % rel
+
+        async def main():
+            return await asyncio.gather(*[
+                _jsonnet.evaluate_snippet_async(
+                    "snippet", 'import "%s"' % name, import_callback=async_import_callback)
+                for name in ("a", "b", "c")
+            ])
+
+        class Awaitable:
+            def __init__(self, rel):
+                self.rel = rel
+
+            def __await__(self):
+                yield from asyncio.sleep(0).__await__()
+                return self.rel, "'%s'" % self.rel
+
+        async def awaitable():
+            return await _jsonnet.evaluate_snippet_async(
+                "snippet", 'import "d"', import_callback=lambda dir, rel: Awaitable(rel))
+
+        async def error():
+            return await _jsonnet.evaluate_snippet_async("snippet", "error 'foo'")
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(main())
+            self.assertEqual(
+                [json.loads(r) for r in results], [{"name": "a"}, {"name": "b"}, {"name": "c"}])
+            self.assertEqual(loop.run_until_complete(awaitable()), '"d"\n')
+            self.assertRaisesRegex(
+                RuntimeError, "RUNTIME ERROR: foo", loop.run_until_complete, error())
+        finally:
+            loop.close()
+        self.assertRaisesRegex(
+            RuntimeError, "no running event loop",
+            _jsonnet.evaluate_snippet_async, "snippet", "1")
+
+    def test_stats(self):
+        result, stats = _jsonnet.evaluate_snippet_to_python(
+            "snippet", "std.foldl(function(a, b) a + [b], std.range(1, 100), [])", stats=True)
+        self.assertEqual(result, list(range(1, 101)))
+        for key in ("lex_seconds", "parse_seconds", "desugar_seconds", "static_analysis_seconds",
+                    "execute_seconds", "manifest_seconds", "gc_mark_seconds", "gc_sweep_seconds"):
+            self.assertGreaterEqual(stats[key], 0)
+        self.assertGreater(stats["heap_allocations"]["arrays"], 100)
+        self.assertGreater(stats["max_heap_entities"], 0)
+        self.assertGreater(stats["max_stack_depth"], 0)
+        self.assertGreaterEqual(stats["gc_cycles"], stats["gc_minor_cycles"])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            main = os.path.join(tmpdir, "main.jsonnet")
+            with open(main, "w") as f:
+                f.write("(import 'lib.libsonnet') + (import 'lib.libsonnet')")
+            with open(os.path.join(tmpdir, "lib.libsonnet"), "w") as f:
+                f.write("1")
+            vm = _jsonnet.Vm()
+            result, stats = vm.evaluate_file(main, stats=True)
+            self.assertEqual(result, "2\n")
+            self.assertEqual((stats["import_cache_hits"], stats["import_cache_misses"]), (1, 1))
+            result, stats = vm.evaluate_file(main, stats=True)
+            self.assertEqual((stats["import_cache_hits"], stats["import_cache_misses"]), (2, 0))
+            self.assertEqual(vm.evaluate_file(main), "2\n")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_gc_nursery_objects(self):
+        snippet = """
+            local obj = { f(n):: if n == 0 then [] else [{ v: n }] + self.f(n - 1) };
+            std.foldl(function(a, b) a + b.v, obj.f(200), 0)
+        """
+        result, stats = _jsonnet.evaluate_snippet_to_python(
+            "snippet", snippet, gc_min_objects=1, gc_nursery_objects=1, stats=True)
+        self.assertEqual(result, 20100)
+        self.assertGreater(stats["gc_minor_cycles"], 0)
+        result, stats = _jsonnet.evaluate_snippet_to_python(
+            "snippet", snippet, gc_min_objects=1, gc_nursery_objects=0, stats=True)
+        self.assertEqual(result, 20100)
+        self.assertEqual(stats["gc_minor_cycles"], 0)
+
+    def test_ext_and_tla_values(self):
+        value = {"k": [1, 2.5, None, True, "s"]}
+        self.assertEqual(
+            _jsonnet.evaluate_snippet_to_python(
+                "snippet", 'function(a, b) [std.extVar("x"), std.extVar("x").k[1], a, b]',
+                ext_values={"x": value}, tla_values={"a": [value]}, tla_codes={"b": "1 + 1"}),
+            [value, 2.5, [value], 2])
+        program = _jsonnet.compile("snippet", src='function(a) a + std.extVar("x")')
+        self.assertEqual(program.evaluate(ext_values={"x": 1}, tla_values={"a": 2}), "3\n")
+        self.assertEqual(program.evaluate(ext_values={"x": 10}, tla_values={"a": 20}), "30\n")
+        self.assertRaisesRegex(
+            TypeError, r'Unrecognized type in ext_values\["x"\]',
+            _jsonnet.evaluate_snippet, "snippet", "1", ext_values={"x": object()})
+        for value, msg in [("a\udcff", "String not encodable as UTF-8"),
+                           (10 ** 400, "Integer too large"),
+                           (float("nan"), "Non-finite number"),
+                           ([float("inf")], "Non-finite number"),
+                           (b"ab", "Bytes instead of str"),
+                           (bytearray(b"ab"), "Bytes instead of str")]:
+            self.assertRaisesRegex(
+                TypeError, msg, _jsonnet.evaluate_snippet, "snippet", "1", ext_values={"x": value})
+        self.assertEqual(
+            _jsonnet.evaluate_snippet("snippet", 'std.extVar("x")', ext_values={"x": 2 ** 70}),
+            "1180591620717411303424\n")
+
+    def test_native_structured_args(self):
+        args = []
+
+        def record(a, b):
+            args.append((a, b))
+            return b
+
+        def cycle():
+            x = []
+            x.append(x)
+            return x
+
+        natives = {
+            'record': (('a', 'b'), record),
+            'cycle': ((), cycle),
+        }
+        self.assertEqual(
+            _jsonnet.evaluate_snippet_to_python(
+                "snippet",
+                'local o = {x: 1, h:: 2, y: [o.x, "s", null]};'
+                'std.native("record")(o, [o, true])',
+                native_callbacks=natives),
+            [{"x": 1, "y": [1, "s", None]}, True])
+        self.assertEqual(
+            args, [({"x": 1, "y": [1, "s", None]}, [{"x": 1, "y": [1, "s", None]}, True])])
+        self.assertRaisesRegex(
+            RuntimeError, "lazy",
+            _jsonnet.evaluate_snippet, "snippet",
+            'std.native("record")([error "lazy"], 1)', native_callbacks=natives)
+        self.assertRaisesRegex(
+            RuntimeError, "max stack frames exceeded",
+            _jsonnet.evaluate_snippet, "snippet",
+            'local x = {a: x}; std.native("record")(x, 1)', native_callbacks=natives)
+        self.assertRaisesRegex(
+            RuntimeError, "Cyclic",
+            _jsonnet.evaluate_snippet, "snippet",
+            'std.native("cycle")()', native_callbacks=natives)
+
+    def test_evaluate_multi(self):
+        docs = _jsonnet.evaluate_snippet_multi(
+            "snippet", "function(x) {b: {x: x}, a: [x]}", tla_codes={"x": "1"})
+        self.assertEqual(
+            list(docs),
+            [("a", "[\n   1\n]\n"), ("b", "{\n   \"x\": 1\n}\n")])
+        self.assertRaisesRegex(
+            RuntimeError, "multi mode: top-level object was a array",
+            lambda: list(_jsonnet.evaluate_snippet_multi("snippet", "[1]")))
+
+    def test_evaluate_stream_is_lazy(self):
+        vm = _jsonnet.Vm()
+        docs = vm.evaluate_snippet_stream("snippet", '[1, error "second", 3]')
+        self.assertEqual(next(docs), "1\n")
+        self.assertRaisesRegex(RuntimeError, "second", next, docs)
+        self.assertEqual(list(docs), [])
+        self.assertRaisesRegex(
+            RuntimeError, "stream mode: top-level object was a object",
+            _jsonnet.evaluate_snippet_stream, "snippet", "{}")
+
+    def test_unfinished_iterator_keeps_vm_busy(self):
+        content = {"x": "{ a: [1, 2, 3], f(n):: n + 1 }"}
+        vm = _jsonnet.Vm(import_callback=lambda dir, rel: (rel, content[rel]))
+        docs = vm.evaluate_snippet_stream(
+            "snippet", "local x = import 'x'; [std.length(x.a), x.f(2)]")
+        self.assertEqual(next(docs), "3\n")
+        content["x"] = "{ a: [] }"
+        self.assertRaisesRegex(
+            RuntimeError, "unfinished Documents iterator", vm.evaluate_snippet, "snippet", "1")
+        self.assertEqual(list(docs), ["3\n"])
+        self.assertEqual(vm.evaluate_snippet("snippet", "std.length((import 'x').a)"), "0\n")
+        docs = vm.evaluate_snippet_stream("snippet", "[1, 2]")
+        del docs
+        self.assertEqual(vm.evaluate_snippet("snippet", "1"), "1\n")
+
+    def test_threads(self):
+        results = []
+
+        def worker(i):
+            vm = _jsonnet.Vm(
+                import_callback=import_callback,
+                native_callbacks=native_callbacks,
+            )
+            for j in range(20):
+                results.append(vm.evaluate_file(self.input_filename))
+                results.append(_jsonnet.evaluate_snippet(
+                    "snippet", "std.extVar('i') * 100 + %d" % j,
+                    ext_codes={"i": str(i)}) == "%d\n" % (i * 100 + j))
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 8 * 20 * 2)
+        for r in results:
+            self.assertTrue(r == self.expected_str or r is True, r)
+
+    @unittest.skipIf((os.cpu_count() or 1) < 4, "needs 4 CPUs to measure scaling")
+    def test_threads_scale(self):
+        # With the GIL released, 4 evaluations on 4 threads take about as long as 1.  The
+        # threshold is generous, so that a loaded machine does not fail it.
+        src = "std.foldl(function(a, b) a + b, std.range(1, 300000), 0)"
+
+        def evaluate():
+            _jsonnet.evaluate_snippet("snippet", src)
+
+        def elapsed(threads):
+            best = None
+            for _ in range(3):
+                ts = [threading.Thread(target=evaluate) for _ in range(threads)]
+                start = time.perf_counter()
+                for t in ts:
+                    t.start()
+                for t in ts:
+                    t.join()
+                t = time.perf_counter() - start
+                best = t if best is None else min(best, t)
+            return best
+        one = elapsed(1)
+        four = elapsed(4)
+        # Serially, 4 evaluations would take 4 * one.
+        self.assertLess(four, 4 * one / 1.5)
+
+    def test_gil_released_during_evaluation(self):
+        # b polls until this thread has run, which it cannot do while evaluation holds the GIL.
+        # poll is a builtin, so calling it does not give other threads a turn either.
+        started = threading.Event()
+        ran = []
+        natives = {"start": ((), started.set), "poll": ((), ran.__len__)}
+        src = ("local wait(n) = if n == 100000 then -1 "
+               "else if std.native('poll')() > 0 then n else wait(n + 1) tailstrict; "
+               "{ a: 1, b: if std.native('start')() == null then wait(0) }")
+        evaluators = [
+            lambda: json.loads(_jsonnet.evaluate_snippet(
+                "snippet", src, native_callbacks=natives)),
+            # b is only evaluated after a has been built.
+            lambda: _jsonnet.evaluate_snippet_to_python(
+                "snippet", src, native_callbacks=natives),
+        ]
+        for evaluate in evaluators:
+            started.clear()
+            del ran[:]
+            results = []
+            t = threading.Thread(target=lambda: results.append(evaluate()))
+            t.start()
+            started.wait()
+            ran.append(True)
+            t.join()
+            self.assertNotEqual(results[0]["b"], -1)
+
+    def test_vm_rejects_concurrent_evaluation(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def block(dir, rel):
+            started.set()
+            release.wait()
+            return rel, "1"
+        vm = _jsonnet.Vm(import_callback=block)
+        t = threading.Thread(target=vm.evaluate_snippet,
+                             args=("snippet", "import 'x'"))
+        t.start()
+        try:
+            started.wait()
+            self.assertRaisesRegex(
+                RuntimeError, "one Vm per thread",
+                vm.evaluate_snippet, "snippet", "1")
+        finally:
+            release.set()
+            t.join()
+
 if __name__ == '__main__':
     unittest.main()
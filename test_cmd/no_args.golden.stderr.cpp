@@ -16,6 +16,7 @@ Available options:
   -t / --max-trace <n>    Max length of stack trace before cropping
   --gc-min-objects <n>    Do not run garbage collector until this many
   --gc-growth-trigger <n> Run garbage collector after this amount of object growth
+  --gc-nursery-objects <n> Collect new objects once there are this many (0 to disable)
   --version               Print version
 Available options for specifying values of 'external' variables:
 Provide the value as a string:
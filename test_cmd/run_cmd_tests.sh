@@ -45,10 +45,30 @@ do_test "exec1" 0 -e "{ a: 1, b: 2, c: 3 }"
 if do_test "exec_out" 0 -e "{ a: 1, b: 2, c: 3 }" -o "out/exec_out/custom_output"; then
     check_file "exec_out" "out/exec_out/custom_output" "exec_out.golden.custom_output"
 fi
+mkdir -p "out/error_out"
+echo "old" > "out/error_out/custom_output"
+if do_test "error_out" 1 -e 'std.range(1, 20000) + [error "foo"]' -o "out/error_out/custom_output"; then
+    # The output written before the error is discarded and the existing file is kept.
+    ls "out/error_out" > "out/error_out/list"
+    check_file "error_out" "out/error_out/list" "error_out.golden.list"
+    check_file "error_out" "out/error_out/custom_output" "error_out.golden.custom_output"
+fi
+
+mkdir -p "out/link_out"
+echo "old" > "out/link_out/target"
+ln -s "target" "out/link_out/custom_output"
+if do_test "link_out" 0 -e "{ a: 1, b: 2, c: 3 }" -o "out/link_out/custom_output"; then
+    # The output is written to the file that the link points to, and the link is kept.
+    if [ ! -L "out/link_out/custom_output" ]; then
+        echo "out/link_out/custom_output" > "out/link_out/not_a_link"
+        check_file "link_out" "out/link_out/not_a_link" /dev/null
+    fi
+    check_file "link_out" "out/link_out/target" "exec_out.golden.custom_output"
+fi
 do_test "double_dash" 0 -e -- -1
-do_test "max_stack1" 1 -s 1 -e 'local x = 1; x'
-do_test "max_stack2" 1 --max-stack 1 -e 'local x = 1; x'
-do_test "max_stack3" 0 --max-stack 2 -e 'local x = 1; x'
+do_test "max_stack1" 1 -s 1 -e 'local x = [1]; x[0]'
+do_test "max_stack2" 1 --max-stack 1 -e 'local x = [1]; x[0]'
+do_test "max_stack3" 0 --max-stack 2 -e 'local x = [1]; x[0]'
 do_test "max_stack4" 0 --max-stack 7 -e 'local f(n, c=0) = if n == 0 then c else f(n - 1, c + n) tailstrict; f(100)'
 do_test "max_stack5" 1 --max-stack 0 -e 'true'
 do_test "max_stack6" 1 --max-stack -1 -e 'true'